@@ -0,0 +1,423 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Mide el tiempo y la memoria de las partes pesadas de Main.py sobre los
+conjuntos GTFS incluidos (datos/gtfs/* y gtfs/sitran), y guarda los
+resultados en JSON para comparar entre commits.
+
+Las consultas a Overpass van a un servidor local que repite respuestas
+grabadas (datos/benchmark/overpass.json.gz). Con --grabar, ese servidor
+reenvía a los servidores reales lo que no tenga grabado y lo guarda; con
+--extracto, responde las consultas por caja con un extracto OSM local, y
+con --sintetico, con paradas inventadas junto a las paradas GTFS (para
+grabar sin red ni extracto). Las grabaciones incluidas son sintéticas,
+de UNIBUSPV; con --grabar contra los servidores reales se reemplazan.
+
+    python Benchmark.py                      # todo, 3 repeticiones
+    python Benchmark.py -c SITEUR -b cargar  # solo un conjunto y un grupo
+    python Benchmark.py --comparar anterior.json
+    python Benchmark.py -c UNIBUSPV -b osm -n 1 --grabar  # grabar respuestas reales
+"""
+
+import os
+import re
+import sys
+import gc
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import tracemalloc
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import Main
+
+RUTA_BASE = os.path.dirname(os.path.abspath(__file__))
+RUTA_GRABACIONES = os.path.join(RUTA_BASE, "datos/benchmark/overpass.json.gz")
+CONJUNTOS_BENCHMARK = [
+    os.path.join(Main.RUTA_DATOS_GTFS, nombre) for nombre in sorted(Main.CONJUNTOS_GTFS)
+] + [os.path.join(RUTA_BASE, "gtfs/sitran")]
+TIMESTAMP_GRABACIONES = "2000-01-01T00:00:00Z"
+# Fracción de las paradas GTFS que tienen una parada sintética al lado
+FRACCION_PARADAS_SINTETICAS = 0.6
+# Si una medición empeora más que esto respecto a la comparada, se marca
+TOLERANCIA_REGRESION = 0.10
+
+
+class ExtractoSintetico:
+    """
+    Paradas de OSM inventadas junto a una parte de las paradas de los
+    conjuntos GTFS, siempre las mismas (dependen solo del stop_id). Algunas
+    llevan la etiqueta ref. Se consulta como Main.AlmacenOsmLocal.
+    """
+
+    generador = "Benchmark.py (sintético)"
+
+    def __init__(self, rutasConjuntos: list):
+        self.nodos = []
+        for rutaConjunto in rutasConjuntos:
+            for stop_id, parada in Main.cargarTablaGtfs(rutaConjunto, "stops").items():
+                azar = hashlib.sha1(stop_id.encode("utf-8")).digest()
+                if azar[0] / 256 >= FRACCION_PARADAS_SINTETICAS:
+                    continue
+                etiquetas = {"highway": "bus_stop"}
+                if azar[1] < 52:
+                    etiquetas["ref"] = stop_id
+                self.nodos.append({
+                    "type": "node",
+                    "id": len(self.nodos) + 1,
+                    # A unos metros de la parada GTFS
+                    "lat": round(float(parada["stop_lat"]) + (azar[2] - 128) * 3e-7, 7),
+                    "lon": round(float(parada["stop_lon"]) + (azar[3] - 128) * 3e-7, 7),
+                    "version": 1,
+                    "tags": etiquetas,
+                })
+
+    def paradasEnCajas(self, cajas: list):
+        return [
+            nodo for nodo in self.nodos
+            if any(sur <= nodo["lat"] <= norte and oeste <= nodo["lon"] <= este
+                   for sur, oeste, norte, este in cajas)
+        ]
+
+
+class ServidorOverpassGrabado:
+    """
+    Servidor HTTP local que se hace pasar por una instancia de Overpass
+    (/status, /timestamp, /interpreter) y contesta con respuestas grabadas,
+    buscadas por la petición normalizada.
+    @grabar: Guardar en las grabaciones lo que no esté grabado. Lo responde
+             el almacén si hay, o si no los servidores Overpass reales
+    """
+
+    def __init__(self, grabaciones: dict, almacen=None, grabar=False):
+        self.grabaciones = grabaciones
+        self.almacen = almacen
+        self.grabar = grabar
+        self.aciertos = 0
+        self.fallos = 0
+        self.candado = threading.Lock()
+        # Main.clienteOverpass se cambia por uno que solo conoce este
+        # servidor; para grabar hace falta uno propio con los reales
+        self.clienteReal = Main.ClienteOverpass() if grabar and almacen is None else None
+
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def responder(self, cuerpo: str, tipo="text/plain"):
+                cuerpo = cuerpo.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", f"{tipo}; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def do_GET(self):
+                if self.path.endswith("/status"):
+                    self.responder("Connected as: 0\nRate limit: 0\n")
+                else:
+                    self.responder(TIMESTAMP_GRABACIONES + "\n")
+
+            def do_POST(self):
+                largo = int(self.headers.get("Content-Length", 0))
+                datos = parse_qs(self.rfile.read(largo).decode("utf-8"))
+                self.responder(servidor.respuesta(datos.get("data", [""])[0]))
+
+        self.http = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+        self.url = f"http://127.0.0.1:{self.http.server_address[1]}/api"
+
+    def respuesta(self, peticion: str):
+        clave = Main.CacheOverpass.hashPeticion(peticion)
+        with self.candado:
+            respuesta = self.grabaciones.get(clave)
+
+        if respuesta is None and self.grabar:
+            if self.almacen is not None:
+                respuesta = self.respuestaSintetica(peticion)
+            else:
+                respuesta = self.respuestaReal(peticion)
+            if respuesta is not None:
+                with self.candado:
+                    self.grabaciones[clave] = respuesta
+        if respuesta is None:
+            respuesta = self.respuestaSintetica(peticion)
+            with self.candado:
+                self.fallos += 1
+        else:
+            with self.candado:
+                self.aciertos += 1
+
+        return respuesta
+
+    def respuestaReal(self, peticion: str):
+        """La respuesta de los servidores Overpass reales, probando con el
+        siguiente si uno falla; None si ninguno respondió bien"""
+        while True:
+            urlServidor = self.clienteReal.mejorServidor()
+            if urlServidor is None:
+                return None
+            datos = self.clienteReal.post(urlServidor, "interpreter", data={"data": peticion})
+            if datos is not None and datos.ok and "runtime error" not in datos.text:
+                return datos.text
+            self.clienteReal.descartar(urlServidor)
+
+    def respuestaSintetica(self, peticion: str):
+        """Sin grabación: las paradas del extracto en las cajas de la
+        petición, o una respuesta vacía"""
+        elementos = []
+        if self.almacen is not None:
+            cajas = re.findall(r"\(([-\d.]+),([-\d.]+),([-\d.]+),([-\d.]+)\)", peticion)
+            elementos = self.almacen.paradasEnCajas([tuple(map(float, c)) for c in cajas])
+        return json.dumps({
+            "version": 0.6,
+            "generator": getattr(self.almacen, "generador", "Benchmark.py"),
+            "osm3s": {"timestamp_osm_base": TIMESTAMP_GRABACIONES, "copyright": Main.CREDITOS_OSM},
+            "elements": elementos,
+        })
+
+    def __enter__(self):
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.http.shutdown()
+        self.http.server_close()
+
+
+def cargarGrabaciones(ruta: str = RUTA_GRABACIONES):
+    try:
+        with gzip.open(ruta, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+
+def guardarGrabaciones(grabaciones: dict, ruta: str = RUTA_GRABACIONES):
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with gzip.open(ruta, "wt", encoding="utf-8") as f:
+        json.dump(grabaciones, f)
+
+
+def medir(funcion, repeticiones: int, preparar=None):
+    """
+    Corre la función varias veces y mide cada corrida; después una más con
+    tracemalloc para el pico de memoria (aparte, porque lo hace más lento).
+    @preparar: Se llama antes de cada corrida, fuera de la medición
+    """
+    segundos = []
+    for _ in range(repeticiones):
+        if preparar:
+            preparar()
+        gc.collect()
+        inicio = time.perf_counter()
+        funcion()
+        segundos.append(time.perf_counter() - inicio)
+
+    if preparar:
+        preparar()
+    gc.collect()
+    tracemalloc.start()
+    funcion()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "segundos": [round(s, 6) for s in segundos],
+        "mejor": round(min(segundos), 6),
+        "mediana": round(statistics.median(segundos), 6),
+        "memoria_pico_bytes": pico,
+    }
+
+
+def benchmarksDeCarga(rutaConjunto: str):
+    """Cada obtener* (a través de cargarTablaDesdeCsv) y el tablero de salidas"""
+    pruebas = {}
+    for tabla in list(Main.TABLAS_GTFS) + list(Main.TABLAS_DERIVADAS_GTFS):
+        pruebas[f"cargar:{tabla}"] = (
+            lambda tabla=tabla: Main.cargarTablaDesdeCsv(rutaConjunto, tabla), None)
+    return pruebas
+
+
+def benchmarksDeHorarios(rutaConjunto: str):
+    conjunto = Main.conjuntoGtfs
+    viajes = [
+        viaje
+        for rutas in conjunto.trips.values()
+        for viaje in rutas.values()
+        if viaje["trip_id"] in conjunto.stop_times.indiceViajes
+    ]
+
+    def paradasDeViajes():
+        for viaje in viajes:
+            Main.ajustarHorariosDeParadas(
+                Main.ordenarParadas(conjunto.stop_times[viaje["trip_id"]]))
+
+    def expandirHorarios():
+        for viaje in viajes:
+            conjunto.horariosDeViaje(viaje["trip_id"])
+
+    def olvidarHorarios():
+        conjunto._horariosDeViajes.clear()
+
+    rutas = [r for agencia in conjunto.routes.values() for r in agencia.values()]
+
+    return {
+        "horarios:ordenar_y_ajustar_paradas": (paradasDeViajes, None),
+        "horarios:expandir_frecuencias": (expandirHorarios, olvidarHorarios),
+        "horarios:ordenar_rutas_dividirRuta": (
+            lambda: sorted(rutas * 20, key=Main.dividirRuta), None),
+    }
+
+
+def benchmarksDeOsm(rutaConjunto: str, directorio: str):
+    conjunto = Main.conjuntoGtfs
+    agencias = list(conjunto.agency.values())
+    pares = [
+        (ruta, viaje)
+        for agencia in agencias
+        for ruta in conjunto.routes.get(agencia["agency_id"], {}).values()
+        for viaje in Main.viajesRepresentativos(ruta)
+    ]
+
+    def cacheVacia():
+        # Cada corrida pasa por el servidor, no por la caché en disco
+        Main.cacheOverpass = Main.CacheOverpass(tempfile.mkdtemp(dir=directorio))
+
+    def colisiones():
+        for _ in Main.verificarColisionesEnLote(pares):
+            pass
+
+    def osmchange():
+        Main.exportarOsmchangeEnLote(
+            os.path.basename(rutaConjunto), agencias,
+            directorio=directorio, pausarAlFinalizar=False)
+
+    return {
+        "osm:colisiones_en_lote": (colisiones, cacheVacia),
+        "osm:osmchange_en_lote": (osmchange, cacheVacia),
+    }
+
+
+def commitActual():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=RUTA_BASE,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def comparar(resultados: dict, anteriores: dict):
+    print("%-10s %-40s %10s %10s %8s" % ("Conjunto", "Prueba", "Antes", "Ahora", "Cambio"))
+    for conjunto, pruebas in resultados["conjuntos"].items():
+        for nombre, medicion in pruebas.items():
+            anterior = anteriores.get("conjuntos", {}).get(conjunto, {}).get(nombre)
+            if anterior is None:
+                continue
+            cambio = medicion["mejor"] / anterior["mejor"] - 1 if anterior["mejor"] else 0
+            marca = "  <-- más lento" if cambio > TOLERANCIA_REGRESION else ""
+            print("%-10s %-40s %9.4fs %9.4fs %+7.1f%%%s" % (
+                conjunto, nombre, anterior["mejor"], medicion["mejor"], cambio * 100, marca))
+
+
+def main():
+    analizador = argparse.ArgumentParser(description="Benchmarks de Main.py")
+    analizador.add_argument("-c", "--conjunto", action="append",
+                            help="Nombre del conjunto (por defecto, todos)")
+    analizador.add_argument("-b", "--grupo", action="append", choices=("cargar", "horarios", "osm"),
+                            help="Grupo de pruebas (por defecto, todos)")
+    analizador.add_argument("-n", "--repeticiones", type=int, default=3)
+    analizador.add_argument("-o", "--salida", help="Archivo JSON de resultados")
+    analizador.add_argument("--comparar", help="Resultados anteriores con los que comparar")
+    analizador.add_argument("--extracto", help="Extracto OSM para lo que no esté grabado")
+    analizador.add_argument("--sintetico", action="store_true",
+                            help="Paradas sintéticas junto a las GTFS para lo que no esté grabado")
+    analizador.add_argument("--grabar", action="store_true",
+                            help="Guardar lo que no esté grabado: lo que responda el extracto "
+                                 "(o las paradas sintéticas), o si no Overpass de verdad")
+    args = analizador.parse_args()
+
+    grupos = args.grupo or ["cargar", "horarios", "osm"]
+    conjuntos = [
+        c for c in CONJUNTOS_BENCHMARK
+        if not args.conjunto or os.path.basename(c) in args.conjunto
+    ]
+    commit = commitActual()
+    resultados = {
+        "commit": commit,
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "repeticiones": args.repeticiones,
+        "conjuntos": {},
+    }
+
+    grabaciones = cargarGrabaciones()
+    if args.extracto:
+        almacen = Main.AlmacenOsmLocal(args.extracto)
+    elif args.sintetico:
+        almacen = ExtractoSintetico(conjuntos)
+    else:
+        almacen = None
+    directorio = tempfile.mkdtemp(prefix="benchmark-")
+
+    try:
+        with ServidorOverpassGrabado(grabaciones, almacen, args.grabar) as servidor:
+            Main.clienteOverpass = Main.ClienteOverpass(servidores=[servidor.url])
+            Main.PETICIONES_POR_SEG_SERVIDOR = 1000
+
+            for rutaConjunto in conjuntos:
+                nombre = os.path.basename(rutaConjunto)
+                print(f"== {nombre} ==", file=sys.stderr)
+                Main.conjuntoGtfs = Main.ConjuntoGtfs(rutaConjunto)
+
+                pruebas = {}
+                if "cargar" in grupos:
+                    pruebas.update(benchmarksDeCarga(rutaConjunto))
+                if "horarios" in grupos:
+                    pruebas.update(benchmarksDeHorarios(rutaConjunto))
+                if "osm" in grupos:
+                    pruebas.update(benchmarksDeOsm(rutaConjunto, directorio))
+
+                mediciones = {}
+                for prueba, (funcion, preparar) in pruebas.items():
+                    # Los mensajes de avance de Main no son parte del reporte
+                    with contextlib.redirect_stdout(open(os.devnull, "w")) as nulo:
+                        mediciones[prueba] = medir(funcion, args.repeticiones, preparar)
+                        nulo.close()
+                    print("  %-40s %9.4f s  %8.1f MiB" % (
+                        prueba, mediciones[prueba]["mejor"],
+                        mediciones[prueba]["memoria_pico_bytes"] / 2**20), file=sys.stderr)
+                resultados["conjuntos"][nombre] = mediciones
+
+            resultados["overpass"] = {"grabadas": servidor.aciertos, "sin_grabar": servidor.fallos}
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    if args.grabar:
+        guardarGrabaciones(grabaciones)
+
+    rutaSalida = args.salida or f"benchmark-{commit or 'resultados'}.json"
+    with open(rutaSalida, "w", encoding="utf-8") as f:
+        json.dump(resultados, f, indent=2)
+    print(f"Resultados guardados en {rutaSalida}", file=sys.stderr)
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(resultados, json.load(f))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
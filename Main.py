@@ -2,29 +2,116 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import math
 import re
 import time
-import datetime
 import math
 import random
+import bisect
 import csv
 import json
+import pickle
+import shutil
+import tempfile
+import hashlib
+import codecs
+import gzip
+import bz2
+import threading
+import argparse
+import datetime
+import contextlib
+import asyncio
+import queue
+import atexit
+import functools
+import cProfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from array import array
+from collections import namedtuple, defaultdict
 import xml.etree.ElementTree as ET
 import requests
-
-print(os.name)
+from requests.adapters import HTTPAdapter
 
 LIMPIAR_PANTALLA = "cls" if ("win" in os.name or "nt" in os.name) else "clear"
 
 # Definimos las rutas de archivo
 RUTA_DATOS_GTFS = os.path.join(os.path.dirname(__file__), "datos/gtfs")
 CONJUNTOS_GTFS = os.listdir(RUTA_DATOS_GTFS)
+# Cómo carga menuGtfs las tablas del conjunto:
+# - "perezosa": cada tabla se procesa hasta que se usa
+# - "precarga": además se cargan en segundo plano mientras se navega
+#               por los menús de agencias y rutas
+# - "paralela": se cargan todas a la vez en un grupo de procesos
+MODO_CARGA_GTFS = "precarga"
+# Procesos para la carga paralela (None para usar todos los núcleos)
+TRABAJADORES_CARGA = None
+# Aquí se guardan las instantáneas binarias de los conjuntos ya procesados
+RUTA_CACHE_GTFS = os.path.join(os.path.dirname(__file__), "datos/cache")
+# Aquí se guardan las respuestas de Overpass ya descargadas
+RUTA_CACHE_OVERPASS = os.path.join(os.path.dirname(__file__), "datos/cache/overpass")
+# Segundos durante los que una respuesta se usa sin preguntarle nada al servidor
+TTL_CACHE_OVERPASS = 6 * 60 * 60
+# Tamaño máximo de la caché de Overpass; al pasarlo se borran las menos usadas
+TAM_MAX_CACHE_OVERPASS = 256 * 1024 * 1024
+# Tamaño de los trozos en que se leen las respuestas grandes de Overpass
+TAM_TROZO_OVERPASS = 64 * 1024
+# Segundos durante los que se reutiliza la marca de tiempo de los datos de un servidor
+SEG_VIGENCIA_TIMESTAMP_OSM = 5 * 60
+# Se incrementa cada vez que cambia la forma de los datos guardados,
+# para que las instantáneas viejas se reconstruyan solas
+VERSION_INSTANTANEA = 8
 RADIO_BUSQ_PREDET = 0.0005
+# Valor para las horas vacías de stop_times (GTFS las permite en paradas intermedias)
+SIN_HORA = -1
 SEG_DESCANSO_ENTRE_PETIC = 0.125
 SEG_DESCANSO_ENTRE_FALLOS = 1.5
 INTENTOS_MAX = 2
+# Espera máxima entre reintentos, aunque el servidor pida más (Retry-After)
+SEG_DESCANSO_MAX = 60
+# Tiempo para conectar y para recibir la respuesta de un servidor Overpass
+SEG_TIMEOUT_CONEXION = 10
+SEG_TIMEOUT_LECTURA = 180
+# Tiempo máximo para que un servidor responda a /status al clasificarlos
+SEG_TIMEOUT_SONDEO = 5
+# Cada cuánto se vuelven a sondear los servidores para reordenarlos
+SEG_VIGENCIA_CLASIFICACION = 10 * 60
+# Slots que se le suponen a un servidor que no limita las peticiones (Rate limit: 0)
+SLOTS_SIN_LIMITE = 4
+# Lado de las áreas en que se agrupan las paradas al buscar colisiones en lote
+TAM_AREA_COLISIONES_GRADOS = 0.05
+# Procesos para armar las relaciones al exportar en lote (None: uno por núcleo)
+TRABAJADORES_EXPORTACION = None
+# Guardar los osmChange comprimidos (.osc.gz)
+COMPRIMIR_OSMCHANGE = False
+# Peticiones por segundo que el motor asíncrono le hace como máximo a cada servidor
+# (además de no pasar de sus slots a la vez)
+PETICIONES_POR_SEG_SERVIDOR = 0.5
 NUM_PRECISION_COORD = 6
+# Tolerancia en metros para simplificar los trazos al cargarlos
+# (Douglas-Peucker). None los deja con todos sus puntos
+TOLERANCIA_TRAZOS_METROS = None
+RADIO_TIERRA_METROS = 6371008.8
+METROS_POR_GRADO = math.pi * RADIO_TIERRA_METROS / 180
+# Lado de las celdas del índice espacial de paradas
+TAM_CELDA_INDICE_METROS = 250
+# Distancia máxima para considerar que una parada de OSM es la misma que una de GTFS
+DIST_MAX_COLISION_METROS = 15
+# Caminatas entre paradas cercanas: hasta qué distancia en línea recta, a
+# qué velocidad (m/s) y cuánto más se camina por las calles que en línea recta
+RADIO_CAMINATA_METROS = 400
+VELOCIDAD_CAMINATA = 1.2
+FACTOR_RODEO_CAMINATA = 1.3
+# Máximo de vehículos distintos en un viaje planificado (RAPTOR)
+MAX_VIAJES_RAPTOR = 5
+# Segundos para bajar de un vehículo y subir a otro en la misma parada
+SEG_MIN_TRANSBORDO = 60
+# Hora de llegada de las paradas a las que aún no se llega en el planificador
+SIN_LLEGADA_RAPTOR = 2**30 - 1
+# Metros a partir de los cuales una parada se marca como lejana a su trazo
+DIST_MAX_PARADA_TRAZO_METROS = 50
 
 SERVIDORES_OSM_OVERPASS = [
     "https://overpass.kumi.systems/api",
@@ -32,43 +119,296 @@ SERVIDORES_OSM_OVERPASS = [
     "http://overpass.openstreetmap.ru/cgi/",
     # "https://lz4.overpass-api.de/api",
 ]
+# Para usar otros servidores (p. ej. uno local) sin tocar el código:
+# OVERPASS_SERVIDORES="http://localhost:12345/api,https://otro/api"
+if os.environ.get("OVERPASS_SERVIDORES"):
+    SERVIDORES_OSM_OVERPASS = [
+        url.strip() for url in os.environ["OVERPASS_SERVIDORES"].split(",") if url.strip()
+    ]
 
 urlServidorOsmOverpass = None
 limitePeticionesAlcanzado = False
+# Extracto local de OSM (un AlmacenOsmLocal). Si está cargado, las
+# verificaciones de colisiones lo usan en lugar de Overpass
+almacenOsmLocal = None
+# Caché en disco de las respuestas de Overpass (una CacheOverpass)
+cacheOverpass = None
+# Cliente HTTP compartido para los servidores Overpass (un ClienteOverpass)
+clienteOverpass = None
+# Si es verdadero, las consultas a Overpass ignoran la caché (pero la actualizan)
+forzarActualizacionOverpass = False
+# Instrumentación de la sesión (ver Instrumentacion). Se activa con
+# INSTRUMENTACION=1, o con una lista de extras: INSTRUMENTACION=perfil,memoria
+# El reporte se guarda al salir en INSTRUMENTACION_SALIDA, o en la carpeta personal
+OPCIONES_INSTRUMENTACION = {
+    opcion.strip() for opcion in os.environ.get("INSTRUMENTACION", "").split(",") if opcion.strip()
+}
+# Máximo de peticiones a Overpass que se guardan una por una en el reporte
+MAX_EVENTOS_INSTRUMENTACION = 10000
+CREDITOS_OSM = ("The data included in this document is from www.openstreetmap.org. "
+                "The data is made available under ODbL.")
+
+# Conjunto GTFS seleccionado en menuGtfs (un ConjuntoGtfs). Sus tablas
+# se cargan la primera vez que se usan
+conjuntoGtfs = None
+
+# Una fila de stop_times. Las horas están en segundos desde
+# el inicio del día de servicio
+HorarioParada = namedtuple(
+    "HorarioParada",
+    ["stop_id", "stop_sequence", "arrival_time", "departure_time"])
+
+
+class Instrumentacion:
+    """
+    Temporizadores y contadores con nombre para ver en qué se va el tiempo
+    de una sesión. Mientras está inactiva, medir() y las funciones marcadas
+    con @medida() solo agregan una comparación.
+
+    Con la opción "perfil" también corre cProfile (solo en el hilo
+    principal), y con "memoria", tracemalloc. Lo que hacen los procesos de
+    trabajo (carga paralela, exportación en lote) no se cuenta por separado,
+    solo el tiempo total de la llamada que los lanzó.
+    """
 
-# Contiene "agencias" que son básicamente las subdivisones
-# del transporte, en este caso macro, tren, sitren, etc
-agency = {}
-# Contiene las rutas como tal. Es recomendable obtener las
-# rutas que contengan el nombre de una agencia determinada,
-# para filtrar y simplificar la navegación
-routes = {}
-# Contiene los viajes que realiza la ruta, es decir, cosas
-# como la dirección y sentido, los días, y un identificador
-# para las paradas que se reaizan
-trips = {}
-# Contiene los tiempos de de frecuencia, esto es, la hora
-# en la que comienza y termina la circulación de la ruta.
-frequencies = {}
-# Describe la forma que recorre la ruta, por ejemplo,
-# para delinearla en un mapa
-shapes = {}
-# Contiene las ubicaciones de las paradas, no sirve sin
-# stop_times
-stops = {}
-# Contiene las paradas específicas de un viaje en particular.
-# Referencia a stops
-stop_times = {}
+    def __init__(self, opciones: set = None):
+        opciones = set(opciones or ())
+        self.activa = bool(opciones)
+        self.perfil = "perfil" in opciones
+        self.memoria = "memoria" in opciones
+        self.inicio = time.time()
+        self.candado = threading.Lock()
+        # nombre -> [llamadas, segundos totales, mínimo, máximo]
+        self.temporizadores = {}
+        self.contadores = {}
+        self.eventos = []
+        self.eventosDescartados = 0
+        self.perfilador = None
+
+    def iniciar(self, guardarAlSalir=False):
+        """Arranca el perfilador y tracemalloc si se pidieron
+        @guardarAlSalir: Guardar el reporte cuando termine el programa"""
+        if self.perfil and self.perfilador is None:
+            self.perfilador = cProfile.Profile()
+            self.perfilador.enable()
+        if self.memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if guardarAlSalir:
+            atexit.register(self.guardarAlSalir)
+
+    def guardarAlSalir(self):
+        try:
+            print(f"Reporte de instrumentación guardado en {self.guardar()}", file=sys.stderr)
+        except OSError as e:
+            print(f"No se pudo guardar el reporte de instrumentación: {e}", file=sys.stderr)
+
+    def registrarTiempo(self, nombre: str, segundos: float):
+        with self.candado:
+            temporizador = self.temporizadores.get(nombre)
+            if temporizador is None:
+                self.temporizadores[nombre] = [1, segundos, segundos, segundos]
+            else:
+                temporizador[0] += 1
+                temporizador[1] += segundos
+                temporizador[2] = min(temporizador[2], segundos)
+                temporizador[3] = max(temporizador[3], segundos)
+
+    def contar(self, nombre: str, cantidad: int = 1):
+        if not self.activa:
+            return
+        with self.candado:
+            self.contadores[nombre] = self.contadores.get(nombre, 0) + cantidad
+
+    def evento(self, tipo: str, **datos):
+        """Anota un suceso con sus datos (p. ej. una petición a Overpass)"""
+        if not self.activa:
+            return
+        with self.candado:
+            if len(self.eventos) < MAX_EVENTOS_INSTRUMENTACION:
+                self.eventos.append({"tipo": tipo, "t": round(time.time() - self.inicio, 3), **datos})
+            else:
+                self.eventosDescartados += 1
+
+    @contextlib.contextmanager
+    def medir(self, nombre: str):
+        if not self.activa:
+            yield
+            return
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrarTiempo(nombre, time.perf_counter() - inicio)
+
+    def medida(self, nombre: str = None):
+        """Decorador que mide cada llamada de la función (o corrutina)"""
+        def decorador(funcion):
+            etiqueta = nombre or funcion.__qualname__
+
+            if asyncio.iscoroutinefunction(funcion):
+                @functools.wraps(funcion)
+                async def envolturaAsincrona(*args, **kwargs):
+                    if not self.activa:
+                        return await funcion(*args, **kwargs)
+                    inicio = time.perf_counter()
+                    try:
+                        return await funcion(*args, **kwargs)
+                    finally:
+                        self.registrarTiempo(etiqueta, time.perf_counter() - inicio)
+                return envolturaAsincrona
+
+            @functools.wraps(funcion)
+            def envoltura(*args, **kwargs):
+                if not self.activa:
+                    return funcion(*args, **kwargs)
+                inicio = time.perf_counter()
+                try:
+                    return funcion(*args, **kwargs)
+                finally:
+                    self.registrarTiempo(etiqueta, time.perf_counter() - inicio)
+            return envoltura
+
+        return decorador
+
+    def medirTrozos(self, nombre: str, trozos):
+        """Deja pasar los trozos de una respuesta contando sus bytes y el
+        tiempo que se pasó esperándolos"""
+        if not self.activa:
+            yield from trozos
+            return
+        total = 0
+        espera = 0.0
+        inicio = time.perf_counter()
+        for trozo in trozos:
+            espera += time.perf_counter() - inicio
+            total += len(trozo)
+            yield trozo
+            inicio = time.perf_counter()
+        espera += time.perf_counter() - inicio
+        self.registrarTiempo(nombre, espera)
+        self.contar(f"{nombre}.bytes", total)
+
+    def reporte(self):
+        with self.candado:
+            temporizadores = {
+                nombre: {
+                    "llamadas": llamadas,
+                    "total": round(total, 6),
+                    "promedio": round(total / llamadas, 6),
+                    "minimo": round(minimo, 6),
+                    "maximo": round(maximo, 6),
+                }
+                for nombre, (llamadas, total, minimo, maximo) in sorted(
+                    self.temporizadores.items(), key=lambda t: -t[1][1])
+            }
+            reporte = {
+                "inicio": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.inicio)),
+                "segundos": round(time.time() - self.inicio, 3),
+                "pid": os.getpid(),
+                "argumentos": sys.argv,
+                "temporizadores": temporizadores,
+                "contadores": dict(sorted(self.contadores.items())),
+                "eventos": list(self.eventos),
+                "eventos_descartados": self.eventosDescartados,
+            }
+
+        if clienteOverpass is not None:
+            reporte["servidores_overpass"] = clienteOverpass.estado
+        if cacheOverpass is not None:
+            reporte["cache_overpass"] = cacheOverpass.estadisticas()
+        if tracemalloc.is_tracing():
+            actual, pico = tracemalloc.get_traced_memory()
+            reporte["memoria"] = {
+                "actual_bytes": actual,
+                "pico_bytes": pico,
+                "principales": [
+                    {"lugar": str(estadistica.traceback), "bytes": estadistica.size,
+                     "bloques": estadistica.count}
+                    for estadistica in tracemalloc.take_snapshot().statistics("lineno")[:30]
+                ],
+            }
+
+        return reporte
+
+    def guardar(self, ruta: str = None):
+        """Guarda el reporte en JSON y, si se perfiló, el perfil en un .prof
+        al lado (se abre con pstats o snakeviz)"""
+        ruta = ruta or os.environ.get("INSTRUMENTACION_SALIDA") or os.path.join(
+            os.path.expanduser("~"),
+            time.strftime("Instrumentacion_%Y%m%d-%H%M%S.json", time.localtime(self.inicio)))
+        reporte = self.reporte()
+
+        if self.perfilador is not None:
+            self.perfilador.disable()
+            reporte["perfil"] = os.path.splitext(ruta)[0] + ".prof"
+            self.perfilador.dump_stats(reporte["perfil"])
+
+        with open(ruta, "w", encoding="utf-8") as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+
+        return ruta
+
+    def mostrar(self):
+        """Imprime los temporizadores y contadores en una tabla"""
+        reporte = self.reporte()
+        print("%-45s %8s %10s %10s %10s" % ("Temporizador", "Llamadas", "Total (s)", "Promedio", "Máximo"))
+        for nombre, t in reporte["temporizadores"].items():
+            print("%-45s %8d %10.4f %10.6f %10.4f" % (
+                nombre, t["llamadas"], t["total"], t["promedio"], t["maximo"]))
+        if reporte["contadores"]:
+            print("\n%-45s %12s" % ("Contador", "Valor"))
+            for nombre, valor in reporte["contadores"].items():
+                print("%-45s %12d" % (nombre, valor))
+
+
+instrumentacion = Instrumentacion(OPCIONES_INSTRUMENTACION)
+
+
+def leerCsv(archivo, columnas: list = None, conversiones: dict = None):
+    """Lee un CSV fila por fila y entrega cada una como diccionario, sin
+    cargar el archivo completo en memoria.
+    @columnas: Las columnas a conservar. Si el archivo no trae alguna, se
+               entrega vacía. Si no se indican, se conservan todas
+    @conversiones: Diccionario de columna a tipo (int, float...) para
+                   convertir los valores no vacíos al momento de leerlos
+    """
+    conversiones = conversiones or {}
+
+    with open(archivo, encoding="utf-8", newline="") as f:
+        lector = csv.reader(f)
+        encabezado = next(lector, [])
+
+        if columnas is None:
+            columnas = encabezado
+
+        # Precalculamos en qué posición está cada columna y cómo convertirla
+        posiciones = [
+            (columna,
+             encabezado.index(columna) if columna in encabezado else None,
+             conversiones.get(columna))
+            for columna in columnas
+        ]
+
+        for fila in lector:
+            if not fila:
+                continue
+
+            registro = {}
+            for columna, posicion, conversion in posiciones:
+                valor = ""
+                if posicion is not None and posicion < len(fila):
+                    valor = fila[posicion]
+                    if conversion is not None and valor != "":
+                        valor = conversion(valor)
+                registro[columna] = valor
+
+            yield registro
 
 
 def csv2dict(file):
     """Tranforma datos crudos CSV a una lista de diccionarios
     tomando como claves la primera columna del CSV"""
-    with open(file, encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        datos = [x for x in reader]
-
-    return datos
+    return list(leerCsv(file))
 
 
 def sinput(texto: str = "",
@@ -163,9 +503,10 @@ def mostrarMenu(entradas: list,
         print(f"{num}) {entrada}")
 
 
+@instrumentacion.medida()
 def obtenerAgencias(archivoAgency):
     agencies = {}
-    datos = csv2dict(archivoAgency)
+    datos = leerCsv(archivoAgency, ["agency_id", "agency_name"])
 
     for agency in datos:
         agency_id = agency["agency_id"]
@@ -178,9 +519,14 @@ def obtenerAgencias(archivoAgency):
     return agencies
 
 
+@instrumentacion.medida()
 def obtenerRutas(archivoRoutes, quitarTexto=False):
     routes = {}
-    datos = csv2dict(archivoRoutes)
+    datos = leerCsv(
+        archivoRoutes,
+        ["agency_id", "route_id", "route_type", "route_short_name",
+         "route_long_name", "route_color", "route_text_color"],
+        {"route_type": int})
 
     for route in datos:
         agency_id = route["agency_id"]
@@ -191,8 +537,6 @@ def obtenerRutas(archivoRoutes, quitarTexto=False):
 
         route["route_long_name"].strip()
 
-        route["route_type"] = int(route["route_type"])
-
         if not routes.get(agency_id):
             routes[agency_id] = {}
 
@@ -209,9 +553,13 @@ def obtenerRutas(archivoRoutes, quitarTexto=False):
     return routes
 
 
+@instrumentacion.medida()
 def obtenerViajes(archivoTrips):
     trips = {}
-    datos = csv2dict(archivoTrips)
+    datos = leerCsv(
+        archivoTrips,
+        ["route_id", "service_id", "trip_id", "trip_headsign",
+         "direction_id", "shape_id"])
 
     for trip in datos:
         route_id = trip["route_id"]
@@ -225,9 +573,13 @@ def obtenerViajes(archivoTrips):
     return trips
 
 
+@instrumentacion.medida()
 def obtenerParadas(archivoStops):
     stops = {}
-    datos = csv2dict(archivoStops)
+    datos = leerCsv(
+        archivoStops,
+        ["stop_id", "stop_name", "stop_lat", "stop_lon"],
+        {"stop_lat": float, "stop_lon": float})
 
     for i, stop in enumerate(datos):
         stop_id = stop["stop_id"]
@@ -241,24 +593,156 @@ def obtenerParadas(archivoStops):
     return stops
 
 
+def horaASegundos(hora: str):
+    """Convierte una hora "HH:MM:SS" a segundos desde el inicio del día de
+    servicio. En GTFS las horas pueden pasar de las 24:00:00"""
+    if not hora:
+        return SIN_HORA
+
+    h, m, s = hora.split(":")
+    return int(h) * 60 * 60 + int(m) * 60 + int(s)
+
+
+def segundosAHora(segundos: int):
+    """Convierte segundos desde el inicio del día de servicio a "HH:MM:SS" """
+    if segundos == SIN_HORA:
+        return ""
+
+    h, resto = divmod(segundos, 60 * 60)
+    m, s = divmod(resto, 60)
+    return f"{h:02d}:{m:02d}:{s:02d}"
+
+
+class HorariosDeParada:
+    """
+    Tabla stop_times guardada por columnas. Los id de viaje y de parada se
+    internan como enteros, y cada columna es un array de enteros. Las filas
+    de un mismo viaje quedan contiguas y ordenadas por stop_sequence, así que
+    un viaje es solo un rango de filas.
+    """
+
+    def __init__(self):
+        # Índice entero -> id de texto, y viceversa
+        self.viajes = []
+        self.indiceViajes = {}
+        self.paradas = []
+        self.indiceParadas = {}
+        # Columnas
+        self.viaje = array("i")
+        self.parada = array("i")
+        self.secuencia = array("i")
+        self.llegada = array("i")
+        self.salida = array("i")
+        # Las filas del viaje i van de inicios[i] a inicios[i + 1]
+        self.inicios = array("i", [0])
+
+    @staticmethod
+    def _internar(valor, lista: list, indice: dict):
+        posicion = indice.get(valor)
+        if posicion is None:
+            posicion = len(lista)
+            indice[valor] = posicion
+            lista.append(valor)
+        return posicion
+
+    def agregar(self, trip_id, stop_id, secuencia: int, llegada: int, salida: int):
+        self.viaje.append(self._internar(trip_id, self.viajes, self.indiceViajes))
+        self.parada.append(self._internar(stop_id, self.paradas, self.indiceParadas))
+        self.secuencia.append(secuencia)
+        self.llegada.append(llegada)
+        self.salida.append(salida)
+
+    def compactar(self):
+        """Ordena las filas por viaje y stop_sequence y calcula los
+        rangos de cada viaje. Se llama una vez terminada la carga"""
+        viaje, secuencia = self.viaje, self.secuencia
+        filas = range(len(viaje))
+        estaOrdenado = all(
+            (viaje[i - 1], secuencia[i - 1]) <= (viaje[i], secuencia[i])
+            for i in range(1, len(viaje)))
+
+        if not estaOrdenado:
+            orden = sorted(filas, key=lambda i: (viaje[i], secuencia[i]))
+            for nombre in ("viaje", "parada", "secuencia", "llegada", "salida"):
+                columna = getattr(self, nombre)
+                setattr(self, nombre, array("i", (columna[i] for i in orden)))
+
+        # Contamos las filas de cada viaje para obtener dónde empieza cada uno
+        conteos = array("i", bytes(4 * len(self.viajes)))
+        for v in self.viaje:
+            conteos[v] += 1
+
+        self.inicios = array("i", [0])
+        for conteo in conteos:
+            self.inicios.append(self.inicios[-1] + conteo)
+
+    def __len__(self):
+        return len(self.viaje)
+
+    def __contains__(self, trip_id):
+        return trip_id in self.indiceViajes
+
+    def __getitem__(self, trip_id):
+        """Devuelve el rango de filas del viaje"""
+        v = self.indiceViajes[trip_id]
+        return range(self.inicios[v], self.inicios[v + 1])
+
+    def get(self, trip_id, predeterminado=None):
+        if trip_id not in self.indiceViajes:
+            return predeterminado
+        return self[trip_id]
+
+    def idParada(self, fila: int):
+        return self.paradas[self.parada[fila]]
+
+    def llegadasDeViaje(self, trip_id):
+        """Las horas de llegada del viaje a cada parada, en orden"""
+        filas = self[trip_id]
+        return self.llegada[filas.start:filas.stop]
+
+    def salidasDeViaje(self, trip_id):
+        """Las horas de salida del viaje de cada parada, en orden"""
+        filas = self[trip_id]
+        return self.salida[filas.start:filas.stop]
+
+    def fila(self, fila: int):
+        return HorarioParada(
+            self.paradas[self.parada[fila]], self.secuencia[fila],
+            self.llegada[fila], self.salida[fila])
+
+
+@instrumentacion.medida()
 def obtenerHorariosDeParada(archivoStopTimes):
-    stimes = {}
-    datos = csv2dict(archivoStopTimes)
+    stimes = HorariosDeParada()
+    datos = leerCsv(
+        archivoStopTimes,
+        ["trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time"],
+        {"stop_sequence": int,
+         "arrival_time": horaASegundos,
+         "departure_time": horaASegundos})
 
     for stop in datos:
-        trip_id = stop["trip_id"]
-
-        if not stimes.get(trip_id):
-            stimes[trip_id] = []
+        llegada = stop["arrival_time"]
+        salida = stop["departure_time"]
+        stimes.agregar(
+            stop["trip_id"], stop["stop_id"], stop["stop_sequence"],
+            SIN_HORA if llegada == "" else llegada,
+            SIN_HORA if salida == "" else salida)
 
-        stimes[trip_id].append(stop)
+    stimes.compactar()
 
     return stimes
 
 
+@instrumentacion.medida()
 def obtenerFrecuencias(archivoFrequencies):
     frequencies = {}
-    datos = csv2dict(archivoFrequencies)
+    datos = leerCsv(
+        archivoFrequencies,
+        ["trip_id", "start_time", "end_time", "headway_secs"],
+        {"start_time": horaASegundos,
+         "end_time": horaASegundos,
+         "headway_secs": int})
 
     for trip in datos:
         trip_id = trip["trip_id"]
@@ -266,163 +750,3152 @@ def obtenerFrecuencias(archivoFrequencies):
         if not frequencies.get(trip_id):
             frequencies[trip_id] = []
 
-        trip["headway_secs"] = int(trip["headway_secs"])
-
         frequencies[trip_id].append(trip)
 
     return frequencies
 
 
-def obtenerHoraDeInicioYDelta(parada, frecuencia):
-    # Truco para obtener el tiempo en enteros en una lista de hora (1), minuto (2) y segundo (3)
-    # Necesitamos los tiempos de inicio y fin para calcular cuántas iteraciones haremos
-    # Dicho de otra forma, cuántas veces cabe la frecuencia en los tiempos de inicio y fin
-    horaIniParadaStr = [
-        int(x) for x in parada["stop_times"]["arrival_time"].split(":")]
-    horaIniStr = [
-        int(x) for x in frecuencia["start_time"].split(":")]
-    horaFinStr = [int(x)
-                  for x in frecuencia["end_time"].split(":")]
-
-    # Convertimos a segundos para el cálculo
-    horaIniParadaInt = (
-        horaIniParadaStr[0] * 60 * 60) + (horaIniParadaStr[1] * 60) + horaIniParadaStr[2]
-    horaIniInt = (
-        horaIniStr[0] * 60 * 60) + (horaIniStr[1] * 60) + horaIniStr[2]
-    horaFinInt = (
-        horaFinStr[0] * 60 * 60) + (horaFinStr[1] * 60) + horaFinStr[2]
-
-    # ¿Cuántas frecuencias se necesitan para llevar a un pasajero?
-    # Ninguna, porque el pasajero se va en coche >:(
-    iteraciones = (
-        horaFinInt - horaIniInt) // frecuencia["headway_secs"]
-    # Creamos una lista de x de deltas del tamaño de la frecuencia,
-    # donde x es la cantidad de veces que cupo la frecuenca
-    minutos = [
-        datetime.timedelta(seconds=float(
-            frecuencia["headway_secs"]))
-        for x in range(iteraciones)
+@instrumentacion.medida()
+def obtenerTransbordos(archivoTransfers):
+    """Las filas de transfers.txt por parada de origen. Es un archivo
+    opcional: si el conjunto no lo trae, no hay transbordos"""
+    transfers = {}
+    if not os.path.exists(archivoTransfers):
+        return transfers
+
+    datos = leerCsv(
+        archivoTransfers,
+        ["from_stop_id", "to_stop_id", "transfer_type", "min_transfer_time"],
+        {"transfer_type": int, "min_transfer_time": int})
+
+    for transfer in datos:
+        from_stop_id = transfer["from_stop_id"]
+
+        if not transfers.get(from_stop_id):
+            transfers[from_stop_id] = []
+
+        transfers[from_stop_id].append(transfer)
+
+    return transfers
+
+
+# Los días de la semana como los escriben los usuarios, 0 es lunes (datetime.weekday)
+DIAS_SEMANA = {
+    "lunes": 0, "martes": 1, "miercoles": 2, "miércoles": 2, "jueves": 3,
+    "viernes": 4, "sabado": 5, "sábado": 5, "domingo": 6,
+    "monday": 0, "tuesday": 1, "wednesday": 2, "thursday": 3,
+    "friday": 4, "saturday": 5, "sunday": 6,
+}
+
+
+def diaDeServicio(valor: str):
+    """Convierte "AAAA-MM-DD" o "AAAAMMDD" a datetime.date, y el nombre de
+    un día de la semana (en español o en inglés) a su número, 0 es lunes"""
+    valor = valor.strip().lower()
+    if valor in DIAS_SEMANA:
+        return DIAS_SEMANA[valor]
+    return datetime.datetime.strptime(valor.replace("-", ""), "%Y%m%d").date()
+
+
+class CalendarioDeServicios:
+    """
+    Los días en que corre cada servicio (service_id), según calendar.txt y
+    calendar_dates.txt. Las fechas se guardan como enteros AAAAMMDD, igual
+    que en GTFS, para compararlas sin convertirlas.
+    """
+
+    def __init__(self):
+        # service_id -> (corre cada día de la semana, fecha de inicio, fecha de fin)
+        self.semanales = {}
+        # fecha -> {service_id: exception_type}. 1 agrega el servicio ese
+        # día y 2 lo quita
+        self.excepciones = {}
+
+    def __len__(self):
+        return len(set(self.semanales) | {
+            s for servicios in self.excepciones.values() for s in servicios})
+
+    def cubre(self, fecha: datetime.date):
+        """Si el calendario dice algo de la fecha"""
+        numero = int(fecha.strftime("%Y%m%d"))
+        return numero in self.excepciones or any(
+            inicio <= numero <= fin for _, inicio, fin in self.semanales.values())
+
+    def serviciosDelDia(self, dia=None):
+        """
+        Los service_id que corren el día.
+        @dia: Una fecha (datetime.date), o un día de la semana (0 es lunes)
+              para no tomar en cuenta la vigencia ni las excepciones. Por
+              defecto, hoy; si el calendario no llega a hoy (p. ej. un
+              conjunto ya vencido), el día de la semana de hoy
+        """
+        if dia is None:
+            dia = datetime.date.today()
+            if not self.cubre(dia):
+                dia = dia.weekday()
+
+        if isinstance(dia, int):
+            return {s for s, (dias, _, _) in self.semanales.items() if dias[dia]}
+
+        fecha = int(dia.strftime("%Y%m%d"))
+        semana = dia.weekday()
+        servicios = {
+            s for s, (dias, inicio, fin) in self.semanales.items()
+            if dias[semana] and inicio <= fecha <= fin
+        }
+        for service_id, tipo in self.excepciones.get(fecha, {}).items():
+            if tipo == 1:
+                servicios.add(service_id)
+            elif tipo == 2:
+                servicios.discard(service_id)
+
+        return servicios
+
+
+@instrumentacion.medida()
+def obtenerCalendario(archivoCalendar, archivoCalendarDates):
+    """Un CalendarioDeServicios. GTFS pide al menos uno de los dos
+    archivos; el que no venga se toma como vacío"""
+    calendario = CalendarioDeServicios()
+    dias = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+    if os.path.exists(archivoCalendar):
+        datos = leerCsv(
+            archivoCalendar,
+            ["service_id", "start_date", "end_date"] + dias,
+            {"start_date": int, "end_date": int})
+
+        for servicio in datos:
+            calendario.semanales[servicio["service_id"]] = (
+                tuple(servicio[dia] == "1" for dia in dias),
+                servicio["start_date"], servicio["end_date"])
+
+    if os.path.exists(archivoCalendarDates):
+        datos = leerCsv(
+            archivoCalendarDates,
+            ["service_id", "date", "exception_type"],
+            {"date": int, "exception_type": int})
+
+        for excepcion in datos:
+            fecha = excepcion["date"]
+
+            if not calendario.excepciones.get(fecha):
+                calendario.excepciones[fecha] = {}
+
+            calendario.excepciones[fecha][excepcion["service_id"]] = excepcion["exception_type"]
+
+    return calendario
+
+
+class TablaDeHorarios:
+    """
+    Horarios de todas las corridas de un viaje en todas sus paradas. Es una
+    matriz de segundos guardada por columnas en un array plano: la columna j
+    (las horas de la parada j) es contigua, y la fila r (una corrida) se
+    obtiene saltando de numCorridas en numCorridas.
+    """
+
+    def __init__(self, matriz: array, numParadas: int, numCorridas: int):
+        self.matriz = matriz
+        self.numParadas = numParadas
+        self.numCorridas = numCorridas
+
+    def deParada(self, parada: int):
+        """Las horas de paso de todas las corridas por la parada"""
+        inicio = parada * self.numCorridas
+        return self.matriz[inicio:inicio + self.numCorridas]
+
+    def deCorrida(self, corrida: int):
+        """Las horas de una corrida en cada una de las paradas"""
+        return self.matriz[corrida::self.numCorridas]
+
+
+def iniciosDeCorridas(frecuencias: list):
+    """La salida de cada corrida desde la primera parada. Cada ventana aporta
+    tantas corridas como veces quepa la frecuencia entre su inicio y su fin"""
+    salidas = array("i")
+    for frecuencia in frecuencias:
+        headway = frecuencia["headway_secs"]
+        iteraciones = (frecuencia["end_time"] - frecuencia["start_time"]) // headway
+        salidas.extend(range(
+            frecuencia["start_time"],
+            frecuencia["start_time"] + headway * iteraciones,
+            headway))
+    return salidas
+
+
+@instrumentacion.medida()
+def expandirFrecuenciasDeViaje(llegadas: array, frecuencias: list,
+                               inicioViaje: int = None):
+    """
+    Expande todas las ventanas de frecuencia de un viaje para todas sus
+    paradas de una vez.
+    @llegadas: Las horas de llegada del viaje a cada parada (stop_times).
+               Pueden ser las de salida para obtener horas de salida
+    @frecuencias: Las filas del viaje en frequencies. Si no tiene, el viaje
+                  es una sola corrida con las horas de stop_times
+    @inicioViaje: La hora de referencia del viaje en stop_times. Por
+                  defecto, la primera de llegadas
+    """
+    if not frecuencias:
+        return TablaDeHorarios(array("i", llegadas), len(llegadas), 1)
+
+    # Lo que tarda el viaje en llegar a cada parada desde su inicio
+    if inicioViaje is None:
+        inicioViaje = llegadas[0]
+    desplazamientos = [
+        SIN_HORA if llegada == SIN_HORA else llegada - inicioViaje
+        for llegada in llegadas
     ]
 
-    # Esto para agregar las deltas a este punto (horaInicio + (delta * iteración))
-    # horaInicioDateTime = datetime.time(horaIniStr[0], horaIniStr[1], horaIniStr[2])
-    horaInicioDateTime = datetime.datetime.strptime(
-        frecuencia["start_time"], "%H:%M:%S")
-    deltaPosicionParada = datetime.timedelta(
-        seconds=float(horaIniParadaInt))
+    salidas = iniciosDeCorridas(frecuencias)
 
-    return horaInicioDateTime, deltaPosicionParada, minutos
+    # Cada columna es el vector de salidas desplazado por lo que tarda en llegar
+    matriz = array("i")
+    for desplazamiento in desplazamientos:
+        if desplazamiento == SIN_HORA:
+            matriz.extend(array("i", [SIN_HORA]) * len(salidas))
+        else:
+            matriz.extend([salida + desplazamiento for salida in salidas])
 
+    return TablaDeHorarios(matriz, len(desplazamientos), len(salidas))
 
-def obtenerTrazos(archivoShapes):
-    """Devuelve los trazos de ruta ordenados en un diccionario por id de
-    trazo (shape_id) y número de secuencia (shape_pt_sequence)"""
-    shapes = {}
-    datos = csv2dict(archivoShapes)
 
-    for trace in datos:
-        shape_id = trace["shape_id"]
+class TableroDeSalidas:
+    """
+    Todas las salidas de todos los viajes y corridas del conjunto, agrupadas
+    por parada y ordenadas por hora. Se guarda en formato CSR: las salidas
+    de la parada p van de inicios[p] a inicios[p + 1] en los arrays salidas
+    (segundos) y viajes (índice del viaje, ver idsViajes).
+    """
+
+    def __init__(self, paradas: list, inicios: array, salidas: array,
+                 viajes: array, idsViajes: list, rutasDeViajes: list,
+                 serviciosDeViajes: list):
+        self.paradas = paradas
+        self.indiceParadas = {stop_id: i for i, stop_id in enumerate(paradas)}
+        self.inicios = inicios
+        self.salidas = salidas
+        self.viajes = viajes
+        self.idsViajes = idsViajes
+        self.rutasDeViajes = rutasDeViajes
+        self.serviciosDeViajes = serviciosDeViajes
+
+    def __len__(self):
+        return len(self.salidas)
+
+    def proximasSalidas(self, stop_id, hora: int, cantidad: int = 10, servicios: set = None):
+        """Las siguientes salidas de la parada a partir de la hora (en
+        segundos), como tuplas (segundos, trip_id, route_id)
+        @servicios: Los service_id que corren ese día (ver
+                    CalendarioDeServicios.serviciosDelDia). Por defecto,
+                    las salidas de todos los servicios"""
+        p = self.indiceParadas.get(stop_id)
+        if p is None:
+            return []
+
+        inicio, fin = self.inicios[p], self.inicios[p + 1]
+        posicion = bisect.bisect_left(self.salidas, hora, inicio, fin)
+
+        salidas = []
+        for i in range(posicion, fin):
+            if len(salidas) == cantidad:
+                break
+            v = self.viajes[i]
+            if servicios is not None and self.serviciosDeViajes[v] not in servicios:
+                continue
+            salidas.append((self.salidas[i], self.idsViajes[v], self.rutasDeViajes[v]))
+
+        return salidas
+
+
+@instrumentacion.medida()
+def construirTableroDeSalidas(stop_times: HorariosDeParada,
+                              frequencies: dict, trips: dict):
+    viajePorId = {
+        trip_id: viaje
+        for viajes in trips.values()
+        for trip_id, viaje in viajes.items()
+    }
+    idsViajes = stop_times.viajes
+    rutasDeViajes = [viajePorId.get(trip_id, {}).get("route_id", "") for trip_id in idsViajes]
+    serviciosDeViajes = [viajePorId.get(trip_id, {}).get("service_id", "") for trip_id in idsViajes]
+    tablas = {}
+
+    # Primera pasada: expandimos cada viaje y contamos cuántas
+    # salidas le tocan a cada parada para reservar su espacio
+    conteos = [0] * len(stop_times.paradas)
+    for trip_id in idsViajes:
+        filas = stop_times[trip_id]
+        tabla = expandirFrecuenciasDeViaje(
+            stop_times.salidasDeViaje(trip_id),
+            frequencies.get(trip_id, []),
+            stop_times.llegada[filas.start])
+        tablas[trip_id] = tabla
+
+        for fila in filas:
+            if stop_times.salida[fila] != SIN_HORA:
+                conteos[stop_times.parada[fila]] += tabla.numCorridas
+
+    inicios = array("i", [0])
+    for conteo in conteos:
+        inicios.append(inicios[-1] + conteo)
+
+    # Segunda pasada: copiamos las columnas de cada viaje al espacio de su parada
+    salidas = array("i", bytes(4 * inicios[-1]))
+    viajes = array("i", bytes(4 * inicios[-1]))
+    cursores = list(inicios[:-1])
+    for v, trip_id in enumerate(idsViajes):
+        tabla = tablas.pop(trip_id)
+
+        for j, fila in enumerate(stop_times[trip_id]):
+            if stop_times.salida[fila] == SIN_HORA:
+                continue
+
+            p = stop_times.parada[fila]
+            c = cursores[p]
+            salidas[c:c + tabla.numCorridas] = tabla.deParada(j)
+            viajes[c:c + tabla.numCorridas] = array("i", [v]) * tabla.numCorridas
+            cursores[p] = c + tabla.numCorridas
+
+    # Ordenamos las salidas de cada parada por hora, una parada a la
+    # vez para no tener en memoria más que una parada como tuplas
+    for p in range(len(conteos)):
+        inicio, fin = inicios[p], inicios[p + 1]
+        if fin - inicio < 2:
+            continue
+
+        pares = sorted(zip(salidas[inicio:fin], viajes[inicio:fin]))
+        salidas[inicio:fin] = array("i", [hora for hora, _ in pares])
+        viajes[inicio:fin] = array("i", [v for _, v in pares])
+
+    return TableroDeSalidas(
+        list(stop_times.paradas), inicios, salidas, viajes,
+        list(idsViajes), rutasDeViajes, serviciosDeViajes)
+
+
+def arraysCsr(listas: list, columnas: int = 1):
+    """Pasa una lista de listas de tuplas a formato CSR: los elementos de
+    la lista i van de inicios[i] a inicios[i + 1] en cada columna"""
+    inicios = array("i", [0])
+    valores = [array("i") for _ in range(columnas)]
+    for lista in listas:
+        for elemento in lista:
+            for columna, valor in zip(valores, elemento):
+                columna.append(valor)
+        inicios.append(len(valores[0]))
+    return inicios, valores
+
+
+class RedRaptor:
+    """
+    La red de transporte preparada para el planificador RAPTOR. Los viajes
+    se agrupan en patrones: mismos route_id, paradas y tiempos entre
+    paradas. Como todas las corridas de un patrón tardan lo mismo, un
+    patrón solo guarda los desplazamientos de llegada y salida de cada
+    parada y la hora de inicio de cada corrida, ordenadas; la primera
+    corrida que pasa por una parada después de cierta hora se encuentra
+    con una búsqueda binaria. Todo está en arrays de enteros en formato
+    CSR (ver TableroDeSalidas).
+
+    Cada patrón es además de un solo service_id, así que para planificar
+    un día basta con saltarse los patrones cuyo servicio no corre ese día.
+    """
+
+    def __init__(self, paradas: list, idsViajes: list, calendario: CalendarioDeServicios = None):
+        self.paradas = paradas
+        self.indiceParadas = {stop_id: i for i, stop_id in enumerate(paradas)}
+        self.idsViajes = idsViajes
+        self.calendario = calendario or CalendarioDeServicios()
+        # Por patrón
+        self.rutasDePatrones = []
+        self.serviciosDePatrones = []
+        self.patronInicios = array("i", [0])
+        self.patronParadas = array("i")
+        self.patronLlegadas = array("i")
+        self.patronSalidas = array("i")
+        self.patronCorridas = array("i", [0])
+        self.corridaInicio = array("i")
+        self.corridaViaje = array("i")
+        # Por parada: los patrones que pasan por ella y en qué posición
+        self.paradaInicios = array("i", [0] * (len(paradas) + 1))
+        self.paradaPatrones = array("i")
+        self.paradaPosiciones = array("i")
+        # Por parada: los transbordos caminando (parada destino, segundos)
+        self.transbordoInicios = array("i", [0] * (len(paradas) + 1))
+        self.transbordoDestinos = array("i")
+        self.transbordoSegundos = array("i")
+
+    def __len__(self):
+        return len(self.rutasDePatrones)
+
+    def agregarPatron(self, route_id, service_id, paradas: list, llegadas: list, salidas: list,
+                      corridas: list):
+        """@corridas: Tuplas (hora de inicio, índice del viaje)"""
+        self.rutasDePatrones.append(route_id)
+        self.serviciosDePatrones.append(service_id)
+        self.patronParadas.extend(paradas)
+        self.patronLlegadas.extend(llegadas)
+        self.patronSalidas.extend(salidas)
+        self.patronInicios.append(len(self.patronParadas))
+        corridas.sort()
+        self.corridaInicio.extend(inicio for inicio, _ in corridas)
+        self.corridaViaje.extend(v for _, v in corridas)
+        self.patronCorridas.append(len(self.corridaInicio))
+
+    def indexarParadas(self):
+        """Arma el índice de parada a patrones. Se llama después de agregar
+        todos los patrones"""
+        porParada = [[] for _ in self.paradas]
+        for patron in range(len(self)):
+            inicio = self.patronInicios[patron]
+            for posicion in range(self.patronInicios[patron + 1] - inicio):
+                porParada[self.patronParadas[inicio + posicion]].append((patron, posicion))
+        self.paradaInicios, (self.paradaPatrones, self.paradaPosiciones) = arraysCsr(porParada, 2)
+
+    def fijarTransbordos(self, transbordos: dict):
+        """@transbordos: Índice de parada -> [(índice de parada destino, segundos)]"""
+        # De la caminata más corta a la más larga, para dejar de revisarlas
+        # en cuanto pasan de la mejor llegada al destino (ver _caminar)
+        self.transbordoInicios, (self.transbordoDestinos, self.transbordoSegundos) = arraysCsr(
+            [sorted(transbordos.get(p, ()), key=lambda x: (x[1], x[0]))
+             for p in range(len(self.paradas))], 2)
+
+    def planificar(self, origenes, destinos, hora: int, maxViajes: int = MAX_VIAJES_RAPTOR,
+                   dia=None):
+        """
+        Los viajes de los orígenes a los destinos saliendo a la hora dada
+        (segundos), óptimos en Pareto entre hora de llegada y número de
+        vehículos: uno por cada número de vehículos que llega antes que con
+        menos vehículos. Cada viaje es un diccionario con sus tramos.
+        @origenes, destinos: Un stop_id o un iterable de ellos (en una red
+                             combinada, tuplas (nombre del conjunto, stop_id))
+        @dia: Solo se usan los viajes cuyo servicio corre ese día. Ver
+              CalendarioDeServicios.serviciosDelDia
+        """
+        origenes = [self.indiceParadas[s] for s in self._paradas(origenes) if s in self.indiceParadas]
+        destinos = {self.indiceParadas[s] for s in self._paradas(destinos) if s in self.indiceParadas}
+        if not origenes or not destinos:
+            return []
+
+        # Sin calendario (p. ej. una red armada sin calendar.txt) corren todos
+        if self.calendario.semanales or self.calendario.excepciones:
+            servicios = self.calendario.serviciosDelDia(dia)
+            activos = [servicio in servicios for servicio in self.serviciosDePatrones]
+        else:
+            activos = [True] * len(self)
+
+        # Un entero y no math.inf: comparar enteros con flotantes es más lento
+        INF = SIN_LLEGADA_RAPTOR
+        n = len(self.paradas)
+        patronInicios, patronParadas = self.patronInicios, self.patronParadas
+        patronLlegadas, patronSalidas = self.patronLlegadas, self.patronSalidas
+        patronCorridas, corridaInicio = self.patronCorridas, self.corridaInicio
+        paradaInicios, paradaPatrones, paradaPosiciones = (
+            self.paradaInicios, self.paradaPatrones, self.paradaPosiciones)
+
+        # mejor: la mejor llegada a cada parada en cualquier ronda. En cada
+        # ronda, llegada es la hora a la que se llega a la parada y listo, a
+        # la que ya se puede abordar ahí (con el tiempo de transbordo)
+        mejor = [INF] * n
+        llegada = [INF] * n
+        listo = [INF] * n
+        etiquetas = {}
+        for o in origenes:
+            llegada[o] = listo[o] = mejor[o] = hora
+            etiquetas[o] = ("origen",)
+        marcadas = set(origenes)
+        limite = min(mejor[d] for d in destinos)
+        limite = self._caminar(marcadas, llegada, listo, mejor, etiquetas, destinos, limite, 0)
+        rondas = [etiquetas]
+
+        resultados = []
+        if limite < INF:
+            resultados.append(self._itinerario(rondas, 0, min(destinos, key=llegada.__getitem__), hora))
+
+        for k in range(1, maxViajes + 1):
+            # Cada patrón que corre ese día se recorre una vez, desde la
+            # primera parada marcada
+            cola = {}
+            for s in marcadas:
+                for j in range(paradaInicios[s], paradaInicios[s + 1]):
+                    patron, posicion = paradaPatrones[j], paradaPosiciones[j]
+                    if posicion < cola.get(patron, n) and activos[patron]:
+                        cola[patron] = posicion
+
+            listoAnterior = listo
+            llegada, listo = list(llegada), list(listo)
+            marcadasAnteriores = marcadas
+            etiquetas = {}
+            marcadas = set()
+
+            for patron, posicion in cola.items():
+                c0, c1 = patronCorridas[patron], patronCorridas[patron + 1]
+                corrida = -1
+                abordaje = -1
+                for i in range(patronInicios[patron] + posicion, patronInicios[patron + 1]):
+                    s = patronParadas[i]
+                    if corrida >= 0:
+                        t = corridaInicio[corrida] + patronLlegadas[i]
+                        if t < mejor[s] and t < limite:
+                            llegada[s] = mejor[s] = t
+                            listo[s] = t + SEG_MIN_TRANSBORDO
+                            etiquetas[s] = ("viaje", patron, corrida, abordaje, i)
+                            marcadas.add(s)
+                            if s in destinos:
+                                limite = t
+
+                    # ¿Se alcanza aquí una corrida que pase antes? Solo en
+                    # las paradas que mejoraron en la ronda anterior: desde
+                    # las demás, lo que se alcanza ya se probó en otra ronda
+                    if s not in marcadasAnteriores:
+                        continue
+                    t = listoAnterior[s]
+                    if corrida < 0 or t <= corridaInicio[corrida] + patronSalidas[i]:
+                        r = bisect.bisect_left(corridaInicio, t - patronSalidas[i], c0, c1)
+                        if r < c1 and (corrida < 0 or r < corrida):
+                            corrida = r
+                            abordaje = i
+
+            limite = self._caminar(marcadas, llegada, listo, mejor, etiquetas, destinos, limite,
+                                   SEG_MIN_TRANSBORDO)
+            rondas.append(etiquetas)
+
+            destino = min(destinos, key=llegada.__getitem__)
+            if destino in etiquetas and (not resultados or llegada[destino] < resultados[-1]["llegada"]):
+                resultados.append(self._itinerario(rondas, k, destino, hora))
+
+            if not marcadas:
+                break
+
+        return resultados
+
+    def _paradas(self, paradas):
+        """Una parada suelta como lista; un iterable de paradas, tal cual"""
+        # En una red combinada cada parada es una tupla (conjunto, stop_id),
+        # así que una tupla es una sola parada si es una de la red
+        if isinstance(paradas, str) or (isinstance(paradas, tuple) and paradas in self.indiceParadas):
+            return [paradas]
+        return paradas
+
+    def _caminar(self, marcadas: set, llegada: list, listo: list, mejor: list,
+                 etiquetas: dict, destinos: set, limite: float, margen: int):
+        """Los transbordos caminando desde las paradas marcadas en la ronda.
+        Agrega las paradas que mejoran a marcadas y devuelve el nuevo límite.
+        @margen: Lo mínimo entre bajar de un vehículo y subir al siguiente,
+                 aunque la caminata sea más corta (p. ej. la misma parada en
+                 dos conjuntos)"""
+        inicios, destinosTransbordo, segundos = (
+            self.transbordoInicios, self.transbordoDestinos, self.transbordoSegundos)
+        nuevas = set()
+        for s in marcadas:
+            salida = llegada[s]
+            for j in range(inicios[s], inicios[s + 1]):
+                t = salida + segundos[j]
+                # Van de la más corta a la más larga
+                if t >= limite:
+                    break
+                q = destinosTransbordo[j]
+                if t < mejor[q]:
+                    llegada[q] = mejor[q] = t
+                    listo[q] = max(t, llegada[s] + margen)
+                    etiquetas[q] = ("caminata", s, segundos[j])
+                    nuevas.add(q)
+                    if q in destinos:
+                        limite = t
+        marcadas |= nuevas
+        return limite
+
+    def _itinerario(self, rondas: list, k: int, s: int, hora: int):
+        """Reconstruye el viaje que llega a la parada s en la ronda k"""
+        tramos = []
+        vehiculos = 0
+
+        while True:
+            # La etiqueta vigente es la de la última ronda que mejoró la parada
+            while s not in rondas[k]:
+                k -= 1
+            etiqueta = rondas[k][s]
+
+            if etiqueta[0] == "origen":
+                break
+            elif etiqueta[0] == "caminata":
+                _, desde, segundos = etiqueta
+                tramos.append({
+                    "tipo": "caminata",
+                    "desde": self.paradas[desde],
+                    "hasta": self.paradas[s],
+                    "segundos": segundos,
+                })
+                s = desde
+            else:
+                _, patron, corrida, abordaje, bajada = etiqueta
+                inicio = self.corridaInicio[corrida]
+                tramos.append({
+                    "tipo": "viaje",
+                    "route_id": self.rutasDePatrones[patron],
+                    "trip_id": self.idsViajes[self.corridaViaje[corrida]],
+                    "desde": self.paradas[self.patronParadas[abordaje]],
+                    "hasta": self.paradas[self.patronParadas[bajada]],
+                    "salida": inicio + self.patronSalidas[abordaje],
+                    "llegada": inicio + self.patronLlegadas[bajada],
+                    "paradas": bajada - abordaje,
+                })
+                vehiculos += 1
+                s = self.patronParadas[abordaje]
+                k -= 1
+
+        tramos.reverse()
+        # Si termina caminando, la llegada es la del último tramo más la caminata
+        llegada = hora
+        for tramo in tramos:
+            llegada = tramo["llegada"] if tramo["tipo"] == "viaje" else llegada + tramo["segundos"]
+
+        return {
+            "salida": hora,
+            "llegada": llegada,
+            "vehiculos": vehiculos,
+            "transbordos": max(vehiculos - 1, 0),
+            "tramos": tramos,
+        }
+
+
+def desplazamientosDeViaje(horas: array, inicio: int):
+    """Las horas del viaje relativas a su inicio. Las que faltan (SIN_HORA)
+    toman la de la parada anterior"""
+    desplazamientos = []
+    anterior = 0
+    for hora in horas:
+        if hora != SIN_HORA:
+            anterior = hora - inicio
+        desplazamientos.append(anterior)
+    return desplazamientos
+
+
+@instrumentacion.medida()
+def construirRedRaptor(stop_times: HorariosDeParada, frequencies: dict,
+                       trips: dict, transfers: dict, caminatas=(),
+                       calendar: CalendarioDeServicios = None):
+    """
+    @caminatas: Tuplas (from_stop_id, to_stop_id, segundos) de las
+                caminatas entre paradas cercanas (ver GrafoDeCaminatas).
+                Donde transfers.txt dice otra cosa, manda transfers.txt
+    @calendar: Los días en que corre cada service_id de trips
+    """
+    viajePorId = {
+        trip_id: viaje
+        for viajes in trips.values()
+        for trip_id, viaje in viajes.items()
+    }
+    idsViajes = list(stop_times.viajes)
+    red = RedRaptor(list(stop_times.paradas), idsViajes, calendar)
+
+    # (route_id, service_id, paradas, llegadas, salidas) -> [(inicio de la corrida, viaje)]
+    patrones = {}
+    for v, trip_id in enumerate(idsViajes):
+        filas = stop_times[trip_id]
+        if len(filas) < 2:
+            continue
+        inicio = stop_times.llegada[filas.start]
+        if inicio == SIN_HORA:
+            inicio = stop_times.salida[filas.start]
+        if inicio == SIN_HORA:
+            continue
+
+        llegadas = desplazamientosDeViaje(stop_times.llegadasDeViaje(trip_id), inicio)
+        salidas = desplazamientosDeViaje(stop_times.salidasDeViaje(trip_id), inicio)
+        viaje = viajePorId.get(trip_id, {})
+        clave = (viaje.get("route_id", ""), viaje.get("service_id", ""),
+                 tuple(stop_times.parada[filas.start:filas.stop]),
+                 tuple(llegadas), tuple(salidas))
+
+        inicios = iniciosDeCorridas(frequencies.get(trip_id, [])) or [inicio]
+        patrones.setdefault(clave, []).extend((i, v) for i in inicios)
+
+    for (route_id, service_id, paradas, llegadas, salidas), corridas in patrones.items():
+        red.agregarPatron(route_id, service_id, paradas, llegadas, salidas, corridas)
+    red.indexarParadas()
+
+    # (desde, hasta) -> segundos
+    segundos = {}
+    for from_stop_id, to_stop_id, s in caminatas:
+        desde = red.indiceParadas.get(from_stop_id)
+        hasta = red.indiceParadas.get(to_stop_id)
+        if desde is not None and hasta is not None and desde != hasta:
+            segundos[desde, hasta] = s
+
+    # transfer_type 3: no se puede transbordar entre esas paradas
+    for from_stop_id, filas in transfers.items():
+        desde = red.indiceParadas.get(from_stop_id)
+        for transfer in filas:
+            hasta = red.indiceParadas.get(transfer["to_stop_id"])
+            if desde is None or hasta is None or desde == hasta:
+                continue
+            if transfer["transfer_type"] == 3:
+                segundos.pop((desde, hasta), None)
+            else:
+                segundos[desde, hasta] = transfer["min_transfer_time"] or 0
+
+    transbordos = {}
+    for (desde, hasta), s in segundos.items():
+        transbordos.setdefault(desde, []).append((hasta, s))
+    red.fijarTransbordos(transbordos)
+
+    return red
+
+
+def combinarRedesRaptor(redes: dict, caminatas=()):
+    """
+    Une las redes de varios conjuntos en una sola para planificar viajes
+    entre ellos. Las paradas, los viajes, las rutas y los servicios de la
+    red combinada son tuplas (nombre del conjunto, id).
+    @redes: Nombre del conjunto -> RedRaptor
+    @caminatas: Tuplas (parada, parada, segundos) entre paradas de
+                distintos conjuntos, con las paradas como tuplas
+    """
+    paradas = [(nombre, p) for nombre, red in redes.items() for p in red.paradas]
+    idsViajes = [(nombre, v) for nombre, red in redes.items() for v in red.idsViajes]
+    calendario = CalendarioDeServicios()
+    for nombre, red in redes.items():
+        calendario.semanales.update(
+            ((nombre, s), semanal) for s, semanal in red.calendario.semanales.items())
+        for fecha, excepciones in red.calendario.excepciones.items():
+            calendario.excepciones.setdefault(fecha, {}).update(
+                ((nombre, s), tipo) for s, tipo in excepciones.items())
+    combinada = RedRaptor(paradas, idsViajes, calendario)
+    transbordos = {}
+    desplazamientoParadas = 0
+    desplazamientoViajes = 0
+
+    for nombre, red in redes.items():
+        for patron in range(len(red)):
+            a, b = red.patronInicios[patron], red.patronInicios[patron + 1]
+            c0, c1 = red.patronCorridas[patron], red.patronCorridas[patron + 1]
+            combinada.agregarPatron(
+                (nombre, red.rutasDePatrones[patron]),
+                (nombre, red.serviciosDePatrones[patron]),
+                [p + desplazamientoParadas for p in red.patronParadas[a:b]],
+                red.patronLlegadas[a:b], red.patronSalidas[a:b],
+                [(inicio, v + desplazamientoViajes) for inicio, v in
+                 zip(red.corridaInicio[c0:c1], red.corridaViaje[c0:c1])])
+
+        for p in range(len(red.paradas)):
+            for j in range(red.transbordoInicios[p], red.transbordoInicios[p + 1]):
+                transbordos.setdefault(p + desplazamientoParadas, []).append(
+                    (red.transbordoDestinos[j] + desplazamientoParadas, red.transbordoSegundos[j]))
+
+        desplazamientoParadas += len(red.paradas)
+        desplazamientoViajes += len(red.idsViajes)
+
+    for desde, hasta, segundos in caminatas:
+        if desde[0] in redes and hasta[0] in redes and desde[0] != hasta[0]:
+            i, j = combinada.indiceParadas.get(desde), combinada.indiceParadas.get(hasta)
+            if i is not None and j is not None:
+                transbordos.setdefault(i, []).append((j, segundos))
+
+    combinada.indexarParadas()
+    combinada.fijarTransbordos(transbordos)
+    return combinada
+
+
+# Redes combinadas ya construidas, por conjuntos incluidos
+redesCombinadas = {}
+
+
+def redRaptorCombinada(rutasConjuntos: list):
+    """La red de varios conjuntos, con las caminatas entre ellos"""
+    clave = tuple(os.path.abspath(r) for r in rutasConjuntos)
+    if clave not in redesCombinadas:
+        redes = {
+            os.path.basename(os.path.normpath(ruta)): cargarTablaGtfs(ruta, "raptor")
+            for ruta in rutasConjuntos
+        }
+        redesCombinadas[clave] = combinarRedesRaptor(
+            redes, cargarGrafoDeCaminatas(rutasConjuntos).aristas())
+    return redesCombinadas[clave]
+
 
-        if not shapes.get(shape_id):
-            shapes[shape_id] = {}
+def planificarViaje(origenes, destinos, hora: int, maxViajes: int = MAX_VIAJES_RAPTOR, dia=None):
+    """Planifica en el conjunto seleccionado. Ver RedRaptor.planificar"""
+    return conjuntoGtfs.raptor.planificar(origenes, destinos, hora, maxViajes, dia)
 
-        pt_seq = int(trace.pop("shape_pt_sequence"))
-        shapes[shape_id][pt_seq] = trace
+
+def simplificarPuntos(lat, lon, tolerancia: float):
+    """
+    Douglas-Peucker: los índices de los puntos que hay que conservar para
+    que la línea no se aleje más de la tolerancia (en metros) de la
+    original. Las coordenadas se proyectan a metros alrededor del primer
+    punto, que a la escala de una ruta urbana es suficiente.
+    """
+    n = len(lat)
+    if n < 3:
+        return list(range(n))
+
+    escalaLon = math.cos(math.radians(lat[0]))
+    x = [(valor - lon[0]) * escalaLon * METROS_POR_GRADO for valor in lon]
+    y = [(valor - lat[0]) * METROS_POR_GRADO for valor in lat]
+    conservar = bytearray(n)
+    conservar[0] = conservar[-1] = 1
+    tolerancia2 = tolerancia * tolerancia
+
+    # Con una pila en lugar de recursión, para los trazos de miles de puntos
+    pendientes = [(0, n - 1)]
+    while pendientes:
+        a, b = pendientes.pop()
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        largo2 = dx * dx + dy * dy
+        peor, peorDistancia2 = None, tolerancia2
+
+        for i in range(a + 1, b):
+            px, py = x[i] - x[a], y[i] - y[a]
+            if largo2 == 0:
+                distancia2 = px * px + py * py
+            else:
+                t = min(max((px * dx + py * dy) / largo2, 0), 1)
+                ex, ey = px - t * dx, py - t * dy
+                distancia2 = ex * ex + ey * ey
+            if distancia2 > peorDistancia2:
+                peor, peorDistancia2 = i, distancia2
+
+        if peor is not None:
+            conservar[peor] = 1
+            pendientes.append((a, peor))
+            pendientes.append((peor, b))
+
+    return [i for i in range(n) if conservar[i]]
+
+
+class TrazosDeRuta:
+    """
+    Tabla shapes guardada por columnas, igual que HorariosDeParada: los
+    puntos de cada trazo quedan contiguos y ordenados por
+    shape_pt_sequence en arrays de coordenadas, junto con la distancia en
+    metros recorrida desde el inicio del trazo hasta cada punto.
+
+    Si los trazos se simplificaron, la distancia de cada punto que quedó
+    sigue siendo la del trazo original.
+    """
+
+    def __init__(self):
+        self.trazos = []
+        self.indiceTrazos = {}
+        # Columnas
+        self.lat = array("d")
+        self.lon = array("d")
+        self.distancia = array("d")
+        # Los puntos del trazo i van de inicios[i] a inicios[i + 1]
+        self.inicios = array("i", [0])
+        self.tolerancia = None
+        # Solo se usan durante la carga
+        self._trazo = array("i")
+        self._secuencia = array("i")
+
+    def agregar(self, shape_id, lat: float, lon: float, secuencia: int):
+        self._trazo.append(HorariosDeParada._internar(shape_id, self.trazos, self.indiceTrazos))
+        self._secuencia.append(secuencia)
+        self.lat.append(lat)
+        self.lon.append(lon)
+
+    def compactar(self, tolerancia: float = None):
+        """Ordena los puntos por trazo y secuencia, calcula las distancias
+        y, si hay tolerancia, simplifica cada trazo. Se llama una vez
+        terminada la carga"""
+        trazo, secuencia = self._trazo, self._secuencia
+        orden = sorted(range(len(trazo)), key=lambda i: (trazo[i], secuencia[i]))
+        conteos = array("i", bytes(4 * len(self.trazos)))
+        for t in trazo:
+            conteos[t] += 1
+
+        lat, lon = self.lat, self.lon
+        self.lat, self.lon, self.distancia = array("d"), array("d"), array("d")
+        self.inicios = array("i", [0])
+        self.tolerancia = tolerancia
+        inicio = 0
+
+        for conteo in conteos:
+            puntos = orden[inicio:inicio + conteo]
+            inicio += conteo
+            latTrazo = [lat[i] for i in puntos]
+            lonTrazo = [lon[i] for i in puntos]
+
+            distancias = [0.0]
+            for i in range(1, len(puntos)):
+                distancias.append(distancias[-1] + distanciaMetros(
+                    latTrazo[i - 1], lonTrazo[i - 1], latTrazo[i], lonTrazo[i]))
+
+            conservados = (simplificarPuntos(latTrazo, lonTrazo, tolerancia)
+                           if tolerancia else range(len(puntos)))
+            for i in conservados:
+                self.lat.append(latTrazo[i])
+                self.lon.append(lonTrazo[i])
+                self.distancia.append(distancias[i])
+            self.inicios.append(len(self.lat))
+
+        self._trazo = array("i")
+        self._secuencia = array("i")
+
+    def __len__(self):
+        return len(self.trazos)
+
+    def __iter__(self):
+        return iter(self.trazos)
+
+    def __contains__(self, shape_id):
+        return shape_id in self.indiceTrazos
+
+    def __getitem__(self, shape_id):
+        """Devuelve el rango de puntos del trazo"""
+        t = self.indiceTrazos[shape_id]
+        return range(self.inicios[t], self.inicios[t + 1])
+
+    def get(self, shape_id, predeterminado=None):
+        if shape_id not in self.indiceTrazos:
+            return predeterminado
+        return self[shape_id]
+
+    def puntos(self, shape_id):
+        """Las coordenadas (lat, lon) del trazo, en orden"""
+        filas = self[shape_id]
+        return list(zip(self.lat[filas.start:filas.stop], self.lon[filas.start:filas.stop]))
+
+    def distancias(self, shape_id):
+        """Los metros recorridos hasta cada punto del trazo"""
+        filas = self[shape_id]
+        return self.distancia[filas.start:filas.stop]
+
+    def longitud(self, shape_id):
+        filas = self[shape_id]
+        return self.distancia[filas.stop - 1] if filas else 0.0
+
+    def tamEnBytes(self):
+        """Lo que ocupan las columnas, sin contar los id de los trazos"""
+        return sum(
+            columna.itemsize * len(columna)
+            for columna in (self.lat, self.lon, self.distancia, self.inicios))
+
+
+@instrumentacion.medida()
+def obtenerTrazos(archivoShapes, tolerancia: float = None):
+    """
+    Devuelve los trazos de ruta (un TrazosDeRuta), ordenados por
+    shape_pt_sequence.
+    @tolerancia: Metros para simplificarlos. Por defecto TOLERANCIA_TRAZOS_METROS
+    """
+    shapes = TrazosDeRuta()
+    datos = leerCsv(
+        archivoShapes,
+        ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"],
+        {"shape_pt_lat": float, "shape_pt_lon": float, "shape_pt_sequence": int})
+
+    for trace in datos:
+        shapes.agregar(
+            trace["shape_id"], trace["shape_pt_lat"], trace["shape_pt_lon"],
+            trace["shape_pt_sequence"])
+
+    shapes.compactar(TOLERANCIA_TRAZOS_METROS if tolerancia is None else tolerancia)
 
     return shapes
 
 
+class ProyectorDeTrazo:
+    """
+    Proyecta puntos sobre la línea de un trazo. Los segmentos se pasan a
+    metros alrededor del primer punto una sola vez y se reparten en una
+    cuadrícula de celdas del tamaño del radio de búsqueda, así que
+    proyectar una parada solo revisa los segmentos de su celda.
+    """
+
+    def __init__(self, shapes: TrazosDeRuta, shape_id, radio: float):
+        filas = shapes[shape_id]
+        lat = shapes.lat[filas.start:filas.stop]
+        lon = shapes.lon[filas.start:filas.stop]
+        acumulada = shapes.distancia[filas.start:filas.stop]
+        self.lat0, self.lon0 = lat[0], lon[0]
+        self.escalaLon = math.cos(math.radians(self.lat0)) * METROS_POR_GRADO
+        x = [(valor - self.lon0) * self.escalaLon for valor in lon]
+        y = [(valor - self.lat0) * METROS_POR_GRADO for valor in lat]
+
+        # Un trazo de un solo punto es un segmento de largo cero
+        if len(x) == 1:
+            x, y, acumulada = x * 2, y * 2, acumulada * 2
+        self.x, self.y = x[:-1], y[:-1]
+        self.dx = [b - a for a, b in zip(x, x[1:])]
+        self.dy = [b - a for a, b in zip(y, y[1:])]
+        self.largo2 = [dx * dx + dy * dy for dx, dy in zip(self.dx, self.dy)]
+        self.acumulada = acumulada[:-1]
+        # El largo de cada segmento según el trazo original (con la
+        # simplificación, un segmento puede cubrir varios del original)
+        self.largo = [b - a for a, b in zip(acumulada, acumulada[1:])]
+
+        # Cada segmento va en todas las celdas que toca su caja ampliada por
+        # el radio: todo segmento a menos del radio de un punto está en la
+        # celda del punto
+        self.radio = radio
+        self.celdas = {}
+        for i, (x1, y1, dx, dy) in enumerate(zip(self.x, self.y, self.dx, self.dy)):
+            x2, y2 = x1 + dx, y1 + dy
+            for cx in range(math.floor((min(x1, x2) - radio) / radio),
+                            math.floor((max(x1, x2) + radio) / radio) + 1):
+                for cy in range(math.floor((min(y1, y2) - radio) / radio),
+                                math.floor((max(y1, y2) + radio) / radio) + 1):
+                    self.celdas.setdefault((cx, cy), []).append(i)
+
+    def proyectar(self, px: float, py: float, segmentos):
+        """(índice, fracción del segmento, distancia²) del punto a cada segmento"""
+        x, y, dx, dy, largo2 = self.x, self.y, self.dx, self.dy, self.largo2
+        resultado = []
+        for i in segmentos:
+            ex, ey = px - x[i], py - y[i]
+            t = min(max((ex * dx[i] + ey * dy[i]) / largo2[i], 0.0), 1.0) if largo2[i] else 0.0
+            ex -= t * dx[i]
+            ey -= t * dy[i]
+            resultado.append((i, t, ex * ex + ey * ey))
+        return resultado
+
+    def candidatos(self, lat: float, lon: float, maximo: int = 6):
+        """
+        Las posiciones del trazo donde puede estar el punto, como tuplas
+        (metros desde el inicio del trazo, metros al trazo). Son los mínimos
+        locales de la distancia a lo largo del trazo que quedan dentro del
+        radio, o el más cercano si ninguno lo está. Un trazo que pasa dos
+        veces por el mismo lugar da un candidato por cada pasada.
+        """
+        px = (lon - self.lon0) * self.escalaLon
+        py = (lat - self.lat0) * METROS_POR_GRADO
+        celda = (math.floor(px / self.radio), math.floor(py / self.radio))
+        radio2 = self.radio * self.radio
+
+        cercanos = [c for c in self.proyectar(px, py, self.celdas.get(celda, ())) if c[2] <= radio2]
+        if cercanos:
+            # Los segmentos vecinos que no están en la lista quedan fuera del
+            # radio, así que cuentan como más lejanos
+            d2 = {i: d for i, _, d in cercanos}
+            minimos = [
+                c for c in cercanos
+                if c[2] <= d2.get(c[0] - 1, math.inf) and c[2] < d2.get(c[0] + 1, math.inf)
+            ]
+            if len(minimos) > maximo:
+                minimos = sorted(minimos, key=lambda c: c[2])[:maximo]
+        else:
+            minimos = [min(self.proyectar(px, py, range(len(self.x))), key=lambda c: c[2])]
+
+        return [
+            (self.acumulada[i] + t * self.largo[i], math.sqrt(d))
+            for i, t, d in minimos
+        ]
+
+
+def elegirCandidatosEnOrden(candidatosPorParada: list, holgura: float = 1.0):
+    """
+    Elige un candidato por parada de modo que las distancias a lo largo del
+    trazo no retrocedan y la suma de las distancias al trazo sea mínima
+    (programación dinámica sobre los candidatos). Si no hay forma de
+    avanzar siempre, se permite retroceder con una penalización.
+    Las paradas sin candidatos quedan en None.
+    """
+    PENALIZACION = 1e6
+    # Por parada: [(costo acumulado, candidato anterior)] alineado con sus candidatos
+    costos = []
+    anterior = None
+
+    for k, candidatos in enumerate(candidatosPorParada):
+        if not candidatos:
+            costos.append(None)
+            continue
+
+        fila = []
+        for s, d in candidatos:
+            if anterior is None:
+                fila.append((d, None))
+                continue
+            mejor = None
+            for j, (s2, _) in enumerate(candidatosPorParada[anterior]):
+                costo = costos[anterior][j][0] + d + (0 if s2 <= s + holgura else PENALIZACION)
+                if mejor is None or costo < mejor[0]:
+                    mejor = (costo, j)
+            fila.append(mejor)
+        costos.append(fila)
+        anterior = k
+
+    elegidos = [None] * len(candidatosPorParada)
+    if anterior is None:
+        return elegidos
+
+    j = min(range(len(costos[anterior])), key=lambda i: costos[anterior][i][0])
+    for k in range(anterior, -1, -1):
+        if costos[k] is None:
+            continue
+        elegidos[k] = candidatosPorParada[k][j]
+        j = costos[k][j][1]
+
+    return elegidos
+
+
+class DistanciasDeParadas:
+    """
+    Dónde queda cada parada a lo largo del trazo de su viaje. Son dos
+    columnas alineadas con las filas de HorariosDeParada: shape_dist_traveled
+    (metros desde el inicio del trazo) y el desvío (metros de la parada a la
+    línea del trazo). Los viajes sin trazo, o las paradas sin coordenadas,
+    quedan en NaN.
+    """
+
+    def __init__(self, stop_times: HorariosDeParada):
+        nan = array("d", [math.nan])
+        self.distancia = nan * len(stop_times)
+        self.desvio = nan * len(stop_times)
+        self.indiceViajes = dict(stop_times.indiceViajes)
+        self.inicios = array("i", stop_times.inicios)
+        # (trip_id, stop_id, stop_sequence, desvío) de las paradas alejadas de su trazo
+        self.lejanas = []
+        self.viajesSinTrazo = 0
+
+    def filas(self, trip_id):
+        v = self.indiceViajes[trip_id]
+        return range(self.inicios[v], self.inicios[v + 1])
+
+    def __contains__(self, trip_id):
+        return trip_id in self.indiceViajes
+
+    def deViaje(self, trip_id):
+        """shape_dist_traveled de cada parada del viaje, en orden"""
+        filas = self.filas(trip_id)
+        return self.distancia[filas.start:filas.stop]
+
+    def desviosDeViaje(self, trip_id):
+        filas = self.filas(trip_id)
+        return self.desvio[filas.start:filas.stop]
+
+    def entreParadas(self, trip_id):
+        """Los metros sobre el trazo entre cada parada y la siguiente"""
+        distancias = self.deViaje(trip_id)
+        return [b - a for a, b in zip(distancias, distancias[1:])]
+
+
+@instrumentacion.medida()
+def construirDistanciasDeParadas(stop_times: HorariosDeParada, shapes: TrazosDeRuta,
+                                 trips: dict, stops: dict,
+                                 umbral: float = DIST_MAX_PARADA_TRAZO_METROS):
+    """
+    Proyecta las paradas de todos los viajes sobre sus trazos. Los viajes
+    se agrupan por trazo y por secuencia de paradas, así que cada parada
+    se proyecta una sola vez por trazo y cada secuencia se resuelve una
+    sola vez aunque la compartan muchos viajes.
+    """
+    distancias = DistanciasDeParadas(stop_times)
+
+    # shape_id -> {secuencia de paradas (internadas): [trip_id, ...]}
+    patrones = {}
+    for viajes in trips.values():
+        for trip_id, viaje in viajes.items():
+            if trip_id not in stop_times:
+                continue
+            if viaje.get("shape_id") not in shapes:
+                distancias.viajesSinTrazo += 1
+                continue
+            filas = stop_times[trip_id]
+            secuencia = tuple(stop_times.parada[filas.start:filas.stop])
+            patrones.setdefault(viaje["shape_id"], {}).setdefault(secuencia, []).append(trip_id)
+
+    # Con el radio holgado, la programación dinámica puede escoger la pasada
+    # correcta de un trazo que vuelve por la misma calle
+    radio = 4 * umbral
+    for shape_id, porSecuencia in patrones.items():
+        proyector = ProyectorDeTrazo(shapes, shape_id, radio)
+        candidatos = {}
+
+        for secuencia, viajes in porSecuencia.items():
+            for p in secuencia:
+                if p not in candidatos:
+                    parada = stops.get(stop_times.paradas[p])
+                    candidatos[p] = proyector.candidatos(
+                        parada["stop_lat"], parada["stop_lon"]) if parada else []
+
+            elegidos = elegirCandidatosEnOrden([candidatos[p] for p in secuencia])
+
+            for trip_id in viajes:
+                for fila, elegido in zip(stop_times[trip_id], elegidos):
+                    if elegido is None:
+                        continue
+                    distancias.distancia[fila], distancias.desvio[fila] = elegido
+
+            # Las paradas lejanas se anotan una vez por secuencia, con su primer viaje
+            for fila, elegido in zip(stop_times[viajes[0]], elegidos):
+                if elegido is not None and elegido[1] > umbral:
+                    horario = stop_times.fila(fila)
+                    distancias.lejanas.append(
+                        (viajes[0], horario.stop_id, horario.stop_sequence, round(elegido[1], 1)))
+
+    return distancias
+
+
+# Tablas que componen un conjunto GTFS y los archivos de los que dependen.
+# Si cambia cualquiera de esos archivos, la instantánea de la tabla se reconstruye
+TABLAS_GTFS = {
+    "agency": ["agency.txt"],
+    "routes": ["routes.txt"],
+    "trips": ["trips.txt"],
+    "frequencies": ["frequencies.txt"],
+    "shapes": ["shapes.txt"],
+    "stops": ["stops.txt"],
+    "stop_times": ["stop_times.txt"],
+    "transfers": ["transfers.txt"],
+    "calendar": ["calendar.txt", "calendar_dates.txt"],
+}
+# Índices que se calculan a partir de las tablas. También se guardan en
+# instantáneas, pero solo se construyen cuando se piden
+TABLAS_DERIVADAS_GTFS = {
+    "departures": ["stop_times.txt", "frequencies.txt", "trips.txt"],
+    "raptor": ["stop_times.txt", "frequencies.txt", "trips.txt", "transfers.txt", "stops.txt",
+               "calendar.txt", "calendar_dates.txt"],
+    "distances": ["stop_times.txt", "shapes.txt", "trips.txt", "stops.txt"],
+}
+
+
+def archivosDeTabla(tabla: str):
+    if tabla in TABLAS_GTFS:
+        return TABLAS_GTFS[tabla]
+    return TABLAS_DERIVADAS_GTFS[tabla]
+
+
+def cargarTablaDesdeCsv(rutaConjunto: str, tabla: str, obtenerTabla=None):
+    """
+    Procesa una tabla del conjunto directamente de sus archivos CSV.
+    @obtenerTabla: Función que devuelve las tablas de las que se construyen
+                   las derivadas (p. ej. ConjuntoGtfs.tabla, para usar las
+                   que ya están cargadas). Por defecto se cargan con
+                   cargarTablaGtfs
+    """
+    if obtenerTabla is None:
+        obtenerTabla = lambda nombre: cargarTablaGtfs(rutaConjunto, nombre)
+
+    if tabla == "departures":
+        return construirTableroDeSalidas(
+            obtenerTabla("stop_times"),
+            obtenerTabla("frequencies"),
+            obtenerTabla("trips"))
+    if tabla == "raptor":
+        # Las paradas del grafo son (nombre del conjunto, stop_id)
+        caminatas = [(desde[1], hasta[1], segundos) for desde, hasta, segundos
+                     in cargarGrafoDeCaminatas([rutaConjunto]).aristas()]
+        return construirRedRaptor(
+            obtenerTabla("stop_times"),
+            obtenerTabla("frequencies"),
+            obtenerTabla("trips"),
+            obtenerTabla("transfers"),
+            caminatas,
+            obtenerTabla("calendar"))
+    if tabla == "distances":
+        return construirDistanciasDeParadas(
+            obtenerTabla("stop_times"),
+            obtenerTabla("shapes"),
+            obtenerTabla("trips"),
+            obtenerTabla("stops"))
+
+    archivo = os.path.join(rutaConjunto, TABLAS_GTFS[tabla][0])
+
+    if tabla == "agency":
+        return obtenerAgencias(archivo)
+    elif tabla == "routes":
+        # A las rutas de Setran se les quita el tipo de ruta del nombre
+        quitarTexto = "etran" in os.path.basename(os.path.normpath(rutaConjunto))
+        return obtenerRutas(archivo, quitarTexto=quitarTexto)
+    elif tabla == "trips":
+        return obtenerViajes(archivo)
+    elif tabla == "frequencies":
+        return obtenerFrecuencias(archivo)
+    elif tabla == "shapes":
+        return obtenerTrazos(archivo)
+    elif tabla == "stops":
+        return obtenerParadas(archivo)
+    elif tabla == "stop_times":
+        return obtenerHorariosDeParada(archivo)
+    elif tabla == "transfers":
+        return obtenerTransbordos(archivo)
+    elif tabla == "calendar":
+        return obtenerCalendario(archivo, os.path.join(rutaConjunto, TABLAS_GTFS[tabla][1]))
+
+    raise ValueError(f"Tabla GTFS desconocida: {tabla}")
+
+
+def firmaArchivo(archivo: str, calcularHash=True):
+    """Devuelve el tamaño, la fecha de modificación y el hash SHA-1 de
+    un archivo, para saber si una instantánea hecha con él sigue vigente"""
+    try:
+        estado = os.stat(archivo)
+    except FileNotFoundError:
+        # Los archivos opcionales (p. ej. transfers.txt) pueden no venir
+        return {"size": None, "mtime": None, "sha1": None}
+    firma = {
+        "size": estado.st_size,
+        "mtime": estado.st_mtime_ns,
+        "sha1": None,
+    }
+
+    if calcularHash:
+        sha1 = hashlib.sha1()
+        with open(archivo, "rb") as f:
+            for bloque in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(bloque)
+        firma["sha1"] = sha1.hexdigest()
+
+    return firma
+
+
+def rutaInstantanea(rutaConjunto: str, tabla: str):
+    """Ruta del archivo de instantánea de una tabla. Cada conjunto tiene su
+    propia carpeta, identificada por su nombre y un hash de su ruta absoluta"""
+    rutaConjunto = os.path.abspath(rutaConjunto)
+    nombre = os.path.basename(os.path.normpath(rutaConjunto))
+    huella = hashlib.sha1(rutaConjunto.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(RUTA_CACHE_GTFS, f"{nombre}-{huella}", f"{tabla}.pickle")
+
+
+def opcionesDeTabla(tabla: str):
+    """Configuración con la que se procesó la tabla. Si cambia, su
+    instantánea ya no sirve aunque los archivos sean los mismos"""
+    if tabla == "shapes":
+        return {"tolerancia": TOLERANCIA_TRAZOS_METROS}
+    if tabla == "distances":
+        return {"tolerancia": TOLERANCIA_TRAZOS_METROS, "umbral": DIST_MAX_PARADA_TRAZO_METROS}
+    if tabla == "raptor":
+        return opcionesDeCaminatas()
+    return {}
+
+
+def archivosDeInstantanea(rutaConjunto: str, tabla: str):
+    """Los archivos fuente de la tabla, por nombre de archivo"""
+    return {
+        nombreArchivo: os.path.join(rutaConjunto, nombreArchivo)
+        for nombreArchivo in archivosDeTabla(tabla)
+    }
+
+
+def esInstantaneaVigente(encabezado: dict, opciones: dict, archivos: dict):
+    if not isinstance(encabezado, dict):
+        return False
+
+    if encabezado.get("version") != VERSION_INSTANTANEA:
+        return False
+
+    if encabezado.get("opciones", {}) != opciones:
+        return False
+
+    return sonFirmasVigentes(encabezado.get("archivos", {}), archivos)
+
+
+def sonFirmasVigentes(firmasGuardadas: dict, archivos: dict):
+    """Si los archivos (clave -> ruta) siguen siendo los mismos con los
+    que se guardaron las firmas"""
+    for clave, archivo in archivos.items():
+        firmaGuardada = firmasGuardadas.get(clave)
+        if firmaGuardada is None:
+            return False
+
+        firmaActual = firmaArchivo(archivo, calcularHash=False)
+
+        if firmaActual["size"] != firmaGuardada["size"]:
+            return False
+
+        # Si solo cambió la fecha (p. ej. se copió el archivo) el hash decide
+        if firmaActual["mtime"] != firmaGuardada["mtime"]:
+            if firmaArchivo(archivo)["sha1"] != firmaGuardada["sha1"]:
+                return False
+
+    return True
+
+
+class LectorInstantanea(pickle.Unpickler):
+    """Las clases de este archivo se guardan como "__main__" o como "Main"
+    según si se ejecutó el programa o se importó. Las resolvemos siempre
+    en este módulo para no importarlo dos veces"""
+
+    def find_class(self, modulo, nombre):
+        if modulo in ("__main__", "Main", __name__) and nombre in globals():
+            return globals()[nombre]
+        return super().find_class(modulo, nombre)
+
+
+def leerInstantanea(archivoInstantanea: str, opciones: dict, archivos: dict):
+    """Devuelve los datos guardados en la instantánea, o None si no existe,
+    si se hizo con otras opciones o si alguno de sus archivos fuente
+    (clave -> ruta) cambió"""
+    try:
+        with open(archivoInstantanea, "rb") as f:
+            # El encabezado va primero para no tener que deserializar
+            # todos los datos de una instantánea que ya no sirve
+            encabezado = LectorInstantanea(f).load()
+            if not esInstantaneaVigente(encabezado, opciones, archivos):
+                return None
+            return LectorInstantanea(f).load()
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+
+def guardarInstantanea(archivoInstantanea: str, opciones: dict, archivos: dict, datos):
+    """Guarda los datos con un encabezado que dice con qué opciones y de
+    qué versión de cada archivo fuente (clave -> ruta) se hicieron"""
+    encabezado = {
+        "version": VERSION_INSTANTANEA,
+        "opciones": opciones,
+        "archivos": {clave: firmaArchivo(archivo) for clave, archivo in archivos.items()},
+    }
+
+    try:
+        os.makedirs(os.path.dirname(archivoInstantanea), exist_ok=True)
+        # Escribimos a un temporal y lo renombramos para que nunca
+        # quede una instantánea a medio escribir
+        archivoTemporal = f"{archivoInstantanea}.{os.getpid()}.tmp"
+        with open(archivoTemporal, "wb") as f:
+            pickle.dump(encabezado, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(datos, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(archivoTemporal, archivoInstantanea)
+    except OSError as e:
+        print(f"No se pudo guardar la instantánea {archivoInstantanea}: {e}")
+
+
+def cargarTablaGtfs(rutaConjunto: str, tabla: str,
+                    usarInstantanea=True, reconstruir=False, obtenerTabla=None):
+    """Carga una tabla del conjunto desde su instantánea si sigue vigente;
+    si no, la procesa desde el CSV y guarda una instantánea nueva.
+    @obtenerTabla: Ver cargarTablaDesdeCsv"""
+    archivoInstantanea = rutaInstantanea(rutaConjunto, tabla)
+    archivos = archivosDeInstantanea(rutaConjunto, tabla)
+
+    if usarInstantanea and not reconstruir:
+        with instrumentacion.medir(f"leerInstantanea.{tabla}"):
+            datos = leerInstantanea(archivoInstantanea, opcionesDeTabla(tabla), archivos)
+        if datos is not None:
+            return datos
+
+    with instrumentacion.medir(f"cargarTablaDesdeCsv.{tabla}"):
+        datos = cargarTablaDesdeCsv(rutaConjunto, tabla, obtenerTabla)
+
+    if usarInstantanea:
+        guardarInstantanea(archivoInstantanea, opcionesDeTabla(tabla), archivos, datos)
+
+    return datos
+
+
+def cargarTablaGtfsMedida(rutaConjunto: str, tabla: str,
+                          usarInstantanea=True, reconstruir=False):
+    """Igual que cargarTablaGtfs, pero también devuelve los segundos que
+    tardó. Es lo que ejecuta cada proceso de la carga paralela"""
+    inicio = time.perf_counter()
+    datos = cargarTablaGtfs(rutaConjunto, tabla, usarInstantanea, reconstruir)
+    return datos, time.perf_counter() - inicio
+
+
+def cargarConjuntoGtfs(rutaConjunto: str, usarInstantanea=True, reconstruir=False):
+    return {
+        tabla: cargarTablaGtfs(rutaConjunto, tabla, usarInstantanea, reconstruir)
+        for tabla in TABLAS_GTFS
+    }
+
+
+def reporteTiemposDeCarga(rutaConjunto: str):
+    """Compara la carga en frío (CSV + escritura de la instantánea)
+    contra la carga en caliente (solo la instantánea) de cada tabla"""
+    filas = []
+    totalFrio = 0.0
+    totalCaliente = 0.0
+
+    for tabla in TABLAS_GTFS:
+        inicio = time.perf_counter()
+        cargarTablaGtfs(rutaConjunto, tabla, reconstruir=True)
+        tiempoFrio = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        cargarTablaGtfs(rutaConjunto, tabla)
+        tiempoCaliente = time.perf_counter() - inicio
+
+        totalFrio += tiempoFrio
+        totalCaliente += tiempoCaliente
+        filas.append((tabla, tiempoFrio, tiempoCaliente))
+
+    filas.append(("TOTAL", totalFrio, totalCaliente))
+
+    print(f'Tiempos de carga de "{rutaConjunto}":')
+    print("%-12s %10s %10s %8s" % ("Tabla", "Frío (s)", "Caliente", "Razón"))
+    for tabla, tiempoFrio, tiempoCaliente in filas:
+        razon = tiempoFrio / tiempoCaliente if tiempoCaliente else float("inf")
+        print("%-12s %10.4f %10.4f %7.1fx" % (tabla, tiempoFrio, tiempoCaliente, razon))
+
+    return filas
+
+
+class ConjuntoGtfs:
+    """
+    Conjunto GTFS que procesa cada tabla la primera vez que se usa, desde
+    su instantánea o desde el CSV. Opcionalmente puede precargar las tablas
+    en un hilo en segundo plano.
+    """
+
+    # Las tablas que usan los menús, en el orden en que se necesitan.
+    # shapes no se precarga porque ningún menú la usa
+    TABLAS_PRECARGA = ["agency", "routes", "trips", "stops", "stop_times", "frequencies"]
+
+    def __init__(self, rutaConjunto: str, usarInstantanea=True):
+        self.ruta = rutaConjunto
+        self.nombre = os.path.basename(os.path.normpath(rutaConjunto))
+        self.usarInstantanea = usarInstantanea
+        self._tablas = {}
+        # Un candado por tabla para que el hilo de precarga y el
+        # programa principal nunca procesen la misma tabla dos veces
+        self._candados = {
+            tabla: threading.Lock()
+            for tabla in list(TABLAS_GTFS) + list(TABLAS_DERIVADAS_GTFS)
+        }
+        self._hiloPrecarga = None
+        # Tablas de horarios ya expandidas, por trip_id
+        self._horariosDeViajes = {}
+
+    def tabla(self, nombre: str):
+        if nombre not in self._tablas:
+            with self._candados[nombre]:
+                if nombre not in self._tablas:
+                    # Las tablas derivadas se construyen con las
+                    # tablas del conjunto que ya estén cargadas
+                    self._tablas[nombre] = cargarTablaGtfs(
+                        self.ruta, nombre, self.usarInstantanea,
+                        obtenerTabla=self.tabla)
+
+        return self._tablas[nombre]
+
+    def estaCargada(self, nombre: str):
+        return nombre in self._tablas
+
+    def horariosDeViaje(self, trip_id):
+        """La TablaDeHorarios del viaje, calculada una sola vez"""
+        tabla = self._horariosDeViajes.get(trip_id)
+
+        if tabla is None:
+            tabla = expandirFrecuenciasDeViaje(
+                self.stop_times.llegadasDeViaje(trip_id),
+                self.frequencies.get(trip_id, []))
+            self._horariosDeViajes[trip_id] = tabla
+
+        return tabla
+
+    def precargar(self, tablas: list = None):
+        """Carga en segundo plano las tablas que aún no se han usado"""
+        tablas = list(tablas or self.TABLAS_PRECARGA)
+
+        def precargarTablas():
+            for tabla in tablas:
+                try:
+                    self.tabla(tabla)
+                except Exception:
+                    # El error se volverá a producir (y mostrar) cuando
+                    # el programa principal pida la tabla
+                    pass
+
+        self._hiloPrecarga = threading.Thread(
+            target=precargarTablas, name=f"precarga-{self.nombre}", daemon=True)
+        self._hiloPrecarga.start()
+
+        return self._hiloPrecarga
+
+    def esperarPrecarga(self):
+        if self._hiloPrecarga is not None:
+            self._hiloPrecarga.join()
+
+    def cargarEnParalelo(self, trabajadores: int = None,
+                         tablas: list = None, reconstruir=False):
+        """
+        Carga las tablas a la vez, cada una en un proceso del grupo.
+        Devuelve los segundos que tardó cada tabla y el tiempo real total.
+        @trabajadores: Número de procesos. Por defecto TRABAJADORES_CARGA
+        @reconstruir: Procesar los CSV aunque haya instantáneas vigentes
+        """
+        tablas = [
+            t for t in (tablas or TABLAS_GTFS)
+            if reconstruir or not self.estaCargada(t)
+        ]
+        # Las tablas más grandes primero, para que no sean las últimas en empezar
+        tablas.sort(key=lambda t: sum(
+            os.path.getsize(os.path.join(self.ruta, archivo))
+            if os.path.exists(os.path.join(self.ruta, archivo)) else 0
+            for archivo in archivosDeTabla(t)), reverse=True)
+        tiempos = {}
+
+        inicio = time.perf_counter()
+        if tablas:
+            # Si los procesos se crean con fork heredan lo que aún no se ha
+            # escrito en pantalla, y lo volverían a imprimir al terminar
+            sys.stdout.flush()
+            with ProcessPoolExecutor(trabajadores or TRABAJADORES_CARGA) as ejecutor:
+                futuros = {
+                    ejecutor.submit(cargarTablaGtfsMedida, self.ruta, tabla,
+                                    self.usarInstantanea, reconstruir): tabla
+                    for tabla in tablas
+                }
+
+                for futuro in as_completed(futuros):
+                    tabla = futuros[futuro]
+                    datos, tiempos[tabla] = futuro.result()
+                    with self._candados[tabla]:
+                        self._tablas[tabla] = datos
+
+        return tiempos, time.perf_counter() - inicio
+
+    @property
+    def agency(self):
+        """Contiene "agencias" que son básicamente las subdivisones
+        del transporte, en este caso macro, tren, sitren, etc"""
+        return self.tabla("agency")
+
+    @property
+    def routes(self):
+        """Contiene las rutas como tal. Es recomendable obtener las
+        rutas que contengan el nombre de una agencia determinada,
+        para filtrar y simplificar la navegación"""
+        return self.tabla("routes")
+
+    @property
+    def trips(self):
+        """Contiene los viajes que realiza la ruta, es decir, cosas
+        como la dirección y sentido, los días, y un identificador
+        para las paradas que se reaizan"""
+        return self.tabla("trips")
+
+    @property
+    def frequencies(self):
+        """Contiene los tiempos de de frecuencia, esto es, la hora
+        en la que comienza y termina la circulación de la ruta."""
+        return self.tabla("frequencies")
+
+    @property
+    def shapes(self):
+        """Describe la forma que recorre la ruta, por ejemplo,
+        para delinearla en un mapa"""
+        return self.tabla("shapes")
+
+    @property
+    def stops(self):
+        """Contiene las ubicaciones de las paradas, no sirve sin
+        stop_times"""
+        return self.tabla("stops")
+
+    @property
+    def stop_times(self):
+        """Contiene las paradas específicas de un viaje en particular.
+        Referencia a stops. Es un HorariosDeParada"""
+        return self.tabla("stop_times")
+
+    @property
+    def calendar(self):
+        """Los días en que corre cada service_id de trips. Es un
+        CalendarioDeServicios"""
+        return self.tabla("calendar")
+
+    @property
+    def departures(self):
+        """Las salidas de todos los viajes en cada parada, ordenadas por
+        hora. Es un TableroDeSalidas"""
+        return self.tabla("departures")
+
+    @property
+    def transfers(self):
+        """Los transbordos explícitos entre paradas, por parada de origen"""
+        return self.tabla("transfers")
+
+    @property
+    def raptor(self):
+        """La red del planificador de viajes. Es una RedRaptor"""
+        return self.tabla("raptor")
+
+    @property
+    def distances(self):
+        """Dónde queda cada parada a lo largo del trazo de su viaje
+        (shape_dist_traveled). Es un DistanciasDeParadas"""
+        return self.tabla("distances")
+
+
+def reporteCargaEnParalelo(rutaConjunto: str, trabajadores: int = None):
+    """Procesa todas las tablas desde CSV en el grupo de procesos y
+    compara el tiempo real contra la suma de los tiempos de cada tabla"""
+    conjunto = ConjuntoGtfs(rutaConjunto)
+    tiempos, tiempoReal = conjunto.cargarEnParalelo(trabajadores, reconstruir=True)
+    tiempoSumado = sum(tiempos.values())
+
+    print(f'Carga paralela de "{rutaConjunto}" ({trabajadores or os.cpu_count()} procesos):')
+    print("%-12s %10s" % ("Tabla", "Tiempo (s)"))
+    for tabla in TABLAS_GTFS:
+        print("%-12s %10.4f" % (tabla, tiempos[tabla]))
+    print("%-12s %10.4f" % ("Suma", tiempoSumado))
+    print("%-12s %10.4f" % ("Real", tiempoReal))
+    print(f"Aceleración: {tiempoSumado / tiempoReal:.2f}x")
+
+    return tiempos, tiempoReal
+
+
+def distanciaMetros(lat1: float, lon1: float, lat2: float, lon2: float):
+    """Distancia de círculo máximo (haversine) entre dos coordenadas"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_METROS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class IndiceEspacial:
+    """
+    Rejilla uniforme sobre puntos (id, lat, lon) para buscar los k más
+    cercanos o los que están dentro de un radio en metros, revisando solo
+    las celdas cercanas en vez de todos los puntos.
+    """
+
+    def __init__(self, puntos, tamCeldaMetros: float = TAM_CELDA_INDICE_METROS):
+        self.ids = []
+        self.lats = array("d")
+        self.lons = array("d")
+
+        for id_, lat, lon in puntos:
+            self.ids.append(id_)
+            self.lats.append(float(lat))
+            self.lons.append(float(lon))
+
+        # Las celdas miden lo mismo en metros en ambos ejes a la latitud media
+        latMedia = sum(self.lats) / len(self.lats) if self.lats else 0.0
+        self.tamCeldaMetros = tamCeldaMetros
+        self.tamCeldaLat = tamCeldaMetros / METROS_POR_GRADO
+        self.tamCeldaLon = tamCeldaMetros / (
+            METROS_POR_GRADO * max(math.cos(math.radians(latMedia)), 0.01))
+
+        self.celdas = {}
+        for i, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            self.celdas.setdefault(self.celda(lat, lon), []).append(i)
+
+        if self.celdas:
+            filas = [f for f, _ in self.celdas]
+            columnas = [c for _, c in self.celdas]
+            self.limites = (min(filas), max(filas), min(columnas), max(columnas))
+        else:
+            self.limites = (0, -1, 0, -1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def celda(self, lat: float, lon: float):
+        return (math.floor(lat / self.tamCeldaLat), math.floor(lon / self.tamCeldaLon))
+
+    def enCaja(self, sur: float, oeste: float, norte: float, este: float):
+        """Los id de los puntos dentro de la caja (en grados)"""
+        filaMin, columnaMin = self.celda(sur, oeste)
+        filaMax, columnaMax = self.celda(norte, este)
+        resultados = []
+
+        for fila in range(filaMin, filaMax + 1):
+            for columna in range(columnaMin, columnaMax + 1):
+                for i in self.celdas.get((fila, columna), ()):
+                    if sur <= self.lats[i] <= norte and oeste <= self.lons[i] <= este:
+                        resultados.append(self.ids[i])
+
+        return resultados
+
+    def enRadio(self, lat: float, lon: float, radioMetros: float):
+        """Los puntos a radioMetros o menos, como tuplas (distancia, id)
+        ordenadas de la más cercana a la más lejana"""
+        filaCentro, columnaCentro = self.celda(lat, lon)
+        alcanceFilas = math.ceil(radioMetros / METROS_POR_GRADO / self.tamCeldaLat)
+        alcanceColumnas = math.ceil(
+            radioMetros / (METROS_POR_GRADO * max(math.cos(math.radians(lat)), 0.01))
+            / self.tamCeldaLon)
+        resultados = []
+
+        for fila in range(filaCentro - alcanceFilas, filaCentro + alcanceFilas + 1):
+            for columna in range(columnaCentro - alcanceColumnas,
+                                 columnaCentro + alcanceColumnas + 1):
+                for i in self.celdas.get((fila, columna), ()):
+                    distancia = distanciaMetros(lat, lon, self.lats[i], self.lons[i])
+                    if distancia <= radioMetros:
+                        resultados.append((distancia, self.ids[i]))
+
+        resultados.sort(key=lambda r: r[0])
+        return resultados
+
+    def masCercanos(self, lat: float, lon: float, k: int = 1,
+                    radioMaximo: float = None):
+        """Los k puntos más cercanos, como tuplas (distancia, id). Revisa
+        anillos de celdas cada vez más grandes hasta que ningún punto
+        sin revisar pueda estar más cerca que el k-ésimo encontrado"""
+        if not self.ids:
+            return []
+
+        filaCentro, columnaCentro = self.celda(lat, lon)
+        filaMin, filaMax, columnaMin, columnaMax = self.limites
+        anilloMax = max(
+            abs(filaCentro - filaMin), abs(filaCentro - filaMax),
+            abs(columnaCentro - columnaMin), abs(columnaCentro - columnaMax))
+        # Lo que mide en metros el lado más corto de una celda en esta latitud
+        ladoMinimo = min(
+            self.tamCeldaLat * METROS_POR_GRADO,
+            self.tamCeldaLon * METROS_POR_GRADO * math.cos(math.radians(lat)))
+        candidatos = []
+
+        for anillo in range(anilloMax + 1):
+            for fila in range(filaCentro - anillo, filaCentro + anillo + 1):
+                # En las filas intermedias solo están las columnas de los bordes
+                if abs(fila - filaCentro) == anillo:
+                    columnas = range(columnaCentro - anillo, columnaCentro + anillo + 1)
+                else:
+                    columnas = (columnaCentro - anillo, columnaCentro + anillo)
+
+                for columna in columnas:
+                    for i in self.celdas.get((fila, columna), ()):
+                        distancia = distanciaMetros(lat, lon, self.lats[i], self.lons[i])
+                        candidatos.append((distancia, i))
+
+            # Fuera de este anillo todo está al menos a anillo * ladoMinimo
+            alcance = anillo * ladoMinimo
+            if len(candidatos) >= k:
+                candidatos.sort()
+                del candidatos[k:]
+                if candidatos[-1][0] <= alcance:
+                    break
+            if radioMaximo is not None and alcance > radioMaximo:
+                break
+
+        candidatos.sort()
+        return [
+            (distancia, self.ids[i]) for distancia, i in candidatos[:k]
+            if radioMaximo is None or distancia <= radioMaximo
+        ]
+
+
+# Índices de paradas ya construidos, por conjuntos incluidos
+indicesDeParadas = {}
+
+
+def indiceDeParadasGtfs(rutasConjuntos: list = None):
+    """Índice espacial sobre las paradas de varios conjuntos GTFS (por
+    defecto, todos los de RUTA_DATOS_GTFS). Los id son tuplas
+    (nombre del conjunto, stop_id)"""
+    if rutasConjuntos is None:
+        rutasConjuntos = [os.path.join(RUTA_DATOS_GTFS, c) for c in CONJUNTOS_GTFS]
+
+    clave = tuple(os.path.abspath(r) for r in rutasConjuntos)
+    if clave not in indicesDeParadas:
+        puntos = []
+        for rutaConjunto in rutasConjuntos:
+            nombre = os.path.basename(os.path.normpath(rutaConjunto))
+            for stop_id, parada in cargarTablaGtfs(rutaConjunto, "stops").items():
+                puntos.append(((nombre, stop_id), parada["stop_lat"], parada["stop_lon"]))
+        indicesDeParadas[clave] = IndiceEspacial(puntos)
+
+    return indicesDeParadas[clave]
+
+
+class GrafoDeCaminatas:
+    """
+    Las caminatas entre todas las paradas que quedan a RADIO_CAMINATA_METROS
+    o menos, de uno o varios conjuntos, en formato CSR: los vecinos de la
+    parada i van de inicios[i] a inicios[i + 1] en destinos (índices de
+    parada) y segundos (lo que se tarda en caminar). Las paradas son tuplas
+    (nombre del conjunto, stop_id), como en indiceDeParadasGtfs.
+    """
+
+    def __init__(self, paradas: list, inicios: array, destinos: array, segundos: array):
+        self.paradas = paradas
+        self.indiceParadas = {parada: i for i, parada in enumerate(paradas)}
+        self.inicios = inicios
+        self.destinos = destinos
+        self.segundos = segundos
+
+    def __len__(self):
+        return len(self.destinos)
+
+    def vecinos(self, parada):
+        """Las paradas a las que se puede caminar, como tuplas (parada, segundos)"""
+        i = self.indiceParadas.get(parada)
+        if i is None:
+            return []
+        return [
+            (self.paradas[self.destinos[j]], self.segundos[j])
+            for j in range(self.inicios[i], self.inicios[i + 1])
+        ]
+
+    def aristas(self):
+        """Todas las caminatas, como tuplas (parada, parada, segundos)"""
+        for i, parada in enumerate(self.paradas):
+            for j in range(self.inicios[i], self.inicios[i + 1]):
+                yield parada, self.paradas[self.destinos[j]], self.segundos[j]
+
+
+def opcionesDeCaminatas():
+    return {
+        "radio": RADIO_CAMINATA_METROS,
+        "velocidad": VELOCIDAD_CAMINATA,
+        "rodeo": FACTOR_RODEO_CAMINATA,
+    }
+
+
+@instrumentacion.medida()
+def construirGrafoDeCaminatas(rutasConjuntos: list):
+    """Busca con el índice espacial las paradas cercanas a cada parada, en
+    lugar de comparar todas contra todas"""
+    indice = indiceDeParadasGtfs(rutasConjuntos)
+    posiciones = {parada: i for i, parada in enumerate(indice.ids)}
+    vecinos = []
+
+    for parada, lat, lon in zip(indice.ids, indice.lats, indice.lons):
+        vecinos.append([
+            (posiciones[otra], round(distancia * FACTOR_RODEO_CAMINATA / VELOCIDAD_CAMINATA))
+            for distancia, otra in indice.enRadio(lat, lon, RADIO_CAMINATA_METROS)
+            if otra != parada
+        ])
+
+    inicios, (destinos, segundos) = arraysCsr(vecinos, 2)
+    return GrafoDeCaminatas(list(indice.ids), inicios, destinos, segundos)
+
+
+def rutaGrafoDeCaminatas(rutasConjuntos: list):
+    """Cada combinación de conjuntos tiene su propio grafo guardado"""
+    rutas = sorted(os.path.abspath(r) for r in rutasConjuntos)
+    nombres = "+".join(os.path.basename(os.path.normpath(r)) for r in rutas)
+    huella = hashlib.sha1("\n".join(rutas).encode("utf-8")).hexdigest()[:8]
+    return os.path.join(RUTA_CACHE_GTFS, "caminatas", f"{nombres}-{huella}.pickle")
+
+
+# Grafos de caminatas ya cargados, por conjuntos incluidos
+grafosDeCaminatas = {}
+
+
+def cargarGrafoDeCaminatas(rutasConjuntos: list = None, reconstruir=False):
+    """
+    El grafo de caminatas entre las paradas de los conjuntos (por defecto,
+    todos los de RUTA_DATOS_GTFS). Se guarda en disco como las instantáneas
+    y se reconstruye solo si cambia algún stops.txt o las opciones de caminata.
+    """
+    if rutasConjuntos is None:
+        rutasConjuntos = [os.path.join(RUTA_DATOS_GTFS, c) for c in CONJUNTOS_GTFS]
+
+    clave = tuple(sorted(os.path.abspath(r) for r in rutasConjuntos))
+    if clave in grafosDeCaminatas and not reconstruir:
+        return grafosDeCaminatas[clave]
+
+    archivo = rutaGrafoDeCaminatas(rutasConjuntos)
+    # Depende del stops.txt de cada conjunto
+    archivos = {ruta: os.path.join(ruta, "stops.txt") for ruta in clave}
+    grafo = None
+
+    if not reconstruir:
+        grafo = leerInstantanea(archivo, opcionesDeCaminatas(), archivos)
+
+    if grafo is None:
+        grafo = construirGrafoDeCaminatas(list(clave))
+        guardarInstantanea(archivo, opcionesDeCaminatas(), archivos, grafo)
+
+    grafosDeCaminatas[clave] = grafo
+    return grafo
+
+
+def reporteGrafoDeCaminatas(rutasConjuntos: list = None):
+    """Construye el grafo de caminatas desde cero y compara contra
+    cargarlo de disco"""
+    inicio = time.perf_counter()
+    grafo = cargarGrafoDeCaminatas(rutasConjuntos, reconstruir=True)
+    tiempoConstruccion = time.perf_counter() - inicio
+
+    grafosDeCaminatas.clear()
+    inicio = time.perf_counter()
+    cargarGrafoDeCaminatas(rutasConjuntos)
+    tiempoCarga = time.perf_counter() - inicio
+
+    entreConjuntos = sum(
+        grafo.paradas[i][0] != grafo.paradas[grafo.destinos[j]][0]
+        for i in range(len(grafo.paradas))
+        for j in range(grafo.inicios[i], grafo.inicios[i + 1]))
+    tam = sum(a.itemsize * len(a) for a in (grafo.inicios, grafo.destinos, grafo.segundos))
+
+    print(f"Caminatas de hasta {RADIO_CAMINATA_METROS} m entre {len(grafo.paradas)} paradas:")
+    print(f"{len(grafo)} caminatas ({entreConjuntos} entre conjuntos distintos), {tam / 1024:.1f} KiB")
+    print(f"Construcción: {tiempoConstruccion:.2f} s; carga desde disco: {tiempoCarga:.3f} s")
+
+    return grafo
+
+
+def reporteIndiceEspacial(rutaConjunto: str, consultas: int = 1000,
+                          k: int = 5, radioMetros: float = 300):
+    """Compara el índice espacial contra una búsqueda lineal sobre las
+    paradas de un conjunto, con coordenadas de consulta al azar"""
+    paradas = cargarTablaGtfs(rutaConjunto, "stops")
+    puntos = [(stop_id, p["stop_lat"], p["stop_lon"]) for stop_id, p in paradas.items()]
+
+    inicio = time.perf_counter()
+    indice = IndiceEspacial(puntos)
+    tiempoConstruccion = time.perf_counter() - inicio
+
+    aleatorio = random.Random(0)
+    coordenadas = [
+        (aleatorio.uniform(min(indice.lats), max(indice.lats)),
+         aleatorio.uniform(min(indice.lons), max(indice.lons)))
+        for _ in range(consultas)
+    ]
+
+    def buscarLinealmente(lat, lon):
+        distancias = sorted(
+            (distanciaMetros(lat, lon, pLat, pLon), stop_id)
+            for stop_id, pLat, pLon in puntos)
+        return distancias[:k], [d for d in distancias if d[0] <= radioMetros]
+
+    tiempos = {}
+    inicio = time.perf_counter()
+    esperados = [buscarLinealmente(lat, lon) for lat, lon in coordenadas]
+    tiempos["lineal"] = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    cercanos = [indice.masCercanos(lat, lon, k) for lat, lon in coordenadas]
+    tiempos["k cercanos"] = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    enRadio = [indice.enRadio(lat, lon, radioMetros) for lat, lon in coordenadas]
+    tiempos["radio"] = time.perf_counter() - inicio
+
+    coincidencias = sum(
+        [d for d, _ in e[0]] == [d for d, _ in c] and len(e[1]) == len(r)
+        for e, c, r in zip(esperados, cercanos, enRadio))
+
+    print(f'Índice espacial sobre {len(indice)} paradas de "{rutaConjunto}":')
+    print(f"Construcción: {tiempoConstruccion:.4f} s ({len(indice.celdas)} celdas)")
+    print(f"{consultas} consultas (k={k}, radio={radioMetros} m):")
+    print("%-12s %12s" % ("Búsqueda", "µs/consulta"))
+    for nombre, tiempo in tiempos.items():
+        print("%-12s %12.1f" % (nombre, tiempo / consultas * 1e6))
+    print(f"Resultados iguales a la búsqueda lineal: {coincidencias}/{consultas}")
+
+    return tiempoConstruccion, tiempos
+
+
+def reporteDistanciasDeParadas(rutaConjunto: str, mostrar: int = 20):
+    """Proyecta las paradas de todos los viajes sobre sus trazos y muestra
+    cuánto tardó y las paradas más alejadas de su trazo"""
+    tablas = {t: cargarTablaGtfs(rutaConjunto, t) for t in ("stop_times", "shapes", "trips", "stops")}
+
+    inicio = time.perf_counter()
+    distancias = construirDistanciasDeParadas(
+        tablas["stop_times"], tablas["shapes"], tablas["trips"], tablas["stops"])
+    segundos = time.perf_counter() - inicio
+
+    proyectadas = sum(not math.isnan(d) for d in distancias.distancia)
+    print(f'Paradas de "{rutaConjunto}" proyectadas sobre sus trazos en {segundos:.2f} s:')
+    print(f"{proyectadas} de {len(distancias.distancia)} filas de stop_times; "
+          f"{distancias.viajesSinTrazo} viajes sin trazo")
+    print(f"{len(distancias.lejanas)} paradas a más de {DIST_MAX_PARADA_TRAZO_METROS} m de su trazo")
+    if distancias.lejanas:
+        print("%-28s %-24s %6s %10s" % ("Viaje", "Parada", "Sec.", "Desvío (m)"))
+        for trip_id, stop_id, secuencia, desvio in sorted(
+                distancias.lejanas, key=lambda l: -l[3])[:mostrar]:
+            print("%-28s %-24s %6d %10.1f" % (trip_id, stop_id, secuencia, desvio))
+
+    return distancias
+
+
+def reporteTrazos(rutaConjunto: str, tolerancias: tuple = (0, 1, 2, 5, 10)):
+    """Carga los trazos de un conjunto con varias tolerancias de
+    simplificación y compara los puntos, la memoria y el tiempo"""
+    archivo = os.path.join(rutaConjunto, TABLAS_GTFS["shapes"][0])
+    filas = []
+
+    for tolerancia in tolerancias:
+        inicio = time.perf_counter()
+        trazos = obtenerTrazos(archivo, tolerancia)
+        segundos = time.perf_counter() - inicio
+        longitud = sum(trazos.longitud(shape_id) for shape_id in trazos)
+        filas.append((tolerancia, len(trazos.lat), trazos.tamEnBytes(), longitud, segundos))
+
+    print(f'Trazos de "{rutaConjunto}" ({len(trazos)} trazos):')
+    print("%-12s %10s %10s %14s %10s" % ("Tolerancia", "Puntos", "KiB", "Longitud (km)", "Carga (s)"))
+    for tolerancia, puntos, tam, longitud, segundos in filas:
+        print("%-12s %10d %10.1f %14.1f %10.3f" % (
+            f"{tolerancia} m" if tolerancia else "sin", puntos, tam / 1024, longitud / 1000, segundos))
+
+    return filas
+
+
+def elementoOsmAParada(elemento: dict):
+    """Separa un elemento de una respuesta JSON de Overpass en sus atributos
+    y sus etiquetas, sin modificar el elemento original"""
+    return {
+        "attrib": {k: v for k, v in elemento.items() if k != "tags"},
+        "tags": dict(elemento.get("tags", {})),
+    }
+
+
+class EmparejadorDeParadasOsm:
+    """
+    Empareja paradas GTFS con nodos de OSM. Los nodos se indexan una sola
+    vez por celda (IndiceEspacial) y por sus etiquetas ref y gtfs_id, así
+    que cada parada se resuelve revisando solo sus vecinos.
+    """
+
+    def __init__(self, elementos: list, distanciaMaxima: float = DIST_MAX_COLISION_METROS):
+        self.distanciaMaxima = distanciaMaxima
+        self.elementos = [e for e in elementos if "lat" in e and "lon" in e]
+        self.indice = IndiceEspacial(
+            ((i, e["lat"], e["lon"]) for i, e in enumerate(self.elementos)),
+            tamCeldaMetros=max(2 * distanciaMaxima, 1))
+
+        # Un nodo puede tener varios ref separados por ";"
+        self.porId = {}
+        for i, elemento in enumerate(self.elementos):
+            etiquetas = elemento.get("tags", {})
+            for clave in ("ref", "gtfs_id"):
+                for valor in str(etiquetas.get(clave, "")).split(";"):
+                    if valor:
+                        self.porId.setdefault(valor, set()).add(i)
+
+    def candidatos(self, stop_id, lat: float, lon: float):
+        """Los nodos que pueden ser la parada, como tuplas (distancia, índice,
+        coincideElId). Los que tienen su stop_id como ref o gtfs_id van
+        primero sin importar la distancia; después, los más cercanos"""
+        encontrados = {
+            i: (distancia, i, False)
+            for distancia, i in self.indice.enRadio(lat, lon, self.distanciaMaxima)
+        }
+
+        for i in self.porId.get(stop_id, ()):
+            elemento = self.elementos[i]
+            encontrados[i] = (
+                distanciaMetros(lat, lon, elemento["lat"], elemento["lon"]), i, True)
+
+        return sorted(encontrados.values(), key=lambda c: (not c[2], c[0]))
+
+    def colision(self, candidato):
+        distancia, i, coincideElId = candidato
+        parada = elementoOsmAParada(self.elementos[i])
+        parada["distance"] = round(distancia, 2)
+        parada["matched_by"] = "ref" if coincideElId else "distance"
+        return parada
+
+    @instrumentacion.medida()
+    def emparejarParadas(self, paradas: list):
+        """
+        Devuelve dos diccionarios por stop_id: la mejor colisión de cada
+        parada, y las paradas ambiguas (más de un nodo candidato) con
+        todos sus candidatos para revisarlas a mano.
+        """
+        colisiones = {}
+        ambiguas = {}
+
+        for p in paradas:
+            stop_id = p["stops"]["stop_id"]
+            candidatos = self.candidatos(
+                stop_id, float(p["stops"]["stop_lat"]), float(p["stops"]["stop_lon"]))
+
+            if not candidatos:
+                continue
+
+            # Cada colisión es una copia, así que se puede modificar sin
+            # afectar a otras paradas que coincidan con el mismo nodo
+            colisiones[stop_id] = self.colision(candidatos[0])
+            if len(candidatos) > 1:
+                ambiguas[stop_id] = [self.colision(c) for c in candidatos]
+
+        return colisiones, ambiguas
+
+
+class AlmacenOsmLocal:
+    """
+    Extracto de OSM (.osm, .osm.gz o .osm.bz2) cargado una sola vez en
+    memoria, para consultar paradas y rutas sin pasar por Overpass. Los
+    elementos se guardan con la misma forma que en las respuestas JSON de
+    Overpass ("out meta"), y las paradas de autobús se indexan por celda.
+    """
+
+    def __init__(self, rutaExtracto: str, soloTransporte=True):
+        """
+        @soloTransporte: Conservar solo paradas, andenes y relaciones de
+                         ruta, que es lo que usa este programa. Si es falso
+                         se conservan todos los nodos, vías y relaciones
+                         con etiquetas
+        """
+        self.ruta = rutaExtracto
+        self.soloTransporte = soloTransporte
+        self.nodos = {}
+        self.vias = {}
+        self.relaciones = {}
+        self.timestamp = time.strftime(
+            "%Y-%m-%dT%H:%M:%SZ", time.gmtime(os.path.getmtime(rutaExtracto)))
+
+        self.cargar()
+
+        self.indiceParadas = IndiceEspacial(
+            (id_, nodo["lat"], nodo["lon"])
+            for id_, nodo in self.nodos.items()
+            if self.esParadaDeAutobus(nodo.get("tags", {})))
+
+    @staticmethod
+    def esParadaDeAutobus(etiquetas: dict):
+        return etiquetas.get("highway") == "bus_stop"
+
+    @staticmethod
+    def esDeTransporte(etiquetas: dict):
+        return bool(
+            etiquetas.get("highway") == "bus_stop"
+            or etiquetas.get("public_transport")
+            or etiquetas.get("type") in ("route", "route_master"))
+
+    def abrir(self):
+        if self.ruta.endswith(".gz"):
+            return gzip.open(self.ruta, "rb")
+        elif self.ruta.endswith(".bz2"):
+            return bz2.open(self.ruta, "rb")
+        return open(self.ruta, "rb")
+
+    def cargar(self):
+        # Leemos el XML por partes y liberamos cada elemento al terminar
+        # de procesarlo, para no tener el árbol completo en memoria
+        with self.abrir() as f:
+            raiz = None
+            for evento, elemento in ET.iterparse(f, events=("start", "end")):
+                if evento == "start":
+                    if raiz is None:
+                        raiz = elemento
+                        self.timestamp = raiz.get("timestamp", self.timestamp)
+                    continue
+
+                if elemento.tag in ("node", "way", "relation"):
+                    self.agregarElemento(elemento)
+                    raiz.clear()
+
+    def agregarElemento(self, elemento):
+        etiquetas = {
+            etiqueta.get("k"): etiqueta.get("v")
+            for etiqueta in elemento.iter("tag")
+        }
+
+        if not etiquetas or (self.soloTransporte and not self.esDeTransporte(etiquetas)):
+            return
+
+        datos = {"type": elemento.tag, "id": int(elemento.get("id"))}
+        if elemento.tag == "node":
+            datos["lat"] = float(elemento.get("lat"))
+            datos["lon"] = float(elemento.get("lon"))
+
+        for atributo in ("timestamp", "version", "changeset", "user", "uid"):
+            valor = elemento.get(atributo)
+            if valor is not None:
+                datos[atributo] = int(valor) if atributo in ("version", "changeset", "uid") else valor
+
+        if elemento.tag == "way":
+            datos["nodes"] = [int(nd.get("ref")) for nd in elemento.iter("nd")]
+            self.vias[datos["id"]] = datos
+        elif elemento.tag == "relation":
+            datos["members"] = [
+                {"type": m.get("type"), "ref": int(m.get("ref")), "role": m.get("role", "")}
+                for m in elemento.iter("member")
+            ]
+            self.relaciones[datos["id"]] = datos
+        else:
+            self.nodos[datos["id"]] = datos
+
+        datos["tags"] = etiquetas
+
+    def paradasEnCaja(self, sur: float, oeste: float, norte: float, este: float):
+        """Equivale a node[highway=bus_stop](sur,oeste,norte,este)"""
+        return [self.nodos[id_] for id_ in self.indiceParadas.enCaja(sur, oeste, norte, este)]
+
+    def paradasEnCajas(self, cajas: list):
+        """Une las paradas de varias cajas sin repetir nodos"""
+        vistos = set()
+        elementos = []
+        for caja in cajas:
+            for nodo in self.paradasEnCaja(*caja):
+                if nodo["id"] not in vistos:
+                    vistos.add(nodo["id"])
+                    elementos.append(nodo)
+        return elementos
+
+    def paradasConEtiquetas(self, *claves):
+        """Paradas de autobús que tienen todas las etiquetas indicadas"""
+        return [
+            nodo for nodo in self.nodos.values()
+            if self.esParadaDeAutobus(nodo["tags"])
+            and all(nodo["tags"].get(clave) for clave in claves)
+        ]
+
+    def relacionesDeRuta(self, tipoRuta: str = "bus", conRef=True):
+        return [
+            relacion for relacion in self.relaciones.values()
+            if relacion["tags"].get("type") == "route"
+            and relacion["tags"].get("route") == tipoRuta
+            and (not conRef or relacion["tags"].get("ref"))
+        ]
+
+    def respuestaJson(self, elementos: list):
+        """Los elementos con la forma de una respuesta [out:json] de Overpass"""
+        return {
+            "version": 0.6,
+            "generator": "gtfs-menu (extracto local)",
+            "osm3s": {
+                "timestamp_osm_base": self.timestamp,
+                "copyright": CREDITOS_OSM,
+            },
+            "elements": elementos,
+        }
+
+    def respuestaXml(self, elementos: list):
+        """Los elementos con la forma de una respuesta XML de Overpass"""
+        xml = ET.Element("osm", {"version": "0.6", "generator": "gtfs-menu (extracto local)"})
+        ET.SubElement(xml, "note").text = CREDITOS_OSM
+        ET.SubElement(xml, "meta", {"osm_base": self.timestamp})
+
+        for elemento in elementos:
+            atributos = {
+                k: str(v) for k, v in elemento.items()
+                if k not in ("type", "tags", "nodes", "members")
+            }
+            nodo = ET.SubElement(xml, elemento["type"], atributos)
+            for ref in elemento.get("nodes", []):
+                ET.SubElement(nodo, "nd", {"ref": str(ref)})
+            for miembro in elemento.get("members", []):
+                ET.SubElement(nodo, "member", {k: str(v) for k, v in miembro.items()})
+            for k, v in elemento.get("tags", {}).items():
+                ET.SubElement(nodo, "tag", {"k": k, "v": v})
+
+        return ET.tostring(xml, encoding="unicode")
+
+
+def cargarExtractoOsmLocal(rutaExtracto: str):
+    """Carga el extracto y lo deja como fuente de datos de OSM. Con una
+    ruta vacía se vuelve a usar Overpass"""
+    global almacenOsmLocal
+
+    if not rutaExtracto:
+        almacenOsmLocal = None
+        return None
+
+    inicio = time.perf_counter()
+    almacenOsmLocal = AlmacenOsmLocal(os.path.expanduser(rutaExtracto))
+    print(f"Extracto cargado en {time.perf_counter() - inicio:.2f} s: "
+          f"{len(almacenOsmLocal.nodos)} nodos, {len(almacenOsmLocal.vias)} vías, "
+          f"{len(almacenOsmLocal.relaciones)} relaciones "
+          f"({len(almacenOsmLocal.indiceParadas)} paradas de autobús)")
+
+    return almacenOsmLocal
+
+
+class ClienteOverpass:
+    """
+    Cliente HTTP para los servidores Overpass. Mantiene una sesión con
+    conexiones persistentes por servidor, aplica timeouts y reintenta con
+    espera exponencial (más un poco de azar) los errores de conexión, las
+    respuestas 429/5xx y las de "rate_limited", respetando Retry-After.
+    También lleva la latencia y los fallos de cada servidor.
+
+    Los servidores se sondean todos a la vez (/status) y se ordenan según
+    su latencia y los slots que tienen libres; la clasificación se renueva
+    cada SEG_VIGENCIA_CLASIFICACION segundos.
+    """
+
+    def __init__(self, servidores: list = None,
+                 intentos: int = INTENTOS_MAX,
+                 descanso: float = SEG_DESCANSO_ENTRE_FALLOS,
+                 timeout=(SEG_TIMEOUT_CONEXION, SEG_TIMEOUT_LECTURA),
+                 vigenciaClasificacion: float = SEG_VIGENCIA_CLASIFICACION):
+        self.servidores = list(SERVIDORES_OSM_OVERPASS if servidores is None else servidores)
+        self.intentos = intentos
+        self.descanso = descanso
+        self.timeout = timeout
+        self.vigenciaClasificacion = vigenciaClasificacion
+        self.sesiones = {}
+        # url -> {"peticiones": ..., "fallos": ..., "latencia": promedio móvil en segundos}
+        self.estado = {}
+        # Resultado del último sondeo, del mejor servidor al peor
+        self.clasificacion = []
+        self.clasificadoEn = 0
+        self.candado = threading.Lock()
+        # Solo un hilo sondea a la vez; los demás esperan su clasificación
+        self.candadoClasificacion = threading.Lock()
+
+    def sesion(self, urlServidor: str):
+        with self.candado:
+            sesion = self.sesiones.get(urlServidor)
+            if sesion is None:
+                sesion = requests.Session()
+                adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+                sesion.mount("http://", adaptador)
+                sesion.mount("https://", adaptador)
+                self.sesiones[urlServidor] = sesion
+                self.estado[urlServidor] = {"peticiones": 0, "fallos": 0, "latencia": None}
+            return sesion
+
+    def registrar(self, urlServidor: str, segundos: float = None):
+        """Anota una petición: con su duración si tuvo éxito, o como fallo"""
+        with self.candado:
+            estado = self.estado[urlServidor]
+            estado["peticiones"] += 1
+            if segundos is None:
+                estado["fallos"] += 1
+            elif estado["latencia"] is None:
+                estado["latencia"] = segundos
+            else:
+                estado["latencia"] = 0.8 * estado["latencia"] + 0.2 * segundos
+
+    def espera(self, intento: int, respuesta=None):
+        """Segundos a esperar antes del siguiente intento"""
+        if respuesta is not None:
+            try:
+                return min(float(respuesta.headers["Retry-After"]), SEG_DESCANSO_MAX)
+            except (KeyError, ValueError):
+                pass
+        return min(self.descanso * 2 ** intento * random.uniform(0.5, 1.5), SEG_DESCANSO_MAX)
+
+    @staticmethod
+    def hayQueReintentar(respuesta, enStreaming: bool = False):
+        """
+        @enStreaming: El cuerpo aún no se descarga; solo se revisa el código
+                      de estado para no tener que leerlo completo
+        """
+        if respuesta.status_code == 429 or respuesta.status_code >= 500:
+            return True
+        return not enStreaming and "rate_limited" in respuesta.text[:2048]
+
+    def peticion(self, metodo: str, urlServidor: str, ruta: str, **kwargs):
+        """
+        Realiza la petición con reintentos. Devuelve la última respuesta
+        recibida (aunque sea un error del servidor), o None si no se pudo
+        conectar en ninguno de los intentos.
+        """
+        sesion = self.sesion(urlServidor)
+        url = f'{urlServidor.rstrip("/")}/{ruta}'
+        kwargs.setdefault("timeout", self.timeout)
+        respuesta = None
+
+        for intento in range(self.intentos + 1):
+            inicio = time.perf_counter()
+            try:
+                respuesta = sesion.request(metodo, url, **kwargs)
+            except requests.RequestException as e:
+                print(f"Error conectando con {urlServidor}: {e.__class__.__name__}")
+                respuesta = None
+                self.registrar(urlServidor)
+                instrumentacion.evento(
+                    "overpass", servidor=urlServidor, ruta=ruta, intento=intento,
+                    error=e.__class__.__name__, segundos=round(time.perf_counter() - inicio, 4))
+            else:
+                # En streaming el cuerpo aún no llega; sus bytes los cuenta quien lo lee
+                instrumentacion.evento(
+                    "overpass", servidor=urlServidor, ruta=ruta, intento=intento,
+                    estado=respuesta.status_code, segundos=round(time.perf_counter() - inicio, 4),
+                    bytes=None if kwargs.get("stream") else len(respuesta.content))
+                if not kwargs.get("stream"):
+                    instrumentacion.contar(f"overpass.bytes.{urlServidor}", len(respuesta.content))
+                if not self.hayQueReintentar(respuesta, kwargs.get("stream", False)):
+                    self.registrar(urlServidor, time.perf_counter() - inicio)
+                    return respuesta
+                self.registrar(urlServidor)
+
+            if intento < self.intentos:
+                espera = self.espera(intento, respuesta)
+                print(f"Reintentando en {espera:.1f} segundos...")
+                time.sleep(espera)
+
+        return respuesta
+
+    def get(self, urlServidor: str, ruta: str, **kwargs):
+        return self.peticion("GET", urlServidor, ruta, **kwargs)
+
+    def post(self, urlServidor: str, ruta: str, **kwargs):
+        return self.peticion("POST", urlServidor, ruta, **kwargs)
+
+    def sondear(self, urlServidor: str):
+        """Pregunta /status a un servidor y resume lo que contestó"""
+        resultado = {
+            "url": urlServidor,
+            "disponible": False,
+            "latencia": None,
+            "limite": None,
+            "slots": 0,
+            "espera": None,
+        }
+        inicio = time.perf_counter()
+        try:
+            respuesta = self.sesion(urlServidor).get(
+                f'{urlServidor.rstrip("/")}/status', timeout=SEG_TIMEOUT_SONDEO
+            )
+        except requests.RequestException:
+            return resultado
+        resultado["latencia"] = time.perf_counter() - inicio
+
+        if not respuesta.ok:
+            return resultado
+
+        # Rate limit: 2
+        # 1 slots available now.
+        # Slot available after: 2024-01-01T00:00:00Z, in 12 seconds.
+        limite = re.search(r"Rate limit: (\d+)", respuesta.text)
+        if limite is None:
+            return resultado
+        resultado["limite"] = int(limite.group(1))
+
+        slots = re.search(r"(\d+) slots? available now", respuesta.text)
+        resultado["slots"] = int(slots.group(1)) if slots else 0
+        esperas = [int(s) for s in re.findall(r"in (\d+) seconds", respuesta.text)]
+        resultado["espera"] = min(esperas) if esperas else None
+
+        resultado["disponible"] = resultado["limite"] == 0 or resultado["slots"] > 0
+        return resultado
+
+    @staticmethod
+    def puntaje(resultado: dict):
+        """Menor es mejor: la latencia repartida entre los slots libres"""
+        if not resultado["disponible"]:
+            return math.inf
+        slots = SLOTS_SIN_LIMITE if resultado["limite"] == 0 else resultado["slots"]
+        return resultado["latencia"] / min(slots, SLOTS_SIN_LIMITE)
+
+    def clasificarServidores(self):
+        """Sondea todos los servidores a la vez y los ordena del mejor al peor"""
+        if not self.servidores:
+            return []
+
+        with ThreadPoolExecutor(max_workers=len(self.servidores)) as ejecutor:
+            resultados = list(ejecutor.map(self.sondear, self.servidores))
+        resultados.sort(key=self.puntaje)
+
+        with self.candado:
+            self.clasificacion = resultados
+            self.clasificadoEn = time.time()
+        return resultados
+
+    def servidoresClasificados(self):
+        if time.time() - self.clasificadoEn > self.vigenciaClasificacion:
+            with self.candadoClasificacion:
+                # Si otro hilo la renovó mientras esperábamos, usamos la suya
+                if time.time() - self.clasificadoEn > self.vigenciaClasificacion:
+                    self.clasificarServidores()
+        return self.clasificacion
+
+    def mejorServidor(self):
+        """El servidor disponible con mejor puntaje, o None si no hay ninguno"""
+        for resultado in self.servidoresClasificados():
+            if resultado["disponible"]:
+                return resultado["url"]
+        return None
+
+    def descartar(self, urlServidor: str):
+        """Deja de usar un servidor hasta la siguiente clasificación"""
+        with self.candado:
+            for resultado in self.clasificacion:
+                if resultado["url"] == urlServidor:
+                    resultado["disponible"] = False
+            self.clasificacion.sort(key=self.puntaje)
+
+    def reporte(self):
+        print("%-45s %5s %5s %9s %10s %6s %10s" % (
+            "Servidor", "Disp.", "Slots", "Sondeo", "Peticiones", "Fallos", "Latencia"))
+        for resultado in self.servidoresClasificados():
+            urlServidor = resultado["url"]
+            estado = self.estado.get(urlServidor, {"peticiones": 0, "fallos": 0, "latencia": None})
+            sondeo = "-" if resultado["latencia"] is None else "%.3f s" % resultado["latencia"]
+            latencia = "-" if estado["latencia"] is None else "%.3f s" % estado["latencia"]
+            slots = "-" if resultado["limite"] in (0, None) else str(resultado["slots"])
+            print("%-45s %5s %5s %9s %10d %6d %10s" % (
+                urlServidor, "sí" if resultado["disponible"] else "no", slots, sondeo,
+                estado["peticiones"], estado["fallos"], latencia))
+
+
+def obtenerClienteOverpass():
+    global clienteOverpass
+    if clienteOverpass is None:
+        clienteOverpass = ClienteOverpass()
+    return clienteOverpass
+
+
 def cambiarUrlServidorOverpass(quitarActual=False):
+    """
+    Selecciona el mejor servidor según la clasificación del cliente.
+    @quitarActual: Descartar el servidor actual (p. ej. porque falló)
+    """
     global urlServidorOsmOverpass
-    urlActual = urlServidorOsmOverpass
-    huboExito = False # Para informar si se tuvo éxito en la selección y dejar que main() (o lo que sea) decida qué hacer
-    seleccionandoServidor = True # Bandera
+    cliente = obtenerClienteOverpass()
+
+    if quitarActual and urlServidorOsmOverpass:
+        cliente.descartar(urlServidorOsmOverpass)
+
+    urlNueva = cliente.mejorServidor()
+
+    # Peor de los casos, nos limitaron en todos los servidores :/
+    if urlNueva is None:
+        print("No se encontraron instancias disponibles por el momento.\n")
+        print("Intenta más tarde o agrega una nueva instancia al código fuente")
+        return False
+
+    if urlNueva != urlServidorOsmOverpass:
+        print(f'{urlNueva} ha sido seleccionado.')
+        urlServidorOsmOverpass = urlNueva
+
+    return True
+
+
+def normalizarPeticionOverpass(peticion: str):
+    """Quita los espacios que no cambian el significado de una petición
+    Overpass QL, para que dos peticiones equivalentes compartan caché"""
+    # Las partes entre comillas se dejan intactas
+    partes = re.split(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')""", peticion.strip())
+    for i in range(0, len(partes), 2):
+        partes[i] = re.sub(r"\s+", " ", partes[i])
+        partes[i] = re.sub(r"\s*([;(),\[\]=~:{}<>!])\s*", r"\1", partes[i])
+    return "".join(partes)
+
+
+class CacheOverpass:
+    """
+    Caché en disco de respuestas de Overpass. Cada respuesta se guarda con
+    una clave que depende de la petición normalizada y de la marca de tiempo
+    de los datos del servidor (timestamp_osm_base), así que si los datos del
+    servidor no cambian la respuesta sigue sirviendo aunque sea vieja.
+    Durante TTL_CACHE_OVERPASS ni siquiera se pregunta la marca de tiempo.
+    Al pasar de TAM_MAX_CACHE_OVERPASS se borran las menos usadas (LRU).
+    """
 
-    # Copiamos la lista
-    servidoresDisponibles = list(SERVIDORES_OSM_OVERPASS)
+    def __init__(self, ruta: str, ttl: float = TTL_CACHE_OVERPASS,
+                 tamMaximo: int = TAM_MAX_CACHE_OVERPASS):
+        self.ruta = ruta
+        self.ttl = ttl
+        self.tamMaximo = tamMaximo
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+        self.archivoIndice = os.path.join(ruta, "indice.json")
+        # clave -> {"peticion": hash, "osm_base": ..., "creado": ..., "usado": ..., "tam": ...}
+        self.entradas = {}
+        self.guardadoEn = 0
 
-    if quitarActual:
         try:
-            servidoresDisponibles.remove(urlActual)
-        except ValueError:
-            pass
+            with open(self.archivoIndice, encoding="utf-8") as f:
+                self.entradas = json.load(f)
+        except (OSError, ValueError):
+            self.entradas = {}
+
+    @staticmethod
+    def hashPeticion(peticion: str):
+        return hashlib.sha256(normalizarPeticionOverpass(peticion).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def clave(hashPeticion: str, osmBase: str):
+        return hashlib.sha256(f"{hashPeticion}\n{osmBase or ''}".encode("utf-8")).hexdigest()
+
+    def rutaRespuesta(self, clave: str):
+        return os.path.join(self.ruta, f"{clave}.resp")
+
+    def guardarIndice(self):
+        try:
+            os.makedirs(self.ruta, exist_ok=True)
+            archivoTemporal = f"{self.archivoIndice}.{os.getpid()}.tmp"
+            with open(archivoTemporal, "w", encoding="utf-8") as f:
+                json.dump(self.entradas, f)
+            os.replace(archivoTemporal, self.archivoIndice)
+            self.guardadoEn = time.time()
+        except OSError as e:
+            print(f"No se pudo guardar el índice de la caché de Overpass: {e}")
+
+    def abrirRespuesta(self, clave: str, binario: bool = False):
+        try:
+            if binario:
+                archivo = open(self.rutaRespuesta(clave), "rb")
+            else:
+                archivo = open(self.rutaRespuesta(clave), encoding="utf-8")
+        except OSError:
+            # El archivo desapareció; olvidamos la entrada
+            self.entradas.pop(clave, None)
+            return None
+
+        # Solo para el orden de desalojo; no hace falta escribir el índice
+        # en cada lectura (importa cuando se leen cientos seguidas)
+        self.entradas[clave]["usado"] = time.time()
+        if time.time() - self.guardadoEn > 5:
+            self.guardarIndice()
+        return archivo
+
+    def leer(self, clave: str):
+        archivo = self.abrirRespuesta(clave)
+        if archivo is None:
+            return None
+        with archivo:
+            return archivo.read()
+
+    def claveVigente(self, peticion: str, osmBase: str = None):
+        """
+        Sin osmBase, la clave de la respuesta más reciente de la petición si
+        aún no pasa el TTL. Con osmBase, la de la respuesta guardada para
+        esos mismos datos del servidor, tenga la edad que tenga. None si no hay.
+        """
+        hashPeticion = self.hashPeticion(peticion)
+
+        if osmBase is not None:
+            clave = self.clave(hashPeticion, osmBase)
+            if clave not in self.entradas:
+                clave = None
+        else:
+            ahora = time.time()
+            vigentes = [
+                (entrada["creado"], clave)
+                for clave, entrada in self.entradas.items()
+                if entrada["peticion"] == hashPeticion and ahora - entrada["creado"] < self.ttl
+            ]
+            clave = max(vigentes)[1] if vigentes else None
+
+        return clave
+
+    def buscar(self, peticion: str, osmBase: str = None, contarFallo=True):
+        """
+        La respuesta guardada (ver claveVigente), o None si no hay (y lo
+        cuenta como fallo).
+        @contarFallo: Si es False, no se cuenta el fallo. Para cuando una
+                      misma petición busca en la caché más de una vez; ver
+                      contarFallo
+        """
+        clave = self.claveVigente(peticion, osmBase)
+        respuesta = self.leer(clave) if clave is not None else None
+
+        if respuesta is not None:
+            self.aciertos += 1
+        elif contarFallo:
+            self.contarFallo()
+
+        return respuesta
+
+    def abrir(self, peticion: str, osmBase: str = None, contarFallo=True):
+        """Como buscar, pero devuelve el archivo abierto en binario, para
+        leer la respuesta por partes"""
+        clave = self.claveVigente(peticion, osmBase)
+        archivo = self.abrirRespuesta(clave, binario=True) if clave is not None else None
+
+        if archivo is not None:
+            self.aciertos += 1
+        elif contarFallo:
+            self.contarFallo()
+
+        return archivo
+
+    def contarFallo(self):
+        """Cuenta una petición que no se encontró en la caché. Las consultas
+        buscan primero por TTL y luego por osm_base (una vez por servidor),
+        pero eso es un solo fallo: lo cuentan ellas al ir al servidor"""
+        self.fallos += 1
+
+    def registrar(self, clave: str, peticion: str, osmBase: str, tam: int):
+        ahora = time.time()
+        self.entradas[clave] = {
+            "peticion": self.hashPeticion(peticion),
+            "osm_base": osmBase,
+            "creado": ahora,
+            "usado": ahora,
+            "tam": tam,
+        }
+        self.desalojar()
+        self.guardarIndice()
 
-    while seleccionandoServidor:
-        # Si hay servidores disponibles...
-        if servidoresDisponibles:
-            # Elegimos un nuevo servidor al azar
-            urlActual = random.choice(servidoresDisponibles)
-            print(f'Probando con {urlActual}...')
+    def guardar(self, peticion: str, osmBase: str, respuesta: str):
+        clave = self.clave(self.hashPeticion(peticion), osmBase)
+        # Escribimos a un temporal y lo renombramos para que otro proceso
+        # (o una ejecución interrumpida) nunca deje una respuesta a medias
+        rutaTemporal = f"{self.rutaRespuesta(clave)}.{os.getpid()}.tmp"
 
+        try:
+            os.makedirs(self.ruta, exist_ok=True)
+            with open(rutaTemporal, "w", encoding="utf-8") as f:
+                f.write(respuesta)
+            os.replace(rutaTemporal, self.rutaRespuesta(clave))
+        except OSError as e:
+            with contextlib.suppress(OSError):
+                os.remove(rutaTemporal)
+            print(f"No se pudo guardar la respuesta en la caché de Overpass: {e}")
+            return
+
+        self.registrar(clave, peticion, osmBase, len(respuesta.encode("utf-8")))
+
+    def guardarEnTrozos(self, peticion: str, osmBase: str, trozos):
+        """
+        Deja pasar los trozos (bytes) de una respuesta mientras los va
+        escribiendo en la caché. La respuesta solo se registra si llegó
+        completa y sin errores de Overpass.
+        """
+        clave = self.clave(self.hashPeticion(peticion), osmBase)
+        rutaTemporal = f"{self.rutaRespuesta(clave)}.{os.getpid()}.tmp"
+        completa = False
+        tam = 0
+        # Overpass avisa de los errores al principio (XML) o al final (remark)
+        cabeza = b""
+        cola = b""
+
+        os.makedirs(self.ruta, exist_ok=True)
+        try:
+            with open(rutaTemporal, "wb") as f:
+                for trozo in trozos:
+                    f.write(trozo)
+                    tam += len(trozo)
+                    if len(cabeza) < 2048:
+                        cabeza += trozo[:2048]
+                    cola = (cola + trozo)[-2048:]
+                    yield trozo
+            completa = b"runtime error" not in cabeza and b"runtime error" not in cola
+        finally:
+            if completa:
+                os.replace(rutaTemporal, self.rutaRespuesta(clave))
+                self.registrar(clave, peticion, osmBase, tam)
+            else:
+                os.remove(rutaTemporal)
+
+    def tamTotal(self):
+        return sum(entrada["tam"] for entrada in self.entradas.values())
+
+    def desalojar(self):
+        """Borra las respuestas usadas hace más tiempo hasta caber en tamMaximo"""
+        tamTotal = self.tamTotal()
+        for clave, entrada in sorted(self.entradas.items(), key=lambda e: e[1]["usado"]):
+            if tamTotal <= self.tamMaximo:
+                break
+            try:
+                os.remove(self.rutaRespuesta(clave))
+            except OSError:
+                pass
+            tamTotal -= entrada["tam"]
+            del self.entradas[clave]
+            self.desalojos += 1
+
+    def vaciar(self):
+        for clave in list(self.entradas):
             try:
-                # Preguntamos si no nos han limitado las peticiones de este servidor
-                respuesta = requests.get(f"{urlActual}/status")
+                os.remove(self.rutaRespuesta(clave))
+            except OSError:
+                pass
+        self.entradas = {}
+        self.guardarIndice()
+
+    def estadisticas(self):
+        return {
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "desalojos": self.desalojos,
+            "entradas": len(self.entradas),
+            "bytes": self.tamTotal(),
+        }
 
-                # Si el límite es 0 (ninguno), establecemos, salimos del bucle,
-                # e informamos del éxtio
-                if "Rate limit: 0" in respuesta.text:
-                    print(f'{urlActual} ha sido seleccionado.')
-                    urlServidorOsmOverpass = urlActual
-                    huboExito = True
-                    seleccionandoServidor = False
 
-                else:
-                    print(f'Puede que nos hayan limitado. Respuesta del servidor:\n')
-                    print(respuesta.text)
-                    print()
-                    servidoresDisponibles.remove(urlActual)
-                    print("Saltando...")
-
-            except Exception:
-                # Posiblemente error de conexión, no podemos proseguir
-                import traceback
-                print("Se ha producido un error intentando conectar. Detalles:")
-                print(traceback.format_exc())
-                print("No se pudo seleccionar un servidor.")
-                seleccionandoServidor = False
-                continue
+def obtenerCacheOverpass():
+    global cacheOverpass
+    if cacheOverpass is None:
+        cacheOverpass = CacheOverpass(RUTA_CACHE_OVERPASS)
+    return cacheOverpass
 
 
-        # Peor de los casos, nos limitaron en todos los servidores :/
-        else:
-            print("No se encontraron instancias disponibles por el momento.\n")
-            print("Intenta más tarde o agrega una nueva instancia al código fuente")
-            seleccionandoServidor = False
+# Marcas de tiempo de los datos de cada servidor: url -> (consultada en, timestamp)
+timestampsOsm = {}
+# Un candado por servidor, para que solo un hilo pregunte su marca de tiempo
+candadosTimestampOsm = defaultdict(threading.Lock)
+
+
+def obtenerTimestampOsm(urlServidor: str):
+    """La marca de tiempo de los datos del servidor (timestamp_osm_base),
+    o None si no se pudo obtener"""
+    consultada, timestamp = timestampsOsm.get(urlServidor, (0, None))
+
+    if time.time() - consultada > SEG_VIGENCIA_TIMESTAMP_OSM:
+        with candadosTimestampOsm[urlServidor]:
+            # Si otro hilo la consultó mientras esperábamos, usamos la suya
+            consultada, timestamp = timestampsOsm.get(urlServidor, (0, None))
+            if time.time() - consultada > SEG_VIGENCIA_TIMESTAMP_OSM:
+                respuesta = obtenerClienteOverpass().get(urlServidor, "timestamp")
+                timestamp = respuesta.text.strip() if respuesta is not None and respuesta.ok else None
+                timestampsOsm[urlServidor] = (time.time(), timestamp)
+
+    return timestamp
+
+
+@instrumentacion.medida()
+def consultaOverpass(peticion: str, forzarActualizacion: bool = None):
+    """
+    Realiza la petición en el servidor de Overpass seleccionado, pasando
+    primero por la caché en disco.
+    @forzarActualizacion: Ignorar la caché. Por defecto, lo que diga
+                          forzarActualizacionOverpass
+    """
+    if forzarActualizacion is None:
+        forzarActualizacion = forzarActualizacionOverpass
 
-    return huboExito
+    cache = obtenerCacheOverpass()
 
+    # Si la misma petición se hizo hace poco, ni siquiera preguntamos al servidor
+    if not forzarActualizacion:
+        respuesta = cache.buscar(peticion, contarFallo=False)
+        if respuesta is not None:
+            return respuesta
 
-def consultaOverpass(peticion: str):
     respuesta = None
+    cambiosDeServidor = 0
+    # Las peticiones forzadas no pasan por la caché, así que no son fallos
+    falloContado = forzarActualizacion
     while respuesta is None:
-        # Por si llamamos directamente a la función y el servidor aún no está definido
-        global urlServidorOsmOverpass
-        if not urlServidorOsmOverpass:
+        # Cada petición va al mejor servidor del momento (la clasificación se
+        # renueva sola); en el primer intento esto también lo define
+        global urlServidorOsmOverpass, limitePeticionesAlcanzado
+        if cambiosDeServidor == 0:
             # Si no hay servidor de OSM disponible, no tiene setido seguir
             hayServidor = cambiarUrlServidorOverpass()
             if not hayServidor:
+                if not falloContado:
+                    cache.contarFallo()
                 pausa("Presiona Entrar para volver...")
                 respuesta = ""
                 continue
 
-        urlPeticion = f'{urlServidorOsmOverpass}/interpreter'
+        # Si los datos del servidor no han cambiado desde que guardamos
+        # la respuesta, sigue sirviendo aunque haya pasado el TTL
+        osmBase = obtenerTimestampOsm(urlServidorOsmOverpass)
+        if not forzarActualizacion and osmBase is not None:
+            respuesta = cache.buscar(peticion, osmBase, contarFallo=False)
+            if respuesta is not None:
+                continue
+
+        if not falloContado:
+            cache.contarFallo()
+            falloContado = True
 
-        datos = requests.post(urlPeticion, data={"data": peticion})
+        datos = obtenerClienteOverpass().post(urlServidorOsmOverpass, "interpreter",
+                                              data={"data": peticion})
 
-        if "rate_limited" in datos.text:
-            print("Se alcanzó el límite de peticiones de esta IP, tenemos problemas...")
+        # Ya se reintentó en el mismo servidor; si sigue fallando, probamos otro
+        if datos is None or ClienteOverpass.hayQueReintentar(datos):
+            if datos is not None and "rate_limited" in datos.text[:2048]:
+                print("Se alcanzó el límite de peticiones de esta IP, tenemos problemas...")
             print("Intentando cambiar de servidor...")
-            limitePeticionesAlcanzado = not cambiarUrlServidorOverpass()
+            cambiosDeServidor += 1
+            limitePeticionesAlcanzado = (cambiosDeServidor >= len(obtenerClienteOverpass().servidores)
+                                         or not cambiarUrlServidorOverpass(quitarActual=True))
 
             if limitePeticionesAlcanzado:
                 print("No hubo éxito tratando de cambiar de servidor. Abortando...")
-                respuesta = ""
-                continue
+                respuesta = "" if datos is None else datos.text
+            continue
+
+        # Solo guardamos las respuestas completas
+        if datos.ok and "runtime error" not in datos.text[:2048]:
+            cache.guardar(peticion, osmBase, datos.text)
 
         respuesta = datos.text
     return respuesta
 
 
+def consultaOverpassEnTrozos(peticion: str, forzarActualizacion: bool = None,
+                             tamTrozo: int = TAM_TROZO_OVERPASS):
+    """
+    Como consultaOverpass, pero entrega la respuesta en trozos (bytes)
+    conforme llega del servidor o se lee de la caché, sin tenerla completa
+    en memoria. Para leerla, ver LectorJsonOverpass y LectorXmlOverpass.
+    """
+    global limitePeticionesAlcanzado
+    if forzarActualizacion is None:
+        forzarActualizacion = forzarActualizacionOverpass
+
+    cache = obtenerCacheOverpass()
+    cliente = obtenerClienteOverpass()
+    archivo = None if forzarActualizacion else cache.abrir(peticion, contarFallo=False)
+    # Las peticiones forzadas no pasan por la caché, así que no son fallos
+    falloContado = forzarActualizacion
+
+    for intento in range(len(cliente.servidores)):
+        if archivo is not None:
+            break
+
+        # El primer intento va al mejor servidor; los siguientes, a otro
+        if not cambiarUrlServidorOverpass(quitarActual=intento > 0):
+            break
+
+        osmBase = obtenerTimestampOsm(urlServidorOsmOverpass)
+        if not forzarActualizacion and osmBase is not None:
+            archivo = cache.abrir(peticion, osmBase, contarFallo=False)
+            if archivo is not None:
+                break
+
+        if not falloContado:
+            cache.contarFallo()
+            falloContado = True
+
+        datos = cliente.post(urlServidorOsmOverpass, "interpreter",
+                             data={"data": peticion}, stream=True)
+        if datos is None or ClienteOverpass.hayQueReintentar(datos, enStreaming=True):
+            print("Intentando cambiar de servidor...")
+            continue
+
+        with datos:
+            trozos = datos.iter_content(tamTrozo)
+            if datos.ok:
+                trozos = cache.guardarEnTrozos(peticion, osmBase, trozos)
+            yield from instrumentacion.medirTrozos(
+                f"consultaOverpassEnTrozos.{urlServidorOsmOverpass}", trozos)
+        return
+
+    if archivo is not None:
+        with archivo:
+            yield from instrumentacion.medirTrozos(
+                "consultaOverpassEnTrozos.cache", iter(lambda: archivo.read(tamTrozo), b""))
+        return
+
+    if not falloContado:
+        cache.contarFallo()
+    print("No hubo éxito tratando de cambiar de servidor. Abortando...")
+    limitePeticionesAlcanzado = True
+
+
+def datosDeRespuestaOverpass(respuesta: str):
+    """El JSON de una respuesta [out:json] de Overpass, o None si la
+    consulta falló: sin respuesta, un error en HTML o XML, o un "remark"
+    con un error de ejecución (p. ej. se acabó el tiempo)"""
+    if not respuesta:
+        return None
+    try:
+        datos = json.loads(respuesta)
+    except ValueError:
+        return None
+    if not isinstance(datos, dict) or "elements" not in datos:
+        return None
+    if "runtime error" in datos.get("remark", ""):
+        return None
+    return datos
+
+
+class LectorJsonOverpass:
+    """
+    Lee una respuesta [out:json] de Overpass conforme llega y entrega cada
+    elemento del arreglo "elements" en cuanto está completo, así que en
+    memoria solo hay un elemento (y un trozo) a la vez. Lo que viene antes
+    y después del arreglo (osm3s, remark) queda en `cabecera`.
+    @trozos: Iterable de bytes o de texto
+    """
+
+    def __init__(self, trozos):
+        self.trozos = iter(trozos)
+        self.cabecera = {}
+        self.decodificador = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+
+    def leer(self):
+        """El siguiente trozo como texto, o None si ya no hay"""
+        for trozo in self.trozos:
+            if isinstance(trozo, bytes):
+                trozo = self.utf8.decode(trozo)
+            if trozo:
+                return trozo
+        return None
+
+    def __iter__(self):
+        texto = ""
+
+        # Todo lo anterior al arreglo de elementos es la cabecera
+        inicio = None
+        while inicio is None:
+            inicio = re.search(r'"elements"\s*:\s*\[', texto)
+            if inicio is None:
+                trozo = self.leer()
+                if trozo is None:
+                    # Sin elementos (p. ej. un error); quizá sea JSON válido
+                    try:
+                        self.cabecera = json.loads(texto)
+                    except ValueError:
+                        pass
+                    return
+                texto += trozo
+
+        try:
+            self.cabecera = json.loads(texto[:inicio.start()].rstrip().rstrip(",") + "}")
+        except ValueError:
+            pass
+
+        pos = inicio.end()
+        while True:
+            # Saltamos los separadores; si se acaba el texto, pedimos más
+            while pos < len(texto) and texto[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(texto):
+                trozo = self.leer()
+                if trozo is None:
+                    return
+                texto, pos = trozo, 0
+                continue
+
+            if texto[pos] == "]":
+                break
+
+            try:
+                elemento, pos = self.decodificador.raw_decode(texto, pos)
+            except ValueError:
+                # El elemento aún no llega completo
+                trozo = self.leer()
+                if trozo is None:
+                    return
+                texto, pos = texto[pos:] + trozo, 0
+                continue
+
+            yield elemento
+
+            # No dejamos crecer lo ya leído
+            if pos > TAM_TROZO_OVERPASS:
+                texto, pos = texto[pos:], 0
+
+        # Lo que sigue al arreglo (p. ej. "remark" si hubo un error)
+        resto = texto[pos + 1:]
+        trozo = self.leer()
+        while trozo is not None:
+            resto += trozo
+            trozo = self.leer()
+        resto = resto.strip().lstrip(",").rstrip().rstrip("}")
+        if resto:
+            try:
+                self.cabecera.update(json.loads("{" + resto + "}"))
+            except ValueError:
+                pass
+
+
+class LectorXmlOverpass:
+    """
+    Lee una respuesta XML de Overpass conforme llega y entrega cada elemento
+    (node, way, relation) como ET.Element en cuanto se cierra; después se
+    descarta. Los créditos (note), la marca de tiempo (meta) y los errores
+    (remark) quedan en `cabecera` con las mismas claves que en JSON.
+    @trozos: Iterable de bytes o de texto
+    """
+
+    def __init__(self, trozos):
+        self.trozos = trozos
+        self.cabecera = {}
+
+    def __iter__(self):
+        analizador = ET.XMLPullParser(events=("start", "end"))
+        profundidad = 0
+        raiz = None
+
+        for trozo in self.trozos:
+            analizador.feed(trozo)
+            for evento, elemento in analizador.read_events():
+                if evento == "start":
+                    profundidad += 1
+                    if raiz is None:
+                        raiz = elemento
+                    continue
+
+                profundidad -= 1
+                # Solo nos interesan los hijos directos de <osm>
+                if profundidad != 1:
+                    continue
+
+                if elemento.tag == "note":
+                    self.cabecera.setdefault("osm3s", {})["copyright"] = elemento.text or ""
+                elif elemento.tag == "meta":
+                    self.cabecera.setdefault("osm3s", {})["timestamp_osm_base"] = elemento.get("osm_base")
+                elif elemento.tag == "remark":
+                    self.cabecera["remark"] = (elemento.text or "").strip()
+                else:
+                    yield elemento
+
+                raiz.remove(elemento)
+
+        analizador.close()
+
+
 def dividirRuta(ruta):
     componentesRuta = []
     texto = str()
@@ -464,39 +3937,109 @@ def dividirRuta(ruta):
     return componentesRuta
 
 
+@instrumentacion.medida()
 def ordenarParadas(horarioParadas):
-    # Obtenemos las paradas asociadas al id de parada
-    paradas = [stops[x["stop_id"]] for x in horarioParadas]
-    # Mezclamos ambos datos en una lista con ambos diccionarios (es más útil tener los datos de paradas juntos)
-    paradas = [{"stops": x, "stop_times": y}
-               for x, y in zip(paradas, horarioParadas)]
-    # Ordenamos
-    paradas = sorted(paradas, key=lambda p: int(
-        p["stop_times"]["stop_sequence"]))
+    # horarioParadas es el rango de filas del viaje en stop_times,
+    # que ya vienen ordenadas por stop_sequence
+    # Mezclamos los datos de la parada con su horario (es más útil tener los datos de paradas juntos)
+    stops = conjuntoGtfs.stops
+    stop_times = conjuntoGtfs.stop_times
+    paradas = [{"stops": stops[stop_times.idParada(i)], "stop_times": stop_times.fila(i)}
+               for i in horarioParadas]
     return paradas
 
 
+@instrumentacion.medida()
 def ajustarHorariosDeParadas(paradas: list):
     # Obtenemos una copia de la lista
     paradas = list(paradas)
 
-    # Obtenemos la diferencia entre la hora de la primera parada y 00:00 (puede no haberla)
-    horaIniStr = [int(x) for x in paradas[0]
-                  ["stop_times"]["arrival_time"].split(":")]
-    delta = datetime.timedelta(seconds=float(
-        (horaIniStr[0] * 60 * 60) + (horaIniStr[1] * 60) + horaIniStr[2]))
+    # Obtenemos la diferencia entre la hora de la primera parada con hora y 00:00 (puede no haberla)
+    delta = next(
+        (p["stop_times"].arrival_time for p in paradas
+         if p["stop_times"].arrival_time != SIN_HORA),
+        0)
 
-    # Quitamos la delta que pudiese tener (si las paradas comienzan en 00:00 no se modificará nada)
+    # Quitamos la delta que pudiese tener (si las paradas comienzan en 00:00 no se modificará nada).
+    # Las paradas sin hora (SIN_HORA) se quedan sin hora
     for i, p in enumerate(list(paradas)):
         p = p["stop_times"]
-        hora = datetime.datetime.strptime(
-            p["arrival_time"], "%H:%M:%S") - delta
-        p["arrival_time"] = hora.strftime("%H:%M:%S")
+        if p.arrival_time != SIN_HORA:
+            p = p._replace(arrival_time=p.arrival_time - delta)
         paradas[i]["stop_times"] = p
 
     return paradas
 
 
+def peticionColisionesDeParadas(paradas: list, radio=RADIO_BUSQ_PREDET, mostrarProgreso=False):
+    """
+    Arma la petición Overpass QL que busca las paradas de OSM alrededor
+    de cada parada. Devuelve la petición y las cajas (norte, este, sur, oeste)
+    que la componen, para consultar el extracto local.
+    """
+    peticionQl  = "[out:json];"
+    peticionQl  += "("
+    cajas = []
+
+    for i, p in enumerate(paradas, 1):
+        if mostrarProgreso:
+            print(f'Procesando parada {i} - {p["stops"]["stop_name"]}...')
+
+        # Por si acaso redondeemos X, Y, y el radio a 6 dígitos
+        latitud = round(float(p["stops"]["stop_lat"]), NUM_PRECISION_COORD)
+        longitud = round(float(p["stops"]["stop_lon"]), NUM_PRECISION_COORD)
+        radio = round(float(radio), NUM_PRECISION_COORD)
+
+        norte = round(latitud - radio, NUM_PRECISION_COORD)
+        sur = round(latitud + radio, NUM_PRECISION_COORD)
+        este = round(longitud - radio, NUM_PRECISION_COORD)
+        oeste = round(longitud + radio, NUM_PRECISION_COORD)
+        # ref = ref.split("_", 1)[1]
+        peticionQl += 'node'
+        peticionQl += '[highway=bus_stop]'
+        # peticionQl += f'["ref"~"{ref}$"]'
+        peticionQl += f'({norte},{este},{sur},{oeste});'
+        cajas.append((norte, este, sur, oeste))
+
+        if mostrarProgreso:
+            print(f'Parada {i} - {p["stops"]["stop_name"]} procesada')
+
+    peticionQl += ");"
+    peticionQl += "out meta;"
+
+    return peticionQl, cajas
+
+
+def resultadosDeColisiones(datos: dict, paradas: list,
+                           distanciaMaxima: float = DIST_MAX_COLISION_METROS):
+    """Empareja las paradas con los nodos de una respuesta de Overpass"""
+    resultados = {
+        "collisions": {},
+        "ambiguous": {},
+    }
+
+    # Créditos de los datos
+    resultados["credits"] = datos.get("osm3s", {}).get("copyright", "")
+    # Generamos una marca de tiempo por defecto por si no hubiese
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    # Obtenemos la marca de tiempo, reemplazando con
+    # la hora actual si no hay
+    resultados["timestamp"] = datos.get("osm3s", {}).get("timestamp_osm_base", timestamp)
+
+    if datos.get("elements"):
+        # Indexamos los nodos una sola vez y emparejamos cada parada
+        # solo contra los nodos de su celda y los que tengan su ref
+        emparejador = EmparejadorDeParadasOsm(datos["elements"], distanciaMaxima)
+        colisiones, ambiguas = emparejador.emparejarParadas(paradas)
+        # Guardamos cada coincidencia en una diccionario por
+        # id de parada para facilitar identificación posterior
+        resultados["collisions"] = colisiones
+        resultados["ambiguous"] = ambiguas
+
+    return resultados
+
+
+@instrumentacion.medida()
 def verificarColisionesDeParadasGtfsConOsm(
             paradas: list,
             ruta: dict,
@@ -505,10 +4048,12 @@ def verificarColisionesDeParadasGtfsConOsm(
             generarReporte = False,
             incluirRespuestaCruda = False,
             pausarAlFinalizar = True,
-            mostrarProgreso = True):
+            mostrarProgreso = True,
+            distanciaMaxima: float = DIST_MAX_COLISION_METROS):
     global limitePeticionesAlcanzado
     # Si no hay servidor de OSM disponible, no tiene setido seguir
-    hayServidor = cambiarUrlServidorOverpass()
+    # (a menos que usemos un extracto local)
+    hayServidor = almacenOsmLocal is not None or cambiarUrlServidorOverpass()
 
     if not hayServidor:
         pausa("Presiona Entrar para volver...")
@@ -524,108 +4069,422 @@ def verificarColisionesDeParadasGtfsConOsm(
         resultados = {
             "coord": "",
             "collisions": {},
+            "ambiguous": {},
             "credits": "",
             "timestamp": "",
         }
 
-        peticionQl  = "[out:json];"
-        peticionQl  += "("
-
-        for i, p in enumerate(paradas, 1):
-            if mostrarProgreso:
-                print(f'Procesando parada {i} - {p["stops"]["stop_name"]}...')
-
-            # Por si acaso redondeemos X, Y, y el radio a 6 dígitos
-            latitud = round(float(p["stops"]["stop_lat"]), NUM_PRECISION_COORD)
-            longitud = round(float(p["stops"]["stop_lon"]), NUM_PRECISION_COORD)
-            radio = round(float(radio), NUM_PRECISION_COORD)
-
-            norte = round(latitud - radio, NUM_PRECISION_COORD)
-            sur = round(latitud + radio, NUM_PRECISION_COORD)
-            este = round(longitud - radio, NUM_PRECISION_COORD)
-            oeste = round(longitud + radio, NUM_PRECISION_COORD)
-            # ref = ref.split("_", 1)[1]
-            peticionQl += 'node'
-            peticionQl += '[highway=bus_stop]'
-            # peticionQl += f'["ref"~"{ref}$"]'
-            peticionQl += f'({norte},{este},{sur},{oeste});'
-
-            if mostrarProgreso:
-                print(f'Parada {i} - {p["stops"]["stop_name"]} procesada')
-        
-        peticionQl += ");"
-        peticionQl += "out meta;"
+        peticionQl, cajas = peticionColisionesDeParadas(paradas, radio, mostrarProgreso)
+
+        try:
+            if almacenOsmLocal is not None:
+                # Misma forma de respuesta, pero sin salir de la máquina
+                datos = almacenOsmLocal.respuestaJson(almacenOsmLocal.paradasEnCajas(cajas))
+                respuesta = json.dumps(datos) if incluirRespuestaCruda else ""
+            else:
+                print('Realizando petición...')
+                # Procesamos la respuesta JSON
+                respuesta = consultaOverpass(peticionQl)
+                datos = datosDeRespuestaOverpass(respuesta)
+        except ConnectionError:
+            respuesta = ""
+            datos = None
+            import traceback
+            print('Error:')
+            print(traceback.format_exc())
+
+        # Sin respuesta no sabemos qué hay en OSM: no es lo mismo que no haya nada
+        if datos is None:
+            print("No se pudieron consultar las paradas en OSM: ningún servidor "
+                  "devolvió una respuesta válida.")
+            if pausarAlFinalizar:
+                pausa()
+            return None
+
+        resultados.update(resultadosDeColisiones(datos, paradas, distanciaMaxima))
+
+        if mostrarProgreso and resultados["ambiguous"]:
+            print(f'{len(resultados["ambiguous"])} paradas tienen más de un nodo candidato en OSM')
+
+        if incluirRespuestaCruda:
+            resultados["response"] = respuesta
+
+        if generarReporte:
+            print("Intentando guardar resultados...")
+            with open(rutaResultadosColisiones, "w", encoding="utf-8") as f:
+                f.write(json.dumps(resultados, indent=2))
+
+            print(f"Resultados guardados en {rutaResultadosColisiones}")
+        else:
+            return resultados
+
+    except (KeyboardInterrupt, EOFError):
+        print("\nProceso interrumpido.\n")
+
+    if pausarAlFinalizar:
+        pausa()
+
+
+class CubetaDeFichas:
+    """
+    Limitador de peticiones (token bucket): se pueden gastar hasta
+    `capacidad` fichas de golpe y se recuperan `tasa` fichas por segundo.
+    Solo se usa desde un mismo bucle de asyncio.
+    """
+
+    def __init__(self, capacidad: float, tasa: float):
+        self.capacidad = capacidad
+        self.tasa = tasa
+        self.fichas = capacidad
+        self.ultimaRecarga = time.monotonic()
+
+    def recargar(self):
+        ahora = time.monotonic()
+        self.fichas = min(self.capacidad, self.fichas + (ahora - self.ultimaRecarga) * self.tasa)
+        self.ultimaRecarga = ahora
+
+    async def tomar(self):
+        while True:
+            self.recargar()
+            if self.fichas >= 1:
+                self.fichas -= 1
+                return
+            await asyncio.sleep((1 - self.fichas) / self.tasa)
+
+
+class MotorOverpassAsincrono:
+    """
+    Hace muchas consultas de Overpass a la vez, repartidas entre todos los
+    servidores disponibles. Cada servidor tiene su cubeta de fichas y un
+    semáforo con sus slots, para no pasarnos de lo que permite cada
+    instancia. Las peticiones HTTP son las del ClienteOverpass (con sus
+    reintentos), corriendo en hilos con asyncio.to_thread.
+    """
+
+    def __init__(self, cliente: ClienteOverpass = None,
+                 peticionesPorSegundo: float = None):
+        self.cliente = cliente or obtenerClienteOverpass()
+        self.peticionesPorSegundo = peticionesPorSegundo or PETICIONES_POR_SEG_SERVIDOR
+        self.cubetas = {}
+        self.semaforos = {}
+        self.enCurso = {}
+        # Servidores que fallaron durante este lote
+        self.caidos = set()
+        # Peticiones idénticas que ya se están haciendo: hash -> tarea
+        self.pendientes = {}
+
+    def prepararServidor(self, resultado: dict):
+        urlServidor = resultado["url"]
+        if urlServidor not in self.cubetas:
+            slots = resultado["slots"] if resultado["limite"] else SLOTS_SIN_LIMITE
+            slots = max(1, min(slots, SLOTS_SIN_LIMITE))
+            self.cubetas[urlServidor] = CubetaDeFichas(slots, self.peticionesPorSegundo)
+            self.semaforos[urlServidor] = asyncio.Semaphore(slots)
+            self.enCurso[urlServidor] = 0
+
+    async def elegirServidor(self, descartados: set):
+        """
+        El servidor disponible menos ocupado (a igual ocupación, el mejor
+        clasificado). Queda apartado para la petición hasta liberarServidor.
+        """
+        clasificacion = await asyncio.to_thread(self.cliente.servidoresClasificados)
+        candidatos = []
+        for posicion, resultado in enumerate(clasificacion):
+            if (resultado["disponible"] and resultado["url"] not in descartados
+                    and resultado["url"] not in self.caidos):
+                self.prepararServidor(resultado)
+                ocupacion = self.enCurso[resultado["url"]] / self.cubetas[resultado["url"]].capacidad
+                candidatos.append((ocupacion, posicion, resultado["url"]))
+        if not candidatos:
+            return None
+
+        urlServidor = min(candidatos)[2]
+        self.enCurso[urlServidor] += 1
+        return urlServidor
+
+    def liberarServidor(self, urlServidor: str):
+        self.enCurso[urlServidor] -= 1
+
+    async def consultarEnServidor(self, peticion: str, urlServidor: str):
+        await self.cubetas[urlServidor].tomar()
+        async with self.semaforos[urlServidor]:
+            # Mientras esperábamos turno el servidor pudo haber fallado
+            if urlServidor in self.caidos:
+                return None
+            return await asyncio.to_thread(
+                self.cliente.post, urlServidor, "interpreter", data={"data": peticion}
+            )
+
+    @instrumentacion.medida()
+    async def consultar(self, peticion: str, forzarActualizacion: bool = None):
+        """Como consultaOverpass, pero sin bloquear el bucle"""
+        if forzarActualizacion is None:
+            forzarActualizacion = forzarActualizacionOverpass
+
+        cache = obtenerCacheOverpass()
+        if not forzarActualizacion:
+            respuesta = cache.buscar(peticion, contarFallo=False)
+            if respuesta is not None:
+                return respuesta
+
+        # Si otra tarea ya está haciendo la misma petición, la esperamos
+        clave = CacheOverpass.hashPeticion(peticion)
+        if clave in self.pendientes:
+            return await asyncio.shield(self.pendientes[clave])
+
+        tarea = asyncio.ensure_future(self.consultarSinCache(peticion, forzarActualizacion))
+        self.pendientes[clave] = tarea
+        try:
+            return await tarea
+        finally:
+            del self.pendientes[clave]
+
+    async def consultarSinCache(self, peticion: str, forzarActualizacion: bool):
+        cache = obtenerCacheOverpass()
+        descartados = set()
+        # Las peticiones forzadas no pasan por la caché, así que no son fallos
+        falloContado = forzarActualizacion
+
+        while True:
+            urlServidor = await self.elegirServidor(descartados)
+            if urlServidor is None:
+                if not falloContado:
+                    cache.contarFallo()
+                print("No quedan servidores Overpass disponibles.")
+                return ""
+
+            try:
+                osmBase = await asyncio.to_thread(obtenerTimestampOsm, urlServidor)
+                if not forzarActualizacion and osmBase is not None:
+                    respuesta = cache.buscar(peticion, osmBase, contarFallo=False)
+                    if respuesta is not None:
+                        return respuesta
+
+                if not falloContado:
+                    cache.contarFallo()
+                    falloContado = True
+
+                datos = await self.consultarEnServidor(peticion, urlServidor)
+            finally:
+                self.liberarServidor(urlServidor)
+
+            # El cliente ya reintentó; lo descartamos y probamos con otro
+            if datos is None or ClienteOverpass.hayQueReintentar(datos):
+                descartados.add(urlServidor)
+                self.caidos.add(urlServidor)
+                self.cliente.descartar(urlServidor)
+                continue
+
+            if datos.ok and "runtime error" not in datos.text[:2048]:
+                cache.guardar(peticion, osmBase, datos.text)
+            return datos.text
+
+    async def consultarEnLote(self, peticiones: list):
+        """Hace todas las peticiones y va entregando (índice de la petición,
+        respuesta) conforme llegan"""
+        async def consultarConIndice(indice: int, peticion: str):
+            return indice, await self.consultar(peticion)
+
+        tareas = [
+            asyncio.ensure_future(consultarConIndice(i, peticion))
+            for i, peticion in enumerate(peticiones)
+        ]
+        try:
+            for tarea in asyncio.as_completed(tareas):
+                yield await tarea
+        finally:
+            for tarea in tareas:
+                tarea.cancel()
+
+    async def colisionesDeViaje(self, ruta: dict, viaje: dict,
+                                radio=RADIO_BUSQ_PREDET,
+                                distanciaMaxima: float = DIST_MAX_COLISION_METROS):
+        """Los resultados son None si la consulta falló: no es lo mismo que
+        un área sin paradas de OSM"""
+        paradas = ordenarParadas(conjuntoGtfs.stop_times[viaje["trip_id"]])
+        peticionQl, cajas = peticionColisionesDeParadas(paradas, radio)
+
+        if almacenOsmLocal is not None:
+            datos = almacenOsmLocal.respuestaJson(almacenOsmLocal.paradasEnCajas(cajas))
+        else:
+            datos = datosDeRespuestaOverpass(await self.consultar(peticionQl))
+            if datos is None:
+                return ruta, viaje, None
+
+        return ruta, viaje, resultadosDeColisiones(datos, paradas, distanciaMaxima)
+
+    async def colisionesEnLote(self, pares: list, **kwargs):
+        """
+        Verifica las colisiones de una lista de pares (ruta, viaje) y va
+        entregando (ruta, viaje, resultados) conforme terminan. Ver
+        colisionesDeViaje.
+        """
+        tareas = [
+            asyncio.ensure_future(self.colisionesDeViaje(ruta, viaje, **kwargs))
+            for ruta, viaje in pares
+        ]
+        try:
+            for tarea in asyncio.as_completed(tareas):
+                yield await tarea
+        finally:
+            for tarea in tareas:
+                tarea.cancel()
+
+
+def iterarEnHilo(crearGenerador):
+    """
+    Recorre un generador asíncrono desde código síncrono: corre su bucle de
+    asyncio en otro hilo y entrega los resultados conforme van llegando.
+    @crearGenerador: Función sin argumentos que devuelve el generador
+    """
+    resultados = queue.Queue()
+    fin = object()
+    errores = []
+
+    async def recolectar():
+        async for resultado in crearGenerador():
+            resultados.put(resultado)
+
+    def correr():
+        try:
+            asyncio.run(recolectar())
+        except Exception as e:
+            errores.append(e)
+        finally:
+            resultados.put(fin)
+
+    threading.Thread(target=correr, daemon=True).start()
+
+    while True:
+        resultado = resultados.get()
+        if resultado is fin:
+            break
+        yield resultado
+
+    if errores:
+        raise errores[0]
 
-        try:
-            print('Realizando petición...')
-            # Procesamos la respuesta JSON
-            respuesta = consultaOverpass(peticionQl)
-            datos = json.loads(respuesta)
-        except ConnectionError:
-            respuesta = ""
-            datos = {}
-            import traceback
-            print('Error:')
-            print(traceback.format_exc())
 
-        # Créditos de los datos
-        osmCredits = datos.get("osm3s", {}).get("copyright", "")
-        # Generamos una marca de tiempo por defecto por si no hubiese
-        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-        # Obtenemos la marca de tiempo, reemplazando con
-        # la hora actual si no hay
-        timestamp = datos.get("osm3s", {}).get("timestamp_osm_base", timestamp)
-
-        if datos.get("elements"):
-            for paradaGtfs in paradas:
-                for nodo in datos["elements"]:
-                    nodo = dict(nodo)
-                    lat = float(paradaGtfs["stops"]["stop_lat"])
-                    lon = float(paradaGtfs["stops"]["stop_lon"])
-                    parada = {"attrib": {}, "tags": {}}
-                    parada["tags"] = nodo.pop("tags", {})
-                    parada["attrib"] = nodo
-
-                    esCercanaLaLat = math.isclose(lat, parada["attrib"]["lat"])
-                    esCercanaLaLon = math.isclose(lon, parada["attrib"]["lon"])
-                    sonCercanasLasCoord = esCercanaLaLat and esCercanaLaLon
-                    if sonCercanasLasCoord or \
-                            paradaGtfs["stops"]["stop_id"] == parada["tags"].get("ref"):
-                        # Guardamos cada coincidencia en una diccionario por
-                        # id de parada para facilitar identificación posterior
-                        resultados["collisions"][paradaGtfs["stops"]["stop_id"]] = parada
-                    # La razón por la que no podemos verificar colisiones indirectas
-                    # es porque no sabemos a qué parada pertenecen dichas colisiones
-                    # Sería factible acumular todas las colisiones indirectas bajo una
-                    # sola etiqueta para decidir qué hacer con cada una por separado
-                    #     resultados["collisions"]["direct"].append(parada)
-                    # else:
-                    #     resultados["collisions"]["indirect"].append(parada)
-
-        resultados.update({
-            "credits": osmCredits,
-            "timestamp": timestamp,
-        })
+def verificarColisionesEnLote(pares: list, **kwargs):
+    """
+    Versión para código síncrono de MotorOverpassAsincrono.colisionesEnLote;
+    entrega (ruta, viaje, resultados) conforme van llegando.
+    """
+    return iterarEnHilo(lambda: MotorOverpassAsincrono().colisionesEnLote(pares, **kwargs))
 
-        if incluirRespuestaCruda:
-            resultados["response"] = respuesta
 
-        if generarReporte:
-            print("Intentando guardar resultados...")
-            with open(rutaResultadosColisiones, "w", encoding="utf-8") as f:
-                f.write(json.dumps(resultados, indent=2))
+def consultarOverpassEnLote(peticiones: list):
+    """Hace varias peticiones a la vez; entrega (índice de la petición,
+    respuesta) conforme llegan"""
+    return iterarEnHilo(lambda: MotorOverpassAsincrono().consultarEnLote(peticiones))
 
-            print(f"Resultados guardados en {rutaResultadosColisiones}")
-        else:
-            return resultados
 
+@instrumentacion.medida()
+def colisionesPorArea(paradas: list,
+                      radio=RADIO_BUSQ_PREDET,
+                      distanciaMaxima: float = DIST_MAX_COLISION_METROS,
+                      tamArea: float = TAM_AREA_COLISIONES_GRADOS):
+    """
+    Como verificarColisionesDeParadasGtfsConOsm, pero para muchas paradas:
+    se agrupan por áreas de tamArea grados y se hace una sola consulta por
+    área (la caja que cubre sus paradas), en lugar de una caja por parada.
+    Devuelve las colisiones y las paradas ambiguas por stop_id, y los
+    stop_id de las áreas cuya consulta falló: de esas paradas no se sabe
+    si ya existen en OSM, así que no hay que tratarlas como nuevas.
+    """
+    areas = {}
+    for p in paradas:
+        lat = float(p["stops"]["stop_lat"])
+        lon = float(p["stops"]["stop_lon"])
+        area = (math.floor(lat / tamArea), math.floor(lon / tamArea))
+        areas.setdefault(area, []).append((lat, lon, p["stops"]["stop_id"]))
+
+    # (sur, oeste, norte, este) de cada área
+    cajas = []
+    for puntos in areas.values():
+        latitudes = [lat for lat, _, _ in puntos]
+        longitudes = [lon for _, lon, _ in puntos]
+        cajas.append(tuple(round(x, NUM_PRECISION_COORD) for x in (
+            min(latitudes) - radio, min(longitudes) - radio,
+            max(latitudes) + radio, max(longitudes) + radio,
+        )))
+
+    sinConsultar = set()
+    if almacenOsmLocal is not None:
+        elementos = almacenOsmLocal.paradasEnCajas(cajas)
+    else:
+        peticiones = [
+            f"[out:json];node[highway=bus_stop]({sur},{oeste},{norte},{este});out meta;"
+            for sur, oeste, norte, este in cajas
+        ]
+        puntosDeArea = list(areas.values())
+        areasFallidas = 0
+        porId = {}
+        for indice, respuesta in consultarOverpassEnLote(peticiones):
+            datos = datosDeRespuestaOverpass(respuesta)
+            if datos is None:
+                areasFallidas += 1
+                sinConsultar.update(stop_id for _, _, stop_id in puntosDeArea[indice])
+                continue
+            for elemento in datos["elements"]:
+                porId[elemento["id"]] = elemento
+        elementos = list(porId.values())
+
+        if areasFallidas:
+            print(f"La consulta de {areasFallidas} de {len(cajas)} áreas falló "
+                  f"({len(sinConsultar)} paradas sin verificar)")
+
+    print(f"{len(cajas)} áreas consultadas, {len(elementos)} paradas encontradas en OSM")
+
+    emparejador = EmparejadorDeParadasOsm(elementos, distanciaMaxima)
+    colisiones, ambiguas = emparejador.emparejarParadas(
+        [p for p in paradas if p["stops"]["stop_id"] not in sinConsultar])
+    return colisiones, ambiguas, sinConsultar
+
+
+def viajesRepresentativos(ruta: dict):
+    """Un viaje por cada secuencia distinta de paradas de la ruta"""
+    stop_times = conjuntoGtfs.stop_times
+    vistos = set()
+    viajes = []
+    for viaje in sorted(conjuntoGtfs.trips.get(ruta["route_id"], {}).values(), key=lambda x: x["trip_id"]):
+        secuencia = tuple(stop_times.idParada(i) for i in stop_times[viaje["trip_id"]])
+        if secuencia and secuencia not in vistos:
+            vistos.add(secuencia)
+            viajes.append(viaje)
+    return viajes
+
+
+def verificarColisionesDeAgencia(agencia: dict, rutas: list):
+    """Verifica las colisiones de todas las rutas y guarda un reporte"""
+    pares = [(ruta, viaje) for ruta in rutas for viaje in viajesRepresentativos(ruta)]
+    rutaReporte = os.path.expanduser(f'~/Resultados_colisiones_{agencia["agency_id"]}.json')
+    reporte = {}
+
+    print(f"Verificando {len(pares)} viajes de {len(rutas)} rutas...")
+    inicio = time.perf_counter()
+    try:
+        for i, (ruta, viaje, resultados) in enumerate(verificarColisionesEnLote(pares), 1):
+            if resultados is None:
+                print("[%d/%d] %-12s %-40s sin respuesta de Overpass" % (
+                    i, len(pares), ruta["route_short_name"], viaje["trip_headsign"][:40]))
+                reporte[viaje["trip_id"]] = {"route_id": ruta["route_id"], "error": "sin respuesta de Overpass"}
+                continue
+            print("[%d/%d] %-12s %-40s %4d colisiones, %d ambiguas" % (
+                i, len(pares), ruta["route_short_name"], viaje["trip_headsign"][:40],
+                len(resultados["collisions"]), len(resultados["ambiguous"])))
+            reporte[viaje["trip_id"]] = dict(resultados, route_id=ruta["route_id"])
     except (KeyboardInterrupt, EOFError):
         print("\nProceso interrumpido.\n")
 
-    if pausarAlFinalizar:
-        pausa()
+    print("Terminado en %.1f s" % (time.perf_counter() - inicio))
+    with open(rutaReporte, "w", encoding="utf-8") as f:
+        json.dump(reporte, f, indent=2)
+    print(f"Resultados guardados en {rutaReporte}")
+    pausa()
 
 
+@instrumentacion.medida()
 def verificarColisionDeParadaEnCoordenadas(latitud: float,
                                            longitud: float,
                                            radio=RADIO_BUSQ_PREDET,
@@ -650,34 +4509,42 @@ def verificarColisionDeParadaEnCoordenadas(latitud: float,
         "timestamp": "",
     }
 
-    datos = consultaOverpass(peticionQl)
+    if almacenOsmLocal is not None:
+        trozos = [almacenOsmLocal.respuestaXml(
+            almacenOsmLocal.paradasEnCaja(norte, este, sur, oeste))]
+    else:
+        trozos = consultaOverpassEnTrozos(peticionQl)
 
-    # La respuesta XML procesada por Python para posterior análisis por este módulo
-    xml = ET.fromstring(datos)
-    nodos = xml.findall(".//node")
-    osmCredits = xml.find(".//note").text
-    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
-    timestamp = xml.find(".//meta").get("osm_base", timestamp)
-
-    if nodos:
-        for nodo in nodos:
-            parada = {"attrib": {}, "tags": {}}
-            parada["attrib"] = {str(k): str(v) for k, v in nodo.attrib.items()}
-            parada["attrib"].update({
-                "lat": float(nodo.get("lat")), "lon": float(nodo.get("lon"))
-            })
+    # Solo si se pide la respuesta cruda hace falta tenerla completa
+    if incluirRespuestaCruda:
+        trozos = list(trozos)
 
-            for etiqueta in nodo.findall(".//tag"):
-                parada["tags"][etiqueta.get("k", "")] = etiqueta.get("v")
+    # La respuesta XML procesada por Python para posterior análisis por este
+    # módulo, nodo por nodo conforme llega
+    lector = LectorXmlOverpass(trozos)
 
-            esCercanaLaLat = math.isclose(latitud, parada["attrib"]["lat"])
-            esCercanaLaLon = math.isclose(longitud, parada["attrib"]["lon"])
-            sonCercanasLasCoordenadas = esCercanaLaLat and esCercanaLaLon
-            if sonCercanasLasCoordenadas:
-                resultados["collisions"]["direct"].append(parada)
+    for nodo in lector:
+        parada = {"attrib": {}, "tags": {}}
+        parada["attrib"] = {str(k): str(v) for k, v in nodo.attrib.items()}
+        parada["attrib"].update({
+            "lat": float(nodo.get("lat")), "lon": float(nodo.get("lon"))
+        })
 
-            else:
-                resultados["collisions"]["indirect"].append(parada)
+        for etiqueta in nodo.findall(".//tag"):
+            parada["tags"][etiqueta.get("k", "")] = etiqueta.get("v")
+
+        distancia = distanciaMetros(
+            latitud, longitud, parada["attrib"]["lat"], parada["attrib"]["lon"])
+        parada["distance"] = round(distancia, 2)
+        if distancia <= DIST_MAX_COLISION_METROS:
+            resultados["collisions"]["direct"].append(parada)
+
+        else:
+            resultados["collisions"]["indirect"].append(parada)
+
+    osmCredits = lector.cabecera.get("osm3s", {}).get("copyright", "")
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    timestamp = lector.cabecera.get("osm3s", {}).get("timestamp_osm_base") or timestamp
 
     resultados.update({
         "timestamp": timestamp,
@@ -687,56 +4554,122 @@ def verificarColisionDeParadaEnCoordenadas(latitud: float,
     })
 
     if incluirRespuestaCruda:
-        resultados["response"] = datos
+        resultados["response"] = "".join(
+            t.decode("utf-8") if isinstance(t, bytes) else t for t in trozos)
 
     return resultados
 
 
-def generarOsmchange(listaCrear: list, listaModificar: list, listaEliminar: list):
-    xml = ET.Element("osmChange", {"version": "0.6", "generator": ""})
-
-    # Creamos los elementos de creación, modificación y
-    # eliminación del xml osmChange
-    nodoCreate = ET.Element("create")
-    nodoModify = ET.Element("modify")
-    nodoDelete = ET.Element("delete")
-
-    for listaActual, nodoActual in [(listaCrear, nodoCreate), (listaModificar, nodoModify), (listaEliminar, nodoDelete)]:
-        for elemento in listaActual:
-            if isinstance(elemento, ET.Element):
-                nodoActual.append(elemento)
-            else:
-                print("Error con", str(elemento))
-                print("Tipo de elemento inválido. Saltando...")
-
-    xml.append(nodoCreate)
-    xml.append(nodoModify)
-    xml.append(nodoDelete)
-    xml = ET.ElementTree(xml)
-
-    return xml
-
+class EscritorOsmchange:
+    """
+    Escribe un osmChange conforme se van generando sus elementos, sin
+    armar el árbol completo en memoria. Cada sección (create, modify,
+    delete) se va escribiendo en su propio archivo temporal, y al cerrar
+    se juntan en el archivo final (comprimido con gzip si se pide).
+
+    También reparte los ids negativos de los elementos nuevos: nuevoId()
+    da uno sin usar, e idDe(clave) da siempre el mismo para la misma clave,
+    para que los miembros de las relaciones apunten a los nodos correctos.
+    """
 
-def generarOsmchangeDeRutaGtfs(operador: str, agencia: dict, ruta: dict, viaje: dict, paradas: list):
-    # Generamos un nombre de ruta
-    rutaOsmChange = f'{agencia["agency_id"]}-{ruta["route_short_name"]}_{viaje["trip_headsign"]}.osc'
-    # Limpiamos por si acaso
-    rutaOsmChange = re.sub("[/\\:><~?!]", "", rutaOsmChange)
-    # Agregamos la ruta a la carpeta del usuario como parte de la ruta
-    rutaOsmChange = os.path.expanduser(f"~/{rutaOsmChange}")
-    obj_id = -1
+    SECCIONES = ("create", "modify", "delete")
+
+    def __init__(self, ruta: str, comprimir: bool = COMPRIMIR_OSMCHANGE):
+        if comprimir and not ruta.endswith(".gz"):
+            ruta += ".gz"
+        self.ruta = ruta
+        self.comprimir = comprimir
+        self.siguienteId = -1
+        self.ids = {}
+        self.cuentas = dict.fromkeys(self.SECCIONES, 0)
+        self.temporales = {
+            seccion: tempfile.TemporaryFile("w+", encoding="utf-8")
+            for seccion in self.SECCIONES
+        }
 
-    # Creamos las listas de los elementos a crear, modificar y eliminar
-    elementosACrear = []
-    elementosAModificar = []
-    elementosABorrar = []
+    def __enter__(self):
+        return self
 
-    # Creamos e inicializamos el nodo de relación de ruta
-    relacionRuta = ET.Element(
-        "relation", {"id": str(obj_id), "version": "1", })
-    obj_id -= 1
+    def __exit__(self, tipo, valor, traza):
+        # Si algo falló a medias no dejamos un archivo incompleto
+        if tipo is None:
+            self.cerrar()
+        else:
+            self.descartar()
+
+    def nuevoId(self):
+        id_ = self.siguienteId
+        self.siguienteId -= 1
+        return id_
+
+    def idDe(self, clave):
+        if clave not in self.ids:
+            self.ids[clave] = self.nuevoId()
+        return self.ids[clave]
+
+    @instrumentacion.medida()
+    def agregar(self, seccion: str, elemento):
+        """
+        @elemento: Un ET.Element, o su XML ya serializado (por ejemplo, el
+                   que devuelve un proceso de trabajo)
+        """
+        if isinstance(elemento, ET.Element):
+            elemento = ET.tostring(elemento, encoding="unicode")
+        self.temporales[seccion].write(elemento)
+        self.cuentas[seccion] += 1
+        instrumentacion.contar(f"EscritorOsmchange.{seccion}.bytes", len(elemento))
+
+    def crear(self, elemento):
+        self.agregar("create", elemento)
+
+    def modificar(self, elemento):
+        self.agregar("modify", elemento)
+
+    def eliminar(self, elemento):
+        self.agregar("delete", elemento)
+
+    @instrumentacion.medida()
+    def cerrar(self):
+        rutaTemporal = f"{self.ruta}.{os.getpid()}.tmp"
+        abrir = gzip.open if self.comprimir else open
 
-    # Añadimos las etiquetas correspondientes a la relación de ruta
+        try:
+            with abrir(rutaTemporal, "wt", encoding="utf-8") as f:
+                f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+                f.write('<osmChange version="0.6" generator="">')
+                for seccion in self.SECCIONES:
+                    temporal = self.temporales[seccion]
+                    if not self.cuentas[seccion]:
+                        f.write(f"<{seccion} />")
+                        continue
+                    f.write(f"<{seccion}>")
+                    temporal.seek(0)
+                    shutil.copyfileobj(temporal, f)
+                    f.write(f"</{seccion}>")
+                f.write("</osmChange>")
+
+            os.replace(rutaTemporal, self.ruta)
+        except BaseException:
+            # No dejamos el .tmp a medio escribir
+            with contextlib.suppress(OSError):
+                os.remove(rutaTemporal)
+            raise
+        finally:
+            self.descartar()
+
+    def descartar(self):
+        for temporal in self.temporales.values():
+            temporal.close()
+
+
+def elementoConEtiquetas(tipo: str, atributos: dict, etiquetas: dict):
+    elemento = ET.Element(tipo, atributos)
+    for k, v in list(etiquetas.items()):
+        elemento.append(ET.Element("tag", {"k": str(k), "v": str(v)}))
+    return elemento
+
+
+def tagsDeRelacionDeRuta(operador: str, agencia: dict, ruta: dict, viaje: dict):
     tagsRuta = {
         "colour": f'#{ruta["route_color"]}',
         "ref": ruta["route_short_name"],
@@ -759,177 +4692,317 @@ def generarOsmchangeDeRutaGtfs(operador: str, agencia: dict, ruta: dict, viaje:
     elif ruta["route_type"] == 0:
         tagsRuta["route"] = "light_rail"
 
-    for k, v in list(tagsRuta.items()):
-        tag = ET.Element("tag", {
-            "k": str(k), "v": str(v)
-        })
-        relacionRuta.append(tag)
+    return tagsRuta
+
+
+def tagsDeParadaOsm(paradas: list, redes: set, operadores: set, refsRutas: set,
+                    etiquetasExistentes: dict = None):
+    """
+    Etiquetas del nodo de una o más paradas GTFS (varias cuando coinciden
+    con el mismo nodo de OSM). Si el nodo ya existe, conserva sus etiquetas
+    y les suma las redes, operadores y rutas que ya tenía, sin repetir.
+    @paradas: Filas de stops
+    """
+    idsGtfs = {p["stop_id"] for p in paradas}
+    etiquetas = {}
+
+    if etiquetasExistentes is not None:
+        etiquetas.update(etiquetasExistentes)
+        redes = redes | set(etiquetasExistentes.get("network", "").split(";"))
+        operadores = operadores | set(etiquetasExistentes.get("operator", "").split(";"))
+        refsRutas = refsRutas | set(etiquetasExistentes.get("route_ref", "").split(";"))
+
+    etiquetas.update({
+        "bus": "yes",
+        "gtfs_id": ";".join(sorted(idsGtfs)),
+        "highway": "bus_stop",
+        "name": paradas[0]["stop_name"],
+        "network": ";".join(sorted(redes - {""})),
+        "operator": ";".join(sorted(operadores - {""})),
+        "public_transport": "platform",
+        "ref": ";".join(sorted(idsGtfs)),
+        "route_ref": ";".join(sorted(refsRutas - {""})),
+    })
+
+    return etiquetas
+
+
+def atributosDeNodoExistente(colision: dict):
+    # Quitamos los metadatos que no van en un osmChange (y el tipo, que
+    # en el JSON de Overpass viene como atributo pero en XML es la etiqueta)
+    return {
+        str(k): str(v) for k, v in colision["attrib"].items()
+        if k not in ("type", "user", "changeset", "timestamp", "uid")
+    }
+
+
+@instrumentacion.medida()
+def generarOsmchangeDeRutaGtfs(operador: str, agencia: dict, ruta: dict, viaje: dict, paradas: list):
+    # Generamos un nombre de ruta
+    rutaOsmChange = f'{agencia["agency_id"]}-{ruta["route_short_name"]}_{viaje["trip_headsign"]}.osc'
+    # Limpiamos por si acaso
+    rutaOsmChange = re.sub("[/\\:><~?!]", "", rutaOsmChange)
+    # Agregamos la ruta a la carpeta del usuario como parte de la ruta
+    rutaOsmChange = os.path.expanduser(f"~/{rutaOsmChange}")
 
+    # Una sola consulta para todas las paradas del viaje
     colisiones = verificarColisionesDeParadasGtfsConOsm(
         paradas, ruta, agencia, pausarAlFinalizar=False, mostrarProgreso=False
     )
+    # Sin saber qué paradas ya existen, crearíamos duplicados de todas
+    if colisiones is None:
+        print("No se generó el archivo.")
+        pausa()
+        return
 
-    # Iteramos por cada parada para crearla como nodo y
-    # añadir el nodo a la relación de ruta
-    offset = -obj_id
-    for i, parada in enumerate(paradas, (-obj_id)+1):
-        lat = float(parada["stops"]["stop_lat"])
-        lon = float(parada["stops"]["stop_lon"])
+    escritor = EscritorOsmchange(rutaOsmChange)
 
-        print(f"Procesando parada #{i-offset}")
+    # Si algo falla a medias, el escritor descarta lo que llevaba
+    with escritor:
+        # Creamos e inicializamos el nodo de relación de ruta con sus etiquetas
+        # (es lo único que se queda en memoria hasta el final)
+        relacionRuta = elementoConEtiquetas(
+            "relation", {"id": str(escritor.nuevoId()), "version": "1", },
+            tagsDeRelacionDeRuta(operador, agencia, ruta, viaje))
 
-        colision = colisiones["collisions"].get(parada["stops"]["stop_id"])
+        # Los nodos ya escritos; si el viaje vuelve a pasar por una parada,
+        # solo se agrega otra vez a la relación
+        nodosEscritos = set()
 
-        # Modificamos una parada existente
-        if colision is not None:
-            print(f"Procesando colisión de parada directa...")
+        # Iteramos por cada parada para crearla como nodo y
+        # añadir el nodo a la relación de ruta
+        for i, parada in enumerate(paradas, 1):
+            lat = float(parada["stops"]["stop_lat"])
+            lon = float(parada["stops"]["stop_lon"])
 
-            # Creamos el nodo
-            for k in ["user", "changeset", "timestamp", "uid"]:
-                colision["attrib"].pop(k)
+            print(f"Procesando parada #{i}")
 
-            atributosNodoParada = {
-                str(k): str(v) for k, v in colision["attrib"].items()
-            }
-            nodoParada = ET.Element("node", atributosNodoParada)
-
-            # Añadimos las etiquetas al nodo
-            tagsParada = colision["tags"]
-            tagsParada.update({
-                "bus": "yes",
-                "highway": "bus_stop",
-                "name": parada["stops"]["stop_name"],
-                "public_transport": "platform",
-                "ref": parada["stops"]["stop_id"],
-                "gtfs_id": parada["stops"]["stop_id"],
-            })
+            colision = colisiones["collisions"].get(parada["stops"]["stop_id"])
 
-            # Buscamos si el nodo de colisión ya tenía las sig. etiquetas que queremos establecer
-            # Les añadimos datos de ser el caso; de no ser el caso habrá un duplicado que se
-            # eliminará mediante un conjunto/set ({})
-
-            redes = set([agencia["agency_name"]])
-            operadores = set([operador])
-            refs = set([parada["stops"]["stop_id"]])
-            gtfsIds = set([parada["stops"]["stop_id"]])
-            refsRutas = set([ruta["route_short_name"]])
-
-            redExistente = colision["tags"].get("network",
-                agencia["agency_name"]).split(";")
-            operadorExistente = colision["tags"].get("operator",
-                operador).split(";")
-            refExistente = tagsParada.get("ref",
-                parada["stops"]["stop_id"]).split(";")
-            gtfsIdExistente = tagsParada.get("gtfs_id",
-                parada["stops"]["stop_id"]).split(";")
-            refsRutasExistente = colision["tags"].get("route_ref",
-                ruta["route_short_name"]).split(";")
-
-            redes.update(redExistente)
-            operadores.update(operadorExistente)
-            refs.update(refExistente)
-            gtfsIds.update(gtfsIdExistente)
-            refsRutas.update(refsRutasExistente)
-
-            redParada = ";".join(redes)
-            operadorParada = ";".join(operadores)
-            refParada = ";".join(refs)
-            gtfsIdParada = ";".join(gtfsIds)
-            referenciaRutas = ";".join(refsRutas)
-
-            # redParada = ";".join({
-            #     agencia["agency_name"],
-            #     colision["tags"].get("network", agencia["agency_name"])
-            # })
-            # operadorParada = ";".join({
-            #     operador,
-            #     colision["tags"].get("operator", operador)
-            # })
-            # refParada = ";".join({
-            #     parada["stops"]["stop_id"],
-            #     colision["tags"].get("ref", parada["stops"]["stop_id"])
-            # })
-            # gtfsIdParada = ";".join({
-            #     parada["stops"]["stop_id"],
-            #     colision["tags"].get("gtfs_id", parada["stops"]["stop_id"])
-            # })
-
-            # route_refs es una particularmente especial
-            # colision["tags"]["route_ref"] = colision["tags"].get("route_ref", [])
-            # if colision["tags"]["route_ref"]:
-            #     colision["tags"]["route_ref"] = colision["tags"]["route_ref"].split(";")
-            # colision["tags"]["route_ref"].append(ruta["route_short_name"])
-            # referenciaRutas = ";".join(set(colision["tags"]["route_ref"]))
-
-            # Agregamos las etiquetas ya procesadas a las etiquetas de la paradas
-            tagsParada["network"] = redParada
-            tagsParada["operator"] = operadorParada
-            tagsParada["gtfs_id"] = gtfsIdParada
-            tagsParada["ref"] = refParada
-            tagsParada["route_ref"] = referenciaRutas
-
-            for k, v in list(tagsParada.items()):
-                tag = ET.Element("tag", {"k": str(k), "v": str(v)})
-                nodoParada.append(tag)
+            # Modificamos una parada existente
+            if colision is not None:
+                refNodo = colision["attrib"]["id"]
 
-            # Añadimos el nodo a la relación de ruta (que ya está en el nodo create)
-            relacionRuta.append(ET.Element("member", {
-                "type": "node",
-                "ref": str(colision["attrib"]["id"]),
-                "role": "platform",
-            }))
-            # Añadimos el nodo a lo que se creará
-            elementosAModificar.append(nodoParada)
+                if refNodo not in nodosEscritos:
+                    print(f"Procesando colisión de parada directa...")
 
-        # Creamos una nueva parada
-        else:
-            # Creamos el nodo
-            nodoParada = ET.Element("node", {
-                "id": str(-i),
-                "lat": str(lat),
-                "lon": str(lon),
-            })
+                    # Las etiquetas que ya tenía el nodo se conservan; a network,
+                    # operator y route_ref se les agregan las nuestras
+                    tagsParada = tagsDeParadaOsm(
+                        [parada["stops"]], {agencia["agency_name"]}, {operador},
+                        {ruta["route_short_name"]}, colision["tags"])
+                    nodoParada = elementoConEtiquetas(
+                        "node", atributosDeNodoExistente(colision), tagsParada)
 
-            # Añadimos las etiquetas al nodo
-            tagsParada = {
-                "bus": "yes",
-                "gtfs_id": parada["stops"]["stop_id"],
-                "highway": "bus_stop",
-                "name": parada["stops"]["stop_name"],
-                "network": agencia["agency_name"],
-                "operator": operador,
-                "public_transport": "platform",
-                "ref": parada["stops"]["stop_id"],
-                "route_ref": ruta["route_short_name"],
-            }
-            for k, v in list(tagsParada.items()):
-                tag = ET.Element("tag", {"k": str(k), "v": str(v)})
-                nodoParada.append(tag)
+                    # Añadimos el nodo a lo que se modificará
+                    escritor.modificar(nodoParada)
+                    nodosEscritos.add(refNodo)
+
+            # Creamos una nueva parada
+            else:
+                refNodo = escritor.idDe(parada["stops"]["stop_id"])
+
+                if refNodo not in nodosEscritos:
+                    tagsParada = tagsDeParadaOsm(
+                        [parada["stops"]], {agencia["agency_name"]}, {operador},
+                        {ruta["route_short_name"]})
+                    nodoParada = elementoConEtiquetas("node", {
+                        "id": str(refNodo),
+                        "lat": str(lat),
+                        "lon": str(lon),
+                    }, tagsParada)
+
+                    # Añadimos el nodo a lo que se creará
+                    escritor.crear(nodoParada)
+                    nodosEscritos.add(refNodo)
 
             # Añadimos el nodo a la relación de ruta (que ya está en el nodo create)
             relacionRuta.append(ET.Element("member", {
-                "type": "node", "ref": str(-i), "role": "platform",
+                "type": "node", "ref": str(refNodo), "role": "platform",
             }))
 
-            # Añadimos el nodo a lo que se creará
-            elementosACrear.append(nodoParada)
+            print(f"Parada #{i} procesada correctamente")
 
-        print(f"Parada #{i-offset} procesada correctamente")
-        print(f"Durmiendo por {SEG_DESCANSO_ENTRE_PETIC} segundos...")
-        time.sleep(SEG_DESCANSO_ENTRE_PETIC)
+        # Añadimos la relación de ruta a las cosas que crear
+        escritor.crear(relacionRuta)
+
+    print(f'Archivo "{escritor.ruta}" creado correctamente.')
+    pausa()
 
-    # Añadimos la relación de ruta a las cosas que crear
-    elementosACrear.append(relacionRuta)
 
-    if os.path.exists(rutaOsmChange):
-        os.remove(rutaOsmChange)
+def xmlDeRelacionesDeRuta(relaciones: list):
+    """
+    Arma las relaciones de los viajes de una ruta. Corre en otro proceso,
+    así que recibe y devuelve solo datos simples: tuplas (id, etiquetas,
+    refs de los nodos) y el XML de cada relación como texto.
+    """
+    resultado = []
+    for idRelacion, etiquetas, refsNodos in relaciones:
+        relacion = elementoConEtiquetas(
+            "relation", {"id": str(idRelacion), "version": "1"}, etiquetas)
+        for ref in refsNodos:
+            relacion.append(ET.Element("member", {
+                "type": "node", "ref": str(ref), "role": "platform",
+            }))
+        resultado.append(ET.tostring(relacion, encoding="unicode"))
+    return resultado
 
-    xml = generarOsmchange(elementosACrear, elementosAModificar, elementosABorrar)
-    xml.write(rutaOsmChange, encoding="utf-8",
-              xml_declaration=True, short_empty_elements=True)
 
-    print(f'Archivo "{rutaOsmChange}" creado correctamente.')
-    pausa()
+@instrumentacion.medida()
+def exportarOsmchangeEnLote(operador: str, agencias: list,
+                            trabajadores: int = TRABAJADORES_EXPORTACION,
+                            comprimir: bool = COMPRIMIR_OSMCHANGE,
+                            idsRutas: set = None,
+                            directorio: str = "~",
+                            pausarAlFinalizar: bool = True):
+    """
+    Genera un solo osmChange con todas las rutas de las agencias (un viaje
+    por cada secuencia distinta de paradas). Cada parada aparece una sola
+    vez aunque la usen varias rutas, con todas ellas en route_ref, y las
+    colisiones se buscan una vez por área para todas las paradas.
+    @idsRutas: Exportar solo estas rutas (route_id)
+    Devuelve un resumen de lo exportado.
+    """
+    nombre = agencias[0]["agency_id"] if len(agencias) == 1 else operador
+    rutaOsmChange = re.sub("[/\\:><~?!]", "", f"{nombre}-todas_las_rutas.osc")
+    rutaOsmChange = os.path.join(os.path.expanduser(directorio), rutaOsmChange)
+    stops = conjuntoGtfs.stops
+    stop_times = conjuntoGtfs.stop_times
+    inicio = time.perf_counter()
+
+    # Viajes a exportar y las paradas que usan
+    rutasAExportar = []
+    paradasUnicas = {}
+    for agencia in agencias:
+        rutas = conjuntoGtfs.routes.get(agencia["agency_id"], {}).values()
+        for ruta in sorted(rutas, key=lambda x: x["route_id"]):
+            if idsRutas is not None and ruta["route_id"] not in idsRutas:
+                continue
+            viajes = viajesRepresentativos(ruta)
+            secuencias = []
+            for viaje in viajes:
+                secuencia = [stop_times.idParada(i) for i in stop_times[viaje["trip_id"]]]
+                secuencias.append(secuencia)
+                for stop_id in secuencia:
+                    paradasUnicas.setdefault(stop_id, {"stops": stops[stop_id]})
+            if viajes:
+                rutasAExportar.append((agencia, ruta, viajes, secuencias))
+
+    print(f"{len(rutasAExportar)} rutas, {sum(len(r[2]) for r in rutasAExportar)} viajes "
+          f"y {len(paradasUnicas)} paradas distintas")
+
+    colisiones, ambiguas, sinConsultar = colisionesPorArea(list(paradasUnicas.values()))
+
+    # Si la consulta de un área falló no sabemos qué paradas ya existen
+    # ahí; crearlas las duplicaría, así que se omiten las rutas que las usan
+    rutasOmitidas = []
+    if sinConsultar:
+        rutasOmitidas = [
+            ruta["route_id"] for _, ruta, _, secuencias in rutasAExportar
+            if any(stop_id in sinConsultar for secuencia in secuencias for stop_id in secuencia)
+        ]
+        rutasAExportar = [r for r in rutasAExportar if r[1]["route_id"] not in rutasOmitidas]
+        print(f"Se omiten {len(rutasOmitidas)} rutas con paradas en áreas que no se "
+              f"pudieron consultar: {', '.join(rutasOmitidas)}")
+
+    # Las paradas de las rutas que quedan, con las redes y rutas de cada una
+    paradasUnicas = {}
+    redesDeParada = {}
+    rutasDeParada = {}
+    for agencia, ruta, viajes, secuencias in rutasAExportar:
+        for secuencia in secuencias:
+            for stop_id in secuencia:
+                paradasUnicas.setdefault(stop_id, {"stops": stops[stop_id]})
+                redesDeParada.setdefault(stop_id, set()).add(agencia["agency_name"])
+                rutasDeParada.setdefault(stop_id, set()).add(ruta["route_short_name"])
+
+    if not rutasAExportar:
+        print("No quedó ninguna ruta que exportar.")
+        if pausarAlFinalizar:
+            pausa()
+        return {
+            "file": None,
+            "created_nodes": 0,
+            "modified_nodes": 0,
+            "ambiguous_stops": 0,
+            "relations": 0,
+            "skipped_routes": rutasOmitidas,
+            "seconds": round(time.perf_counter() - inicio, 3),
+        }
+
+    # Los nodos se escriben conforme se arman; en memoria solo quedan
+    # los ids con que las relaciones se refieren a ellos
+    escritor = EscritorOsmchange(rutaOsmChange, comprimir)
+
+    # Una parada nueva por cada parada GTFS sin colisión, y una modificación
+    # por cada nodo de OSM (varias paradas GTFS pueden caer en el mismo)
+    refDeParada = {}
+    paradasDeNodo = {}
+    for stop_id, parada in paradasUnicas.items():
+        colision = colisiones.get(stop_id)
+        if colision is None:
+            refDeParada[stop_id] = escritor.idDe(stop_id)
+            escritor.crear(elementoConEtiquetas("node", {
+                "id": str(refDeParada[stop_id]),
+                "lat": str(float(parada["stops"]["stop_lat"])),
+                "lon": str(float(parada["stops"]["stop_lon"])),
+            }, tagsDeParadaOsm(
+                [parada["stops"]], redesDeParada[stop_id], {operador}, rutasDeParada[stop_id])))
+        else:
+            refDeParada[stop_id] = colision["attrib"]["id"]
+            paradasDeNodo.setdefault(colision["attrib"]["id"], []).append(stop_id)
+
+    for idsParadas in paradasDeNodo.values():
+        colision = colisiones[idsParadas[0]]
+        tagsParada = tagsDeParadaOsm(
+            [stops[stop_id] for stop_id in idsParadas],
+            set().union(*(redesDeParada[stop_id] for stop_id in idsParadas)),
+            {operador},
+            set().union(*(rutasDeParada[stop_id] for stop_id in idsParadas)),
+            colision["tags"])
+        escritor.modificar(
+            elementoConEtiquetas("node", atributosDeNodoExistente(colision), tagsParada))
+
+    # Los ids de las relaciones se reparten aquí para que no dependan
+    # del orden en que terminen los procesos
+    trabajos = []
+    for agencia, ruta, viajes, secuencias in rutasAExportar:
+        relaciones = []
+        for viaje, secuencia in zip(viajes, secuencias):
+            relaciones.append((
+                escritor.nuevoId(),
+                tagsDeRelacionDeRuta(operador, agencia, ruta, viaje),
+                [refDeParada[stop_id] for stop_id in secuencia],
+            ))
+        trabajos.append(relaciones)
+
+    paradasNuevas = escritor.cuentas["create"]
+    print("Armando relaciones...")
+    # Sin esto, los procesos hijos repiten lo que quedó en el búfer
+    sys.stdout.flush()
+    with escritor, ProcessPoolExecutor(max_workers=trabajadores) as ejecutor:
+        # Ya vienen serializadas; se escriben tal cual
+        for relaciones in ejecutor.map(xmlDeRelacionesDeRuta, trabajos, chunksize=8):
+            for relacion in relaciones:
+                escritor.crear(relacion)
+
+    resumen = {
+        "file": escritor.ruta,
+        "created_nodes": paradasNuevas,
+        "modified_nodes": escritor.cuentas["modify"],
+        "ambiguous_stops": sum(stop_id in paradasUnicas for stop_id in ambiguas),
+        "relations": escritor.cuentas["create"] - paradasNuevas,
+        "skipped_routes": rutasOmitidas,
+        "seconds": round(time.perf_counter() - inicio, 3),
+    }
+    print("%d paradas nuevas, %d modificadas (%d ambiguas), %d relaciones en %.1f s" % (
+        resumen["created_nodes"], resumen["modified_nodes"], resumen["ambiguous_stops"],
+        resumen["relations"], resumen["seconds"]))
+    print(f'Archivo "{escritor.ruta}" creado correctamente.')
+    if pausarAlFinalizar:
+        pausa()
+
+    return resumen
 
 
 def seleccionarOpcion(opciones,
@@ -991,21 +5064,14 @@ def menuHorarios(ruta, viaje, paradas):
         #     NOTE 2: Hay que ver cómo nos peleamos con frequencies
         #             para lidiar con las frecuencias variables (como las de SITEUR)
 
-        # Obtenemos los datos de la frecuencia para el cálculo de las paradas
-        frecuenciasViaje = frequencies[viaje["trip_id"]]
+        # Las corridas de todas las ventanas de frecuencia se expanden
+        # de una vez para todas las paradas del viaje; aquí solo tomamos
+        # la columna de la parada seleccionada
+        tablaHorarios = conjuntoGtfs.horariosDeViaje(viaje["trip_id"])
         # Lista de los textos de los horarios
-        frecuenciasParada = []
-
-        for frecuencia in frecuenciasViaje:
-            horaInicioDateTime, deltaPosicionParada, minutos = \
-                obtenerHoraDeInicioYDelta(parada, frecuencia)
-
-            for i, minutosFrecuencia in enumerate(minutos):
-                nuevaHora = horaInicioDateTime + \
-                    deltaPosicionParada + (minutosFrecuencia * i)
-                # Creamos el tablero y lo agregamos a la lista
-                texto = f"{nuevaHora.strftime('%H:%M:%S')}"
-                frecuenciasParada.append(texto)
+        frecuenciasParada = [
+            segundosAHora(hora) for hora in tablaHorarios.deParada(seleccion)
+        ]
 
         listar(
             frecuenciasParada, 'Horarios de la parada "{}":'.format(
@@ -1024,9 +5090,11 @@ def menuParadas(paradas: list, ruta: dict, viaje: dict, agencia: dict, operador:
             "Ver lista de paradas",
             "Ver paradas con coordenadas",
             "Ver horarios de paradas",
+            "Ver horarios de todas las corridas del viaje",
             "Crear una relación de bus junto con paradas de esta ruta (formato OsmChange)",
             "Verificar colisiones de paradas de esta ruta con paradas existentes en OSM",
             "Generar wikitexto de paradas con coordenadas en GMS",
+            "Ver próximas salidas de todas las rutas en una parada",
         ]
         texto = f'== Ruta {ruta["route_long_name"]}: {viaje["trip_headsign"]} =='
         seleccion = seleccionarOpcion(opciones, texto, alinearSeleccionACero=False)
@@ -1055,16 +5123,25 @@ def menuParadas(paradas: list, ruta: dict, viaje: dict, agencia: dict, operador:
         elif seleccion == 4:
             menuHorarios(ruta, viaje, paradas)
 
-        # Se quiere un archivo osc para añadirlo a OpenStreetMap
+        # Se quiere la tabla completa: una fila por corrida con su hora en cada parada
         elif seleccion == 5:
+            tablaHorarios = conjuntoGtfs.horariosDeViaje(viaje["trip_id"])
+            corridas = [
+                " ".join(segundosAHora(hora) for hora in tablaHorarios.deCorrida(i))
+                for i in range(tablaHorarios.numCorridas)
+            ]
+            listar(corridas, "Horarios de las corridas (una columna por parada):")
+
+        # Se quiere un archivo osc para añadirlo a OpenStreetMap
+        elif seleccion == 6:
             generarOsmchangeDeRutaGtfs(
                 operador, agencia, ruta, viaje, paradas)
 
-        elif seleccion == 6:
+        elif seleccion == 7:
             verificarColisionesDeParadasGtfsConOsm(paradas, ruta, agencia,
                                                    generarReporte=True)
 
-        elif seleccion == 7:
+        elif seleccion == 8:
             def decAgmsXY(x, y):
                 x = decAgms(x)
                 y = decAgms(y)
@@ -1095,6 +5172,30 @@ def menuParadas(paradas: list, ruta: dict, viaje: dict, agencia: dict, operador:
             ]
             listar(paradasConCoordenadas, "")
 
+        elif seleccion == 9:
+            numParada = seleccionarParada(ruta, paradas)
+            if numParada == -1:
+                continue
+
+            parada = paradas[numParada]["stops"]
+            hora = sinput("Hora de consulta (HH:MM:SS): ", tipoClase=horaASegundos)
+            dia = sinput("Fecha (AAAA-MM-DD) o día de la semana, vacío para hoy: ",
+                         tipoClase=lambda valor: diaDeServicio(valor) if valor.strip() else None)
+            # La primera vez se construye el índice de todo el conjunto
+            salidas = conjuntoGtfs.departures.proximasSalidas(
+                parada["stop_id"], hora, 20, conjuntoGtfs.calendar.serviciosDelDia(dia))
+            rutas = {
+                route_id: r
+                for rutasAgencia in conjuntoGtfs.routes.values()
+                for route_id, r in rutasAgencia.items()
+            }
+            textos = [
+                f'{segundosAHora(salida)} {rutas.get(route_id, {}).get("route_short_name", route_id)}'
+                f' - {conjuntoGtfs.trips.get(route_id, {}).get(trip_id, {}).get("trip_headsign", trip_id)}'
+                for salida, trip_id, route_id in salidas
+            ]
+            listar(textos, f'Próximas salidas de "{parada["stop_name"]}":')
+
 
 def menuViajes(ruta: dict, viajes: list, agencia: dict, operador: str):
     salidaSolicitada = False
@@ -1125,7 +5226,7 @@ def menuViajes(ruta: dict, viajes: list, agencia: dict, operador: str):
         # Asignamos el viaje que seleccionó el usuario
         viaje = viajes[seleccion]
         # Obtenemos los tiempos de parada asociadas al id de viaje
-        horarioParadas = stop_times[viaje["trip_id"]]
+        horarioParadas = conjuntoGtfs.stop_times[viaje["trip_id"]]
         # Obtenemos las paradas asociadas al id de parada
         paradas = ordenarParadas(horarioParadas)
         paradas = ajustarHorariosDeParadas(paradas)
@@ -1137,7 +5238,7 @@ def menuRutas(agencia: dict, operador: str):
     salidaSolicitada = False
     while not salidaSolicitada:
         # Obtenemos las rutas que provee esta agencia
-        rutas_agencia = list(routes[agencia["agency_id"]].values())
+        rutas_agencia = list(conjuntoGtfs.routes[agencia["agency_id"]].values())
         # rutas_agencia = rutas_agencia[:20]
         rutas_agencia = sorted(rutas_agencia, key=dividirRuta)
         # Pedimos que selecciona una ruta de la agencia
@@ -1148,29 +5249,124 @@ def menuRutas(agencia: dict, operador: str):
             if len(partes) > 1:
                 nombre_largo = partes[1].strip()
             listadoNombresRuta.append(f"%-18s %s" % (r['route_short_name'], nombre_largo))
+        listadoNombresRuta.append("Verificar colisiones de todas las rutas")
+        listadoNombresRuta.append("Exportar osmChange de todas las rutas")
         seleccion = seleccionarOpcion(listadoNombresRuta, "Elige una ruta:")
 
         if seleccion == -1:
             salidaSolicitada = True
             continue
+        elif seleccion == len(rutas_agencia):
+            verificarColisionesDeAgencia(agencia, rutas_agencia)
+            continue
+        elif seleccion == len(rutas_agencia) + 1:
+            exportarOsmchangeEnLote(operador, [agencia])
+            continue
 
         ruta = rutas_agencia[seleccion]
         # Obtenemos los viajes que ofrece la ruta
-        viajes = list(trips[ruta["route_id"]].values())
+        viajes = list(conjuntoGtfs.trips[ruta["route_id"]].values())
 
         menuViajes(ruta, viajes, agencia, operador)
 
 
+def pedirParada(texto: str):
+    """Pide una parada por su stop_id o por parte de su nombre. Devuelve
+    su stop_id, o None si no se eligió ninguna"""
+    stops = conjuntoGtfs.stops
+    while True:
+        consulta = sinput(texto).strip()
+        if consulta == "":
+            return None
+        if consulta in stops:
+            return consulta
+
+        coincidencias = [p for p in stops.values() if consulta.lower() in p["stop_name"].lower()]
+        if not coincidencias:
+            print("No hay paradas con ese nombre. Deja vacío para cancelar.")
+            continue
+
+        coincidencias = coincidencias[:50]
+        seleccion = seleccionarOpcion(
+            ["%-24s %s" % (p["stop_id"], p["stop_name"]) for p in coincidencias],
+            "Elige una parada:")
+        if seleccion != -1:
+            return coincidencias[seleccion]["stop_id"]
+
+
+def mostrarItinerario(itinerario: dict):
+    stops = conjuntoGtfs.stops
+
+    def nombre(stop_id):
+        return stops.get(stop_id, {}).get("stop_name", stop_id)
+
+    duracion = (itinerario["llegada"] - itinerario["salida"]) // 60
+    print(f'Llegada {segundosAHora(itinerario["llegada"])} ({duracion} min), '
+          f'{itinerario["transbordos"]} transbordos')
+    for tramo in itinerario["tramos"]:
+        if tramo["tipo"] == "viaje":
+            print(f'  {segundosAHora(tramo["salida"])} Toma {tramo["route_id"]} '
+                  f'en {nombre(tramo["desde"])}')
+            print(f'  {segundosAHora(tramo["llegada"])} Baja en {nombre(tramo["hasta"])} '
+                  f'({tramo["paradas"]} paradas)')
+        else:
+            print(f'           Camina {tramo["segundos"] // 60} min hasta {nombre(tramo["hasta"])}')
+    print()
+
+
+def menuPlanificador():
+    """Planifica viajes entre dos paradas del conjunto seleccionado"""
+    salidaSolicitada = False
+    while not salidaSolicitada:
+        limpiarPantalla()
+        print("Planificar un viaje (deja vacío para volver)")
+        origen = pedirParada("Parada de origen (nombre o stop_id): ")
+        if origen is None:
+            salidaSolicitada = True
+            continue
+        destino = pedirParada("Parada de destino (nombre o stop_id): ")
+        if destino is None:
+            continue
+        hora = sinput("Hora de salida (HH:MM:SS): ", tipoClase=horaASegundos)
+        dia = sinput("Fecha (AAAA-MM-DD) o día de la semana, vacío para hoy: ",
+                     tipoClase=lambda valor: diaDeServicio(valor) if valor.strip() else None)
+
+        inicio = time.perf_counter()
+        itinerarios = planificarViaje(origen, destino, hora, dia=dia)
+        segundos = time.perf_counter() - inicio
+
+        limpiarPantalla()
+        print(f"De {conjuntoGtfs.stops[origen]['stop_name']} a "
+              f"{conjuntoGtfs.stops[destino]['stop_name']}, saliendo a las {segundosAHora(hora)}:")
+        print()
+        if not itinerarios:
+            print(f"No hay forma de llegar con {MAX_VIAJES_RAPTOR} vehículos o menos.")
+        for itinerario in itinerarios:
+            mostrarItinerario(itinerario)
+        print(f"Calculado en {segundos * 1000:.1f} ms")
+        pausa()
+
+
 def menuAgencias(agencias: list, operador: str):
     salidaSolicitada = False
     while not salidaSolicitada:
         # Pedimos que seleccione una agencia
         seleccion = seleccionarOpcion(
-            [x["agency_name"] for x in agencias], "Elige una agencia:")
+            [x["agency_name"] for x in agencias] + [
+                "Exportar osmChange de todas las agencias",
+                "Planificar un viaje entre dos paradas",
+            ],
+            "Elige una agencia:")
 
         if seleccion == -1:
             salidaSolicitada = True
             continue
+        elif seleccion == len(agencias):
+            exportarOsmchangeEnLote(operador, agencias)
+            continue
+        elif seleccion == len(agencias) + 1:
+            menuPlanificador()
+            continue
 
         # Obtenemos los detalles de la agencia seleccionada
         agencia = agencias[seleccion]
@@ -1189,41 +5385,52 @@ def menuGtfs():
 
         operadorSeleccionado = CONJUNTOS_GTFS[seleccion]
 
-        # Obtenemos los datos del conjunto seleccionado
-
-        rutaAgency = os.path.join(RUTA_DATOS_GTFS,
-                                  operadorSeleccionado, "agency.txt")
-        rutaRoutes = os.path.join(RUTA_DATOS_GTFS,
-                                  operadorSeleccionado, "routes.txt")
-        rutaTrips = os.path.join(RUTA_DATOS_GTFS,
-                                 operadorSeleccionado, "trips.txt")
-        rutaFrequencies = os.path.join(RUTA_DATOS_GTFS,
-                                       operadorSeleccionado, "frequencies.txt")
-        rutaShapes = os.path.join(RUTA_DATOS_GTFS,
-                                  operadorSeleccionado, "shapes.txt")
-        rutaStops = os.path.join(RUTA_DATOS_GTFS,
-                                 operadorSeleccionado, "stops.txt")
-        rutaStopTimes = os.path.join(RUTA_DATOS_GTFS,
-                                     operadorSeleccionado, "stop_times.txt")
-
-        # Establecemos estas como globales para establecerlas para el resto del programa
-        global agency, routes, trips, frequencies, shapes, stops, stop_times
-
-        agency = obtenerAgencias(rutaAgency)
-        if "etran" in operadorSeleccionado:
-            routes = obtenerRutas(rutaRoutes, quitarTexto=True)
-        else:
-            routes = obtenerRutas(rutaRoutes)
-        trips = obtenerViajes(rutaTrips)
-        frequencies = obtenerFrecuencias(rutaFrequencies)
-        shapes = obtenerTrazos(rutaShapes)
-        stops = obtenerParadas(rutaStops)
-        stop_times = obtenerHorariosDeParada(rutaStopTimes)
-
-        agencias = list(agency.values())
+        # Establecemos el conjunto como global para el resto del programa.
+        # Sus tablas se procesan hasta que se usan (usando su instantánea si
+        # los archivos no han cambiado), o en segundo plano si se precargan
+        global conjuntoGtfs
+        rutaConjunto = os.path.join(RUTA_DATOS_GTFS, operadorSeleccionado)
+        conjuntoGtfs = ConjuntoGtfs(rutaConjunto)
+
+        if MODO_CARGA_GTFS == "precarga":
+            conjuntoGtfs.precargar()
+        elif MODO_CARGA_GTFS == "paralela":
+            conjuntoGtfs.cargarEnParalelo(TRABAJADORES_CARGA)
+
+        agencias = list(conjuntoGtfs.agency.values())
         menuAgencias(agencias, operadorSeleccionado)
 
 
+def menuCacheOverpass():
+    global forzarActualizacionOverpass
+    salidaSolicitada = False
+    while not salidaSolicitada:
+        estado = "activado" if forzarActualizacionOverpass else "desactivado"
+        opciones = [
+            f"Forzar actualización de las consultas (ahora {estado})",
+            "Ver estadísticas de la caché",
+            "Vaciar la caché",
+        ]
+        seleccion = seleccionarOpcion(opciones, "== Caché de Overpass ==",
+                                      alinearSeleccionACero=False)
+
+        if seleccion == -1:
+            salidaSolicitada = True
+            continue
+
+        elif seleccion == 1:
+            forzarActualizacionOverpass = not forzarActualizacionOverpass
+
+        elif seleccion == 2:
+            print(json.dumps(obtenerCacheOverpass().estadisticas(), indent=2))
+            pausa()
+
+        elif seleccion == 3:
+            obtenerCacheOverpass().vaciar()
+            print("Caché vaciada.")
+            pausa()
+
+
 def menuDepuracion():
     salidaSolicitada = False
     opciones = [
@@ -1233,6 +5440,17 @@ def menuDepuracion():
         "Listar paradas de autobús en Jalisco con ref",
         "Realizar consulta overpass",
         #"Reparar operador roto (quitar el S;e;t;r;a;n;s)",
+        "Comparar tiempos de carga en frío y en caliente de un conjunto GTFS",
+        "Medir la carga paralela de un conjunto GTFS",
+        "Buscar paradas GTFS cercanas a una coordenada",
+        "Medir el índice espacial de paradas de un conjunto GTFS",
+        "Usar un extracto OSM local (.osm) en lugar de Overpass",
+        "Caché de Overpass",
+        "Clasificar servidores Overpass",
+        "Reporte de instrumentación de la sesión",
+        "Medir la simplificación de trazos de un conjunto GTFS",
+        "Proyectar las paradas sobre los trazos de un conjunto GTFS",
+        "Construir el grafo de caminatas entre las paradas de todos los conjuntos GTFS",
     ]
     while not salidaSolicitada:
         seleccion = seleccionarOpcion(opciones, alinearSeleccionACero=False)
@@ -1252,34 +5470,40 @@ def menuDepuracion():
 
         elif seleccion == 2:
             peticionOverpass = """[out:json];"""
-            peticionOverpass  = """area[name="Jalisco"];"""
+            peticionOverpass += """area[name="Jalisco"];"""
             peticionOverpass += """relation["route"="bus"]["ref"~".+"](area);"""
             peticionOverpass += """out meta;"""
-            rutas = {}
+            # ref -> etiquetas de la primera relación con ese ref
+            primeras = {}
+            duplicadas = set()
 
             print("Realizando petición...")
-            respuesta = json.loads(consultaOverpass(peticionOverpass))
-            print("Petición completada. Procesando resultados...")
-
-            if respuesta["elements"]:
-                for relacion in respuesta["elements"]:
-                    # Guardamos el ref para comodidad
-                    ref = relacion["tags"]["ref"]
-                    # Obtenemos la lista de rutas
-                    # Si no hay devolvemos una lista vacía
-                    variantesEncontradas = rutas.get(ref, [])
-                    variantesEncontradas.append(relacion)
-                    # Asignamos la lista creada u obtenida al diccionario
-                    rutas[ref] = variantesEncontradas
-
-            print("Resultados procesados. Listando:")
-            
-            for ruta in rutas.values():
-                if len(ruta) > 1:
-                    for r in ruta:
-                        print(f'{ruta[0]["tags"]["ref"]} duplicada. Detalles:')
-                        print(json.dumps(r["tags"], indent=2))
-                        pausa()
+            if almacenOsmLocal is not None:
+                relaciones = almacenOsmLocal.relacionesDeRuta("bus")
+            else:
+                relaciones = LectorJsonOverpass(consultaOverpassEnTrozos(peticionOverpass))
+
+            # Cada relación se revisa en cuanto llega
+            for relacion in relaciones:
+                # Guardamos el ref para comodidad
+                ref = relacion["tags"]["ref"]
+                if ref not in primeras:
+                    primeras[ref] = relacion["tags"]
+                    continue
+
+                # La primera vez que se repite un ref mostramos también la original
+                variantes = [relacion["tags"]]
+                if ref not in duplicadas:
+                    duplicadas.add(ref)
+                    variantes.insert(0, primeras[ref])
+
+                for etiquetas in variantes:
+                    print(f'{ref} duplicada. Detalles:')
+                    print(json.dumps(etiquetas, indent=2))
+                    pausa()
+
+            print(f"{len(primeras)} refs revisados, {len(duplicadas)} duplicados.")
+            pausa()
 
         elif seleccion == 3:
             peticionOverpass = """[out:json];"""
@@ -1287,13 +5511,15 @@ def menuDepuracion():
             peticionOverpass += """relation["route"="bus"]["ref"~".+"](area);"""
             peticionOverpass += """out meta;"""
 
-            respuesta = json.loads(consultaOverpass(peticionOverpass))
+            if almacenOsmLocal is not None:
+                relaciones = almacenOsmLocal.relacionesDeRuta("bus")
+            else:
+                relaciones = LectorJsonOverpass(consultaOverpassEnTrozos(peticionOverpass))
 
-            if respuesta["elements"]:
-                for relacion in respuesta["elements"]:
-                    print(f'Detalles de {relacion["tags"]["ref"]}:')
-                    print(json.dumps(relacion["tags"], indent=2))
-                    pausa()
+            for relacion in relaciones:
+                print(f'Detalles de {relacion["tags"]["ref"]}:')
+                print(json.dumps(relacion["tags"], indent=2))
+                pausa()
         
         elif seleccion == 4:
             peticionOverpass = '[out:json];'
@@ -1301,15 +5527,17 @@ def menuDepuracion():
             peticionOverpass += 'node["highway"="bus_stop"]["ref"~".+"][operator](area);'
             peticionOverpass += 'out meta;'
 
-            respuesta = json.loads(consultaOverpass(peticionOverpass))
+            if almacenOsmLocal is not None:
+                nodos = almacenOsmLocal.paradasConEtiquetas("ref", "operator")
+            else:
+                nodos = LectorJsonOverpass(consultaOverpassEnTrozos(peticionOverpass))
 
-            if respuesta["elements"]:
-                for nodo in respuesta["elements"]:
-                    if nodo["tags"]["operator"].find(";") != -1:
-                        nodo["tags"]["operator"] = "Setran"
-                        print(f'Detalles de {nodo["tags"]["ref"]}:')
-                        print(json.dumps(nodo["tags"], indent=2))
-                        pausa()
+            for nodo in nodos:
+                if nodo["tags"]["operator"].find(";") != -1:
+                    nodo["tags"]["operator"] = "Setran"
+                    print(f'Detalles de {nodo["tags"]["ref"]}:')
+                    print(json.dumps(nodo["tags"], indent=2))
+                    pausa()
 
         elif seleccion == 5:
             peticionOverpass = input("Ingresa la petición overpass: ")
@@ -1317,6 +5545,114 @@ def menuDepuracion():
             print(respuesta["elements"])
             pausa()
 
+        elif seleccion == 6:
+            conjunto = seleccionarOpcion(CONJUNTOS_GTFS, "Elige un conjunto de datos GTFS:")
+            if conjunto == -1:
+                continue
+
+            limpiarPantalla()
+            reporteTiemposDeCarga(os.path.join(RUTA_DATOS_GTFS, CONJUNTOS_GTFS[conjunto]))
+            pausa()
+
+        elif seleccion == 7:
+            conjunto = seleccionarOpcion(CONJUNTOS_GTFS, "Elige un conjunto de datos GTFS:")
+            if conjunto == -1:
+                continue
+
+            trabajadores = sinput("Número de procesos: ", tipoClase=int, rangoValido=(1, 64))
+            limpiarPantalla()
+            reporteCargaEnParalelo(
+                os.path.join(RUTA_DATOS_GTFS, CONJUNTOS_GTFS[conjunto]), trabajadores)
+            pausa()
+
+        elif seleccion == 8:
+            lat = sinput("Ingresa la latitud: ", tipoClase=float)
+            lon = sinput("Ingresa la longitud: ", tipoClase=float)
+            radio = sinput("Radio en metros (0 para las 10 más cercanas): ", tipoClase=float)
+
+            # Incluye las paradas de todos los conjuntos disponibles
+            indice = indiceDeParadasGtfs()
+            if radio > 0:
+                resultados = indice.enRadio(lat, lon, radio)
+            else:
+                resultados = indice.masCercanos(lat, lon, 10)
+
+            # Las paradas de cada conjunto se cargan una sola vez
+            paradasPorConjunto = {
+                nombreConjunto: cargarTablaGtfs(os.path.join(RUTA_DATOS_GTFS, nombreConjunto), "stops")
+                for nombreConjunto in {nombreConjunto for _, (nombreConjunto, _) in resultados}
+            }
+
+            textos = []
+            for distancia, (nombreConjunto, stop_id) in resultados:
+                paradas = paradasPorConjunto[nombreConjunto]
+                textos.append(
+                    f'{distancia:8.1f} m  [{nombreConjunto}] {stop_id}: {paradas[stop_id]["stop_name"]}')
+            limpiarPantalla()
+            listar(textos, f"Paradas cercanas a {lat},{lon}:")
+
+        elif seleccion == 9:
+            conjunto = seleccionarOpcion(CONJUNTOS_GTFS, "Elige un conjunto de datos GTFS:")
+            if conjunto == -1:
+                continue
+
+            limpiarPantalla()
+            reporteIndiceEspacial(os.path.join(RUTA_DATOS_GTFS, CONJUNTOS_GTFS[conjunto]))
+            pausa()
+
+        elif seleccion == 10:
+            rutaExtracto = input("Ruta del extracto (vacío para volver a usar Overpass): ").strip()
+            try:
+                cargarExtractoOsmLocal(rutaExtracto)
+            except (OSError, ET.ParseError) as e:
+                print(f"No se pudo cargar el extracto: {e}")
+            if almacenOsmLocal is None:
+                print("Se usará Overpass para las consultas a OSM.")
+            pausa()
+
+        elif seleccion == 11:
+            menuCacheOverpass()
+
+        elif seleccion == 12:
+            print("Sondeando servidores...")
+            obtenerClienteOverpass().clasificarServidores()
+            obtenerClienteOverpass().reporte()
+            pausa()
+
+        elif seleccion == 13:
+            if not instrumentacion.activa:
+                print("La instrumentación está apagada. Para usarla, inicia el programa con")
+                print("INSTRUMENTACION=1 (o INSTRUMENTACION=perfil,memoria para perfilar también)")
+                pausa()
+                continue
+            instrumentacion.mostrar()
+            if sinput("¿Guardar el reporte? (s/n): ", rangoValido=("s", "n")) == "s":
+                print(f"Guardado en {instrumentacion.guardar()}")
+            pausa()
+
+        elif seleccion == 14:
+            conjunto = seleccionarOpcion(CONJUNTOS_GTFS, "Elige un conjunto de datos GTFS:")
+            if conjunto == -1:
+                continue
+
+            limpiarPantalla()
+            reporteTrazos(os.path.join(RUTA_DATOS_GTFS, CONJUNTOS_GTFS[conjunto]))
+            pausa()
+
+        elif seleccion == 15:
+            conjunto = seleccionarOpcion(CONJUNTOS_GTFS, "Elige un conjunto de datos GTFS:")
+            if conjunto == -1:
+                continue
+
+            limpiarPantalla()
+            reporteDistanciasDeParadas(os.path.join(RUTA_DATOS_GTFS, CONJUNTOS_GTFS[conjunto]))
+            pausa()
+
+        elif seleccion == 16:
+            limpiarPantalla()
+            reporteGrafoDeCaminatas()
+            pausa()
+
 
 
 def menuPrincipal():
@@ -1340,10 +5676,497 @@ def menuPrincipal():
 
 
 def main():
+    print(os.name)
     menuPrincipal()
 
     return 0
 
 
+def escribirFilas(filas: list, formato: str, salida=None):
+    """Escribe las filas (diccionarios) como un arreglo JSON o como CSV"""
+    salida = salida or sys.stdout
+
+    if formato == "csv":
+        columnas = []
+        for fila in filas:
+            columnas.extend(k for k in fila if k not in columnas)
+        escritor = csv.DictWriter(salida, columnas, lineterminator="\n")
+        escritor.writeheader()
+        for fila in filas:
+            escritor.writerow({
+                k: json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v
+                for k, v in fila.items()
+            })
+    else:
+        json.dump(filas, salida, ensure_ascii=False, indent=2)
+        salida.write("\n")
+
+    salida.flush()
+
+
+def resolverConjuntoGtfs(valor: str):
+    """El nombre y la carpeta de un conjunto, dado su nombre en datos/gtfs o una ruta"""
+    if valor in CONJUNTOS_GTFS:
+        return valor, os.path.join(RUTA_DATOS_GTFS, valor)
+    if os.path.isdir(valor):
+        return os.path.basename(os.path.normpath(valor)), valor
+    raise argparse.ArgumentTypeError(f"no existe el conjunto GTFS {valor!r}")
+
+
+def horaCli(valor: str):
+    """HH:MM:SS, que en GTFS puede pasar de las 24:00:00"""
+    if not re.fullmatch(r"\d{1,2}:[0-5]\d:[0-5]\d", valor.strip()):
+        raise argparse.ArgumentTypeError(f"hora no válida {valor!r}: usa HH:MM:SS")
+    return horaASegundos(valor.strip())
+
+
+def diaDeServicioCli(valor: str):
+    try:
+        return diaDeServicio(valor)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"fecha no válida {valor!r}: usa AAAA-MM-DD o un día de la semana")
+
+
+def agenciasCli(args):
+    agencias = list(conjuntoGtfs.agency.values())
+    if args.agencia:
+        agencias = [a for a in agencias if a["agency_id"] in args.agencia]
+    return agencias
+
+
+def rutasCli(args):
+    rutas = []
+    for agencia in agenciasCli(args):
+        for ruta in sorted(conjuntoGtfs.routes.get(agencia["agency_id"], {}).values(), key=dividirRuta):
+            if not args.ruta or ruta["route_id"] in args.ruta:
+                rutas.append(ruta)
+    return rutas
+
+
+def viajesCli(args):
+    """Los pares (ruta, viaje) que piden --viaje, o un viaje por secuencia
+    distinta de paradas de cada ruta"""
+    pares = []
+    for ruta in rutasCli(args):
+        if args.viaje:
+            viajes = [v for v in conjuntoGtfs.trips.get(ruta["route_id"], {}).values()
+                      if v["trip_id"] in args.viaje]
+        else:
+            viajes = viajesRepresentativos(ruta)
+        pares.extend((ruta, viaje) for viaje in viajes)
+    return pares
+
+
+def cliRutas(args):
+    return [{
+        "agency_id": ruta["agency_id"],
+        "route_id": ruta["route_id"],
+        "route_short_name": ruta["route_short_name"],
+        "route_long_name": ruta["route_long_name"],
+        "route_type": ruta["route_type"],
+        "trips": len(conjuntoGtfs.trips.get(ruta["route_id"], {})),
+    } for ruta in rutasCli(args)]
+
+
+def cliParadas(args):
+    stops = conjuntoGtfs.stops
+
+    # Sin ruta ni viaje, todas las paradas del conjunto
+    if not (args.ruta or args.viaje):
+        return [{
+            "stop_id": p["stop_id"], "stop_name": p["stop_name"],
+            "stop_lat": p["stop_lat"], "stop_lon": p["stop_lon"],
+        } for p in stops.values()]
+
+    filas = []
+    for ruta, viaje in viajesCli(args):
+        for parada in ordenarParadas(conjuntoGtfs.stop_times[viaje["trip_id"]]):
+            horario = parada["stop_times"]
+            filas.append({
+                "route_id": ruta["route_id"],
+                "trip_id": viaje["trip_id"],
+                "stop_sequence": horario.stop_sequence,
+                "stop_id": horario.stop_id,
+                "stop_name": parada["stops"]["stop_name"],
+                "stop_lat": parada["stops"]["stop_lat"],
+                "stop_lon": parada["stops"]["stop_lon"],
+                "arrival_time": segundosAHora(horario.arrival_time),
+                "departure_time": segundosAHora(horario.departure_time),
+            })
+    return filas
+
+
+def cliHorario(args):
+    """Todas las corridas de los viajes (expandidas con frequencies), por parada"""
+    stop_times = conjuntoGtfs.stop_times
+    filas = []
+    for ruta, viaje in viajesCli(args):
+        tabla = conjuntoGtfs.horariosDeViaje(viaje["trip_id"])
+        for j, fila in enumerate(stop_times[viaje["trip_id"]]):
+            stop_id = stop_times.idParada(fila)
+            if args.parada and stop_id not in args.parada:
+                continue
+            for corrida, hora in enumerate(tabla.deParada(j)):
+                filas.append({
+                    "route_id": ruta["route_id"],
+                    "trip_id": viaje["trip_id"],
+                    "stop_id": stop_id,
+                    "run": corrida,
+                    "time": segundosAHora(hora),
+                })
+    return filas
+
+
+def cliDistancias(args):
+    """shape_dist_traveled de las paradas de los viajes, con la distancia
+    desde la parada anterior y el desvío al trazo"""
+    stop_times = conjuntoGtfs.stop_times
+    distancias = conjuntoGtfs.distances
+    filas = []
+    for ruta, viaje in viajesCli(args):
+        anterior = None
+        for fila in stop_times[viaje["trip_id"]]:
+            distancia = distancias.distancia[fila]
+            desvio = distancias.desvio[fila]
+            sinTrazo = math.isnan(distancia)
+            horario = stop_times.fila(fila)
+            filas.append({
+                "route_id": ruta["route_id"],
+                "trip_id": viaje["trip_id"],
+                "shape_id": viaje["shape_id"],
+                "stop_sequence": horario.stop_sequence,
+                "stop_id": horario.stop_id,
+                "shape_dist_traveled": None if sinTrazo else round(distancia, 1),
+                "dist_from_previous": None if sinTrazo or anterior is None else round(distancia - anterior, 1),
+                "dist_to_shape": None if sinTrazo else round(desvio, 1),
+                "far_from_shape": not sinTrazo and desvio > DIST_MAX_PARADA_TRAZO_METROS,
+            })
+            anterior = None if sinTrazo else distancia
+    return filas
+
+
+def cliViaje(args):
+    """Los itinerarios óptimos de Pareto (llegada, transbordos) entre dos paradas"""
+    stops = conjuntoGtfs.stops
+    args.paradasEncontradas.update(p for p in args.desde + args.hasta if p in stops)
+    # Si el conjunto no tiene las paradas, ni siquiera se arma su red
+    if not any(p in stops for p in args.desde) or not any(p in stops for p in args.hasta):
+        return []
+
+    filas = []
+    itinerarios = planificarViaje(args.desde, args.hasta, args.hora, args.maximo, args.fecha)
+    for i, itinerario in enumerate(itinerarios):
+        for tramo in itinerario["tramos"]:
+            filas.append({
+                "journey": i,
+                "arrival": segundosAHora(itinerario["llegada"]),
+                "transfers": itinerario["transbordos"],
+                "leg": tramo["tipo"],
+                "route_id": tramo.get("route_id", ""),
+                "trip_id": tramo.get("trip_id", ""),
+                "from_stop_id": tramo["desde"],
+                "to_stop_id": tramo["hasta"],
+                "departure_time": segundosAHora(tramo["salida"]) if "salida" in tramo else "",
+                "arrival_time": segundosAHora(tramo["llegada"]) if "llegada" in tramo else "",
+                "walk_secs": tramo.get("segundos", ""),
+            })
+    return filas
+
+
+def cliCaminatas(args):
+    """Construye (o carga) el grafo de caminatas de los conjuntos indicados"""
+    rutas = [ruta for _, ruta in args.conjunto or [resolverConjuntoGtfs(c) for c in CONJUNTOS_GTFS]]
+    inicio = time.perf_counter()
+    grafo = cargarGrafoDeCaminatas(rutas, reconstruir=args.reconstruir)
+    return [{
+        "feeds": "+".join(os.path.basename(os.path.normpath(r)) for r in rutas),
+        "stops": len(grafo.paradas),
+        "footpaths": len(grafo),
+        "radius_m": RADIO_CAMINATA_METROS,
+        "file": rutaGrafoDeCaminatas(rutas),
+        "seconds": round(time.perf_counter() - inicio, 3),
+    }]
+
+
+def cliViajeCombinado(args):
+    """Como cliViaje, sobre la red de todos los conjuntos indicados. Las
+    paradas se escriben conjunto:stop_id"""
+    rutas = [ruta for _, ruta in args.conjunto or [resolverConjuntoGtfs(c) for c in CONJUNTOS_GTFS]]
+    red = redRaptorCombinada(rutas)
+
+    def parada(valor):
+        nombre, _, stop_id = valor.partition(":")
+        return (nombre, stop_id)
+
+    args.paradasEncontradas.update(
+        p for p in args.desde + args.hasta if parada(p) in red.indiceParadas)
+
+    filas = []
+    itinerarios = red.planificar(
+        [parada(p) for p in args.desde], [parada(p) for p in args.hasta], args.hora, args.maximo,
+        args.fecha)
+    for i, itinerario in enumerate(itinerarios):
+        for tramo in itinerario["tramos"]:
+            filas.append({
+                "journey": i,
+                "arrival": segundosAHora(itinerario["llegada"]),
+                "transfers": itinerario["transbordos"],
+                "leg": tramo["tipo"],
+                "route_id": ":".join(tramo.get("route_id", ())),
+                "trip_id": ":".join(tramo.get("trip_id", ())),
+                "from_stop_id": ":".join(tramo["desde"]),
+                "to_stop_id": ":".join(tramo["hasta"]),
+                "departure_time": segundosAHora(tramo["salida"]) if "salida" in tramo else "",
+                "arrival_time": segundosAHora(tramo["llegada"]) if "llegada" in tramo else "",
+                "walk_secs": tramo.get("segundos", ""),
+            })
+    return filas
+
+
+def cliSalidas(args):
+    args.paradasEncontradas.update(p for p in args.parada if p in conjuntoGtfs.stops)
+    servicios = conjuntoGtfs.calendar.serviciosDelDia(args.fecha)
+    filas = []
+    for stop_id in args.parada:
+        for salida, trip_id, route_id in conjuntoGtfs.departures.proximasSalidas(
+                stop_id, args.hora, args.cantidad, servicios):
+            filas.append({
+                "stop_id": stop_id,
+                "time": segundosAHora(salida),
+                "trip_id": trip_id,
+                "route_id": route_id,
+            })
+    return filas
+
+
+def cliColisiones(args):
+    filas = []
+    for ruta, viaje, resultados in verificarColisionesEnLote(viajesCli(args)):
+        # Si la consulta falló no sabemos cuántas hay: no son cero
+        fila = {
+            "route_id": ruta["route_id"],
+            "trip_id": viaje["trip_id"],
+            "collisions": None if resultados is None else len(resultados["collisions"]),
+            "ambiguous": None if resultados is None else len(resultados["ambiguous"]),
+            "timestamp": None if resultados is None else resultados["timestamp"],
+            "error": "sin respuesta de Overpass" if resultados is None else None,
+        }
+        if args.detalle:
+            fila["results"] = resultados
+        filas.append(fila)
+    return filas
+
+
+def cliOsmchange(args):
+    agencias = agenciasCli(args)
+    if not agencias:
+        return []
+    resumen = exportarOsmchangeEnLote(
+        args.nombreConjunto, agencias,
+        comprimir=args.gzip,
+        idsRutas=set(args.ruta) if args.ruta else None,
+        directorio=args.directorio,
+        pausarAlFinalizar=False)
+    return [resumen]
+
+
+def cliOverpass(args, salida):
+    """Escribe la respuesta de la consulta. Devuelve 1 si ningún servidor
+    respondió o si Overpass contestó con un error"""
+    global limitePeticionesAlcanzado
+    limitePeticionesAlcanzado = False
+    peticion = sys.stdin.read() if args.peticion == "-" else args.peticion
+    # Overpass avisa de los errores al principio (HTML o XML) o al final (remark)
+    recibido = {"bytes": 0, "cabeza": b"", "cola": b""}
+
+    def vigilar(trozos):
+        for trozo in trozos:
+            recibido["bytes"] += len(trozo)
+            if len(recibido["cabeza"]) < 2048:
+                recibido["cabeza"] += trozo[:2048]
+            recibido["cola"] = (recibido["cola"] + trozo)[-2048:]
+            yield trozo
+
+    trozos = vigilar(consultaOverpassEnTrozos(peticion, forzarActualizacion=args.forzar or None))
+    try:
+        if args.elementos:
+            lector = LectorJsonOverpass(trozos)
+            elementos = list(lector)
+            if "runtime error" in lector.cabecera.get("remark", ""):
+                print(f'Overpass devolvió un error: {lector.cabecera["remark"]}')
+                return 1
+            escribirFilas(elementos, args.formato, salida)
+        else:
+            for trozo in trozos:
+                salida.buffer.write(trozo)
+            salida.flush()
+    except ValueError as e:
+        # Lo que llegó no es JSON (p. ej. la página de error de una petición mal escrita)
+        print(f"La respuesta de Overpass no se pudo leer: {e}")
+        return 1
+
+    if limitePeticionesAlcanzado or not recibido["bytes"]:
+        print("Ningún servidor Overpass devolvió una respuesta.")
+        return 1
+    if any(error in parte for parte in (recibido["cabeza"], recibido["cola"])
+           for error in (b"runtime error", b"Error</strong>")):
+        print("Overpass devolvió un error.")
+        return 1
+    return 0
+
+
+def cli(argumentos: list = None):
+    """
+    Interfaz sin menús, para usar el programa desde scripts. Los resultados
+    van a la salida estándar en JSON o CSV; los mensajes de avance, a la
+    salida de errores.
+    """
+    analizador = argparse.ArgumentParser(
+        description="Consultas sobre conjuntos GTFS y OSM sin pasar por los menús.")
+    analizador.add_argument(
+        "-c", "--conjunto", action="append", type=resolverConjuntoGtfs,
+        help="Conjunto GTFS (nombre en datos/gtfs o carpeta). Se puede repetir; "
+             "por defecto, todos los de datos/gtfs")
+    analizador.add_argument("-f", "--formato", choices=("json", "csv"), default="json")
+    analizador.add_argument("--extracto", help="Extracto OSM local a usar en lugar de Overpass")
+
+    subcomandos = analizador.add_subparsers(dest="orden", required=True)
+
+    def filtros(sub, parada=False):
+        sub.add_argument("-a", "--agencia", action="append", help="agency_id (se puede repetir)")
+        sub.add_argument("-r", "--ruta", action="append", help="route_id (se puede repetir)")
+        sub.add_argument("-v", "--viaje", action="append", help="trip_id (se puede repetir)")
+        if parada:
+            sub.add_argument("-p", "--parada", action="append", help="stop_id (se puede repetir)")
+        return sub
+
+    filtros(subcomandos.add_parser("rutas", help="Listar rutas")).set_defaults(funcion=cliRutas)
+    filtros(subcomandos.add_parser(
+        "paradas", help="Paradas del conjunto, o de las rutas/viajes indicados con sus horas"
+    )).set_defaults(funcion=cliParadas)
+    filtros(subcomandos.add_parser(
+        "horario", help="Horario de todas las corridas de los viajes, por parada"
+    ), parada=True).set_defaults(funcion=cliHorario)
+
+    filtros(subcomandos.add_parser(
+        "distancias", help="shape_dist_traveled y distancia entre paradas de los viajes"
+    )).set_defaults(funcion=cliDistancias)
+
+    sub = subcomandos.add_parser("viaje", help="Planificar un viaje entre dos paradas")
+    sub.add_argument("--desde", action="append", required=True, help="stop_id de origen (se puede repetir)")
+    sub.add_argument("--hasta", action="append", required=True, help="stop_id de destino (se puede repetir)")
+    sub.add_argument("--hora", type=horaCli, default=time.strftime("%H:%M:%S"),
+                     help="HH:MM:SS (por defecto, la hora actual)")
+    sub.add_argument("--fecha", type=diaDeServicioCli,
+                     help="AAAA-MM-DD o día de la semana (lunes...domingo). Por defecto, hoy; "
+                          "si el conjunto ya no está vigente, el día de la semana de hoy")
+    sub.add_argument("-m", "--maximo", type=int, default=MAX_VIAJES_RAPTOR,
+                     help="Máximo de vehículos distintos")
+    sub.add_argument("--combinar", action="store_true",
+                     help="Planificar sobre todos los conjuntos a la vez, caminando entre ellos. "
+                          "Las paradas van como conjunto:stop_id")
+    sub.set_defaults(funcion=cliViaje)
+
+    sub = subcomandos.add_parser(
+        "caminatas", help="Construir el grafo de caminatas entre las paradas de los conjuntos")
+    sub.add_argument("--reconstruir", action="store_true", help="Aunque ya esté guardado")
+    sub.set_defaults(funcion=cliCaminatas)
+
+    sub = subcomandos.add_parser("salidas", help="Próximas salidas desde una parada")
+    sub.add_argument("-p", "--parada", action="append", required=True)
+    sub.add_argument("--hora", type=horaCli, default=time.strftime("%H:%M:%S"),
+                     help="HH:MM:SS (por defecto, la hora actual)")
+    sub.add_argument("--fecha", type=diaDeServicioCli,
+                     help="AAAA-MM-DD o día de la semana (lunes...domingo). Por defecto, hoy; "
+                          "si el conjunto ya no está vigente, el día de la semana de hoy")
+    sub.add_argument("-n", "--cantidad", type=int, default=10)
+    sub.set_defaults(funcion=cliSalidas)
+
+    sub = filtros(subcomandos.add_parser("colisiones", help="Buscar las paradas de los viajes en OSM"))
+    sub.add_argument("--detalle", action="store_true", help="Incluir las colisiones encontradas")
+    sub.set_defaults(funcion=cliColisiones)
+
+    sub = subcomandos.add_parser("osmchange", help="Exportar las rutas a un archivo osmChange")
+    sub.add_argument("-a", "--agencia", action="append")
+    sub.add_argument("-r", "--ruta", action="append")
+    sub.add_argument("-d", "--directorio", default="~")
+    sub.add_argument("--gzip", action="store_true", default=COMPRIMIR_OSMCHANGE)
+    sub.set_defaults(funcion=cliOsmchange)
+
+    sub = subcomandos.add_parser("overpass", help="Hacer una consulta Overpass QL")
+    sub.add_argument("peticion", help='La consulta, o "-" para leerla de la entrada estándar')
+    sub.add_argument("--elementos", action="store_true",
+                     help="Escribir solo los elementos (requiere [out:json]) en el formato elegido")
+    sub.add_argument("--forzar", action="store_true", help="Ignorar la caché")
+
+    args = analizador.parse_args(argumentos)
+    salida = sys.stdout
+
+    try:
+        # Todo lo que imprima el resto del programa es avance; la salida
+        # estándar queda solo para los resultados
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.extracto:
+                cargarExtractoOsmLocal(args.extracto)
+
+            if args.orden == "overpass":
+                return cliOverpass(args, salida)
+
+            # Las paradas de --desde y --hasta (o --parada) que existen en algún conjunto
+            args.paradasEncontradas = set()
+
+            # Estas trabajan sobre todos los conjuntos juntos, no uno por uno
+            if args.orden == "caminatas" or (args.orden == "viaje" and args.combinar):
+                funcion = cliCaminatas if args.orden == "caminatas" else cliViajeCombinado
+                filas = funcion(args)
+            else:
+                global conjuntoGtfs
+                filas = []
+                for nombre, ruta in args.conjunto or [resolverConjuntoGtfs(c) for c in CONJUNTOS_GTFS]:
+                    conjuntoGtfs = ConjuntoGtfs(ruta)
+                    args.nombreConjunto = nombre
+                    filas.extend(dict(feed=nombre, **fila) for fila in args.funcion(args))
+
+            if args.orden in ("viaje", "salidas"):
+                paradas = args.desde + args.hasta if args.orden == "viaje" else args.parada
+                desconocidas = [p for p in paradas if p not in args.paradasEncontradas]
+                if desconocidas:
+                    analizador.error(f'paradas desconocidas: {", ".join(desconocidas)}')
+            if args.orden == "viaje":
+                if not filas:
+                    print("No hay ningún viaje entre esas paradas a esa hora.")
+                    return 1
+
+            escribirFilas(filas, args.formato, salida)
+
+            # Lo que sí se hizo ya está en la salida; el estado avisa de lo que faltó
+            if args.orden == "colisiones":
+                fallidos = sum(1 for fila in filas if fila["error"])
+                if fallidos:
+                    print(f"{fallidos} de {len(filas)} viajes no se pudieron consultar en OSM.")
+                    return 1
+            if args.orden == "osmchange":
+                if not filas or any(fila["file"] is None for fila in filas):
+                    print("No se escribió ningún archivo osmChange.")
+                    return 1
+                if any(fila["skipped_routes"] for fila in filas):
+                    print("Algunas rutas no se exportaron porque no se pudieron consultar sus paradas en OSM.")
+                    return 1
+    except BrokenPipeError:
+        # Quien leía la salida (p. ej. head) ya no quiere más: terminamos en
+        # silencio, como las herramientas de Unix. Al salir Python vacía la
+        # salida estándar y volvería a fallar, así que la mandamos a devnull
+        os.dup2(os.open(os.devnull, os.O_WRONLY), salida.fileno())
+        return 141
+
+    return 0
+
+
 if __name__ == "__main__":
+    if instrumentacion.activa:
+        instrumentacion.iniciar(guardarAlSalir=True)
+    # Con argumentos se usa la interfaz de línea de órdenes; sin ellos, los menús
+    if len(sys.argv) > 1:
+        sys.exit(cli())
     main()
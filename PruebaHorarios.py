@@ -0,0 +1,178 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Prueba el tablero de salidas (TableroDeSalidas) y el planificador RAPTOR
+(RedRaptor) sobre un conjunto GTFS pequeño que se arma en una carpeta
+temporal, con servicios entre semana y en domingo y un día festivo.
+
+    python -m pytest PruebaHorarios.py
+"""
+
+import sys
+import datetime
+
+import pytest
+
+import Main
+
+
+# A, B, C y D quedan a más de 1 km entre sí; E, a unos 95 m de D
+PARADAS = """stop_id,stop_name,stop_lat,stop_lon
+A,Parada A,20.00,-103.00
+B,Parada B,20.01,-103.00
+C,Parada C,20.02,-103.00
+D,Parada D,20.03,-103.00
+E,Parada E,20.03,-103.0009
+"""
+RUTAS = """agency_id,route_id,route_type,route_short_name,route_long_name
+P,R1,3,R1,A - C
+P,R2,3,R2,A - C directo
+P,R3,3,R3,B - D
+P,R4,3,R4,A - D
+P,R5,3,R5,E - C
+"""
+VIAJES = """route_id,service_id,trip_id,trip_headsign,direction_id,shape_id
+R1,LV,R1-LV,C,0,
+R2,D,R2-D,C,0,
+R3,LV,R3-LV,D,0,
+R4,LV,R4-LV,D,0,
+R5,D,R5-D,C,0,
+"""
+HORARIOS = """trip_id,arrival_time,departure_time,stop_id,stop_sequence
+R1-LV,08:00:00,08:00:00,A,1
+R1-LV,08:10:00,08:10:00,B,2
+R1-LV,08:20:00,08:20:00,C,3
+R2-D,08:05:00,08:05:00,A,1
+R2-D,08:12:00,08:12:00,C,2
+R3-LV,08:12:00,08:12:00,B,1
+R3-LV,08:30:00,08:30:00,D,2
+R4-LV,08:01:00,08:01:00,A,1
+R4-LV,09:00:00,09:00:00,D,2
+R5-D,10:00:00,10:00:00,E,1
+R5-D,10:30:00,10:30:00,C,2
+"""
+# R1 sale de A cada 15 minutos: 08:00, 08:15, 08:30 y 08:45
+FRECUENCIAS = """trip_id,start_time,end_time,headway_secs
+R1-LV,08:00:00,09:00:00,900
+"""
+CALENDARIO = """service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date
+LV,1,1,1,1,1,0,0,20240101,20241231
+D,0,0,0,0,0,0,1,20240101,20241231
+"""
+# El lunes 6 de mayo es festivo: corre el servicio de domingo
+FECHAS_CALENDARIO = """service_id,date,exception_type
+LV,20240506,2
+D,20240506,1
+"""
+
+LUNES = datetime.date(2024, 5, 13)
+DOMINGO = datetime.date(2024, 5, 12)
+FESTIVO = datetime.date(2024, 5, 6)
+
+
+@pytest.fixture
+def conjunto(tmp_path, monkeypatch):
+    """El conjunto de prueba, con su caché de instantáneas en la carpeta temporal"""
+    monkeypatch.setattr(Main, "RUTA_CACHE_GTFS", str(tmp_path / "cache"))
+    ruta = tmp_path / "Prueba"
+    ruta.mkdir()
+    archivos = {
+        "agency.txt": "agency_id,agency_name\nP,Prueba\n",
+        "stops.txt": PARADAS,
+        "routes.txt": RUTAS,
+        "trips.txt": VIAJES,
+        "stop_times.txt": HORARIOS,
+        "frequencies.txt": FRECUENCIAS,
+        "calendar.txt": CALENDARIO,
+        "calendar_dates.txt": FECHAS_CALENDARIO,
+    }
+    for nombre, contenido in archivos.items():
+        (ruta / nombre).write_text(contenido, encoding="utf-8")
+
+    conjunto = Main.ConjuntoGtfs(str(ruta))
+    monkeypatch.setattr(Main, "conjuntoGtfs", conjunto)
+    return conjunto
+
+
+def salidas(conjunto, stop_id, hora, dia):
+    return [
+        (Main.segundosAHora(segundos), trip_id)
+        for segundos, trip_id, _ in conjunto.departures.proximasSalidas(
+            stop_id, Main.horaASegundos(hora), 10, conjunto.calendar.serviciosDelDia(dia))
+    ]
+
+
+def resumen(itinerarios):
+    """(llegada, transbordos) de cada itinerario"""
+    return [(Main.segundosAHora(i["llegada"]), i["transbordos"]) for i in itinerarios]
+
+
+def pruebaSalidasOrdenadasPorHora(conjunto):
+    assert salidas(conjunto, "A", "07:55:00", LUNES) == [
+        ("08:00:00", "R1-LV"),
+        ("08:01:00", "R4-LV"),
+        ("08:15:00", "R1-LV"),
+        ("08:30:00", "R1-LV"),
+        ("08:45:00", "R1-LV"),
+    ]
+    assert salidas(conjunto, "A", "08:20:00", LUNES)[0] == ("08:30:00", "R1-LV")
+    assert salidas(conjunto, "E", "08:00:00", LUNES) == []
+
+
+def pruebaSalidasSoloDelServicioDelDia(conjunto):
+    assert salidas(conjunto, "A", "07:55:00", DOMINGO) == [("08:05:00", "R2-D")]
+    # El festivo quita el servicio entre semana y pone el de domingo
+    assert salidas(conjunto, "A", "07:55:00", FESTIVO) == [("08:05:00", "R2-D")]
+    # Un día de la semana no toma en cuenta las fechas ni los festivos
+    assert salidas(conjunto, "A", "07:55:00", 0) == salidas(conjunto, "A", "07:55:00", LUNES)
+    # Sin servicios que filtrar salen todos
+    assert len(conjunto.departures.proximasSalidas("A", Main.horaASegundos("07:55:00"))) == 6
+
+
+def pruebaCalendarioFueraDeVigencia(conjunto):
+    assert conjunto.calendar.serviciosDelDia(datetime.date(2025, 5, 12)) == set()
+    assert conjunto.calendar.serviciosDelDia(0) == {"LV"}
+    assert not conjunto.calendar.cubre(datetime.date(2025, 5, 12))
+
+
+def pruebaRaptorOptimosDePareto(conjunto):
+    itinerarios = Main.planificarViaje("A", "D", Main.horaASegundos("07:55:00"), dia=LUNES)
+
+    # Directo en R4, o antes con un transbordo de R1 a R3 en B
+    assert resumen(itinerarios) == [("09:00:00", 0), ("08:30:00", 1)]
+    assert [t["trip_id"] for t in itinerarios[1]["tramos"]] == ["R1-LV", "R3-LV"]
+    assert itinerarios[1]["tramos"][0]["hasta"] == "B"
+
+
+def pruebaRaptorSoloServiciosDelDia(conjunto):
+    hora = Main.horaASegundos("07:55:00")
+
+    assert Main.planificarViaje("A", "D", hora, dia=DOMINGO) == []
+    assert resumen(Main.planificarViaje("A", "C", hora, dia=DOMINGO)) == [("08:12:00", 0)]
+    # Entre semana R2 no corre: a C solo se llega en R1
+    assert resumen(Main.planificarViaje("A", "C", hora, dia=LUNES)) == [("08:20:00", 0)]
+    assert resumen(Main.planificarViaje("A", "C", hora, dia=FESTIVO)) == [("08:12:00", 0)]
+    assert resumen(Main.planificarViaje("A", "D", hora, dia=0)) == [("09:00:00", 0), ("08:30:00", 1)]
+
+
+def pruebaRaptorCaminataAlFinal(conjunto):
+    # E solo tiene servicio en domingo, pero se llega caminando desde D
+    itinerarios = Main.planificarViaje("A", "E", Main.horaASegundos("07:55:00"), dia=LUNES)
+
+    caminata = itinerarios[-1]["tramos"][-1]
+    assert caminata["tipo"] == "caminata"
+    assert (caminata["desde"], caminata["hasta"]) == ("D", "E")
+    assert itinerarios[-1]["llegada"] == Main.horaASegundos("08:30:00") + caminata["segundos"]
+
+
+def pruebaRaptorDesdeLaInstantanea(conjunto):
+    """La red leída de disco planifica igual que la recién construida"""
+    hora = Main.horaASegundos("07:55:00")
+    esperado = resumen(conjunto.raptor.planificar("A", "D", hora, dia=LUNES))
+
+    otro = Main.ConjuntoGtfs(conjunto.ruta)
+    assert resumen(otro.raptor.planificar("A", "D", hora, dia=LUNES)) == esperado
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))
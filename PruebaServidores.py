@@ -0,0 +1,171 @@
+#!/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Prueba la clasificación de servidores Overpass de Main.ClienteOverpass
+contra servidores locales que imitan distintas instancias (rápida, lenta,
+sin límite, sin slots, con error y apagada), sin salir a internet. También
+que muchas tareas a la vez no sondeen cada servidor más de una vez.
+
+    python -m pytest PruebaServidores.py
+
+o, igual que antes, python PruebaServidores.py.
+"""
+
+import sys
+import time
+import socket
+import threading
+import contextlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import Main
+
+
+class ServidorOverpassSimulado:
+    """
+    Servidor HTTP local que contesta /status (y /timestamp) como una
+    instancia de Overpass, con el texto, el código de estado y el retraso
+    indicados. Cuenta las peticiones que recibe por ruta.
+    """
+
+    def __init__(self, nombre: str, status: str, retraso: float = 0, codigo: int = 200):
+        self.nombre = nombre
+        self.status = status
+        self.retraso = retraso
+        self.codigo = codigo
+        self.peticiones = Counter()
+        self.candado = threading.Lock()
+
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                ruta = self.path.rsplit("/", 1)[-1]
+                with servidor.candado:
+                    servidor.peticiones[ruta] += 1
+                time.sleep(servidor.retraso)
+                if ruta == "timestamp":
+                    cuerpo = "2000-01-01T00:00:00Z\n".encode("utf-8")
+                else:
+                    cuerpo = servidor.status.encode("utf-8")
+                self.send_response(servidor.codigo)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+        self.http = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+        self.url = f"http://127.0.0.1:{self.http.server_address[1]}/api"
+
+    def __enter__(self):
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.http.shutdown()
+        self.http.server_close()
+
+
+def urlSinServidor():
+    """Una URL local en la que no escucha nadie"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        puerto = s.getsockname()[1]
+    return f"http://127.0.0.1:{puerto}/api"
+
+
+@pytest.fixture
+def servidores():
+    """Los servidores simulados, ya escuchando, por nombre. "apagado" es
+    solo una URL; las demás entradas son ServidorOverpassSimulado"""
+    simulados = [
+        # Puntaje = latencia / slots libres (ver ClienteOverpass.puntaje)
+        ServidorOverpassSimulado(
+            "lento", "Rate limit: 2\n1 slots available now.\n", retraso=0.4),
+        ServidorOverpassSimulado(
+            "ocupado", "Rate limit: 2\nSlot available after: 2000-01-01T00:00:30Z, in 30 seconds.\n",
+            retraso=0.3),
+        ServidorOverpassSimulado("sin_limite", "Rate limit: 0\n", retraso=0.2),
+        ServidorOverpassSimulado("con_error", "Error interno", retraso=0.3, codigo=503),
+        ServidorOverpassSimulado(
+            "rapido", "Rate limit: 2\n2 slots available now.\n", retraso=0.02),
+    ]
+
+    with contextlib.ExitStack() as pila:
+        for servidor in simulados:
+            pila.enter_context(servidor)
+        yield dict({s.nombre: s for s in simulados}, apagado=urlSinServidor())
+
+
+def clienteDe(servidores: dict):
+    return Main.ClienteOverpass(
+        servidores=[s if isinstance(s, str) else s.url for s in servidores.values()],
+        vigenciaClasificacion=60)
+
+
+def nombreDe(servidores: dict, url: str):
+    return next(nombre for nombre, s in servidores.items() if (s if isinstance(s, str) else s.url) == url)
+
+
+def simulados(servidores: dict):
+    return [s for s in servidores.values() if not isinstance(s, str)]
+
+
+def pruebaClasificacion(servidores):
+    cliente = clienteDe(servidores)
+
+    inicio = time.perf_counter()
+    clasificacion = cliente.servidoresClasificados()
+    segundos = time.perf_counter() - inicio
+
+    orden = [nombreDe(servidores, r["url"]) for r in clasificacion]
+    # Los disponibles, ordenados por latencia entre slots libres
+    assert orden[:3] == ["rapido", "sin_limite", "lento"]
+    # Los que no tienen slots, dan error o están apagados, al final y no disponibles
+    assert set(orden[3:]) == {"ocupado", "con_error", "apagado"}
+    assert all(not r["disponible"] for r in clasificacion[3:])
+    # Se sondean a la vez: uno tras otro tardarían más de 1.2 s
+    assert segundos < 0.8
+
+
+def pruebaDescartarYVigencia(servidores):
+    cliente = clienteDe(servidores)
+
+    assert cliente.mejorServidor() == servidores["rapido"].url
+    cliente.descartar(servidores["rapido"].url)
+    assert cliente.mejorServidor() == servidores["sin_limite"].url
+
+    # Mientras la clasificación está vigente no se vuelve a sondear
+    cliente.servidoresClasificados()
+    assert all(s.peticiones["status"] == 1 for s in simulados(servidores))
+
+
+def pruebaUnSoloSondeoConMuchosHilos(servidores, monkeypatch):
+    # Al empezar un lote todas las tareas encuentran la clasificación
+    # y las marcas de tiempo vencidas a la vez
+    cliente = clienteDe(servidores)
+    monkeypatch.setattr(Main, "clienteOverpass", cliente)
+    monkeypatch.setattr(Main, "timestampsOsm", {})
+    monkeypatch.setattr(Main, "candadosTimestampOsm", defaultdict(threading.Lock))
+    urlRapido = servidores["rapido"].url
+
+    with ThreadPoolExecutor(16) as ejecutor:
+        clasificaciones = list(ejecutor.map(lambda _: cliente.servidoresClasificados(), range(16)))
+        timestamps = list(ejecutor.map(lambda _: Main.obtenerTimestampOsm(urlRapido), range(16)))
+
+    assert all(s.peticiones["status"] == 1 for s in simulados(servidores))
+    # Los hilos que esperaron usan la clasificación del que sondeó
+    assert all(c is clasificaciones[0] for c in clasificaciones)
+    assert servidores["rapido"].peticiones["timestamp"] == 1
+    assert set(timestamps) == {"2000-01-01T00:00:00Z"}
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, "-q"]))